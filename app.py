@@ -1,5 +1,9 @@
 
+import time
+SCRIPT_STARTED = time.time()
+
 import streamlit as st
+from utils import startup_profiler
 import pandas as pd
 import numpy as np
 import sqlite3
@@ -10,20 +14,18 @@ import hashlib
 import base64
 from cryptography.fernet import Fernet
 import json
-from llm_agent_pipeline import run_llm_data_flow, get_llm
+from utils.import_jobs import start_import_job, get_import_job
+from utils.snapshots import current_snapshot
+from utils import sharding
+from utils.export import export_table, remove_export, EXPORT_FORMATS
+from utils import db_explorer
 import sqlite3
 
-# Generate encryption key
-ENCRYPTION_KEY = Fernet.generate_key()
-cipher_suite = Fernet(ENCRYPTION_KEY)
-
 # Import helper functions
 from utils.helper import (
     run_complete_pipeline,
     decrypt_data,
-    get_database_data,
     get_database_schema,
-    download_dataframe_as_csv,
     initialize_session_state,
     cleanup_database,
     cleanup_expired_messages
@@ -82,10 +84,24 @@ def render_chat_interface():
             else:
                 with st.chat_message("assistant"):
                     st.write(msg.get("text", ""))
+                    if msg.get("approximation"):
+                        approx = msg["approximation"]
+                        st.caption(f"≈ Approximate: estimated from {approx['sample_rows']:,} sampled rows "
+                                   f"({approx['fraction']:.1%}), with 95% confidence intervals")
                     if "plot_figure" in msg and msg["plot_figure"] is not None:
                         st.pyplot(msg["plot_figure"])
+                    # Compound questions have one chart per part
+                    for fig in msg.get("plot_figures", []):
+                        st.pyplot(fig)
                     if "table_df" in msg and msg["table_df"] is not None:
                         st.dataframe(msg["table_df"])
+                    if msg.get("example") and not msg.get("example_saved"):
+                        # Accepted answers teach SQL generation by example; unreviewed ones never do
+                        if st.button("👍 Good answer", key=f"accept_{id(msg)}"):
+                            from utils import example_store
+                            example_store.add_example(**msg["example"], source="accepted")
+                            msg["example_saved"] = True
+                            st.caption("Saved as an example for similar questions.")
             #     st.chat_message("assistant").write(msg["content"])
             # if "graph" in msg:
             #     st.plotly_chart(msg["graph"], use_container_width=True)
@@ -108,7 +124,7 @@ def render_chat_interface():
 
     # Chat input
     with st.container():
-        col1, col2, col3 = st.columns([6, 1, 1])
+        col1, col2, col3, col4 = st.columns([5, 1.2, 1, 1])
         with col1:
             prompt = st.text_input(
                 "Ask a question about your financial data...",
@@ -117,27 +133,35 @@ def render_chat_interface():
                 placeholder='Ask me anything... eg. "what is the given data about?"'
             )
         with col2:
+            approximate = st.toggle(
+                "≈ Approx.",
+                key=f"approximate_{st.session_state.input_key}",
+                help="Answer aggregates from a sample table in a fraction of the time, with 95% confidence intervals"
+            )
+        with col3:
             if st.button("Send", type="primary", use_container_width=True):
                 if prompt:
-                    st.session_state.messages.append({"role": "user", "content": prompt})
+                    st.session_state.messages.append({"role": "user", "content": prompt, "approximate": approximate})
 
                     # Generate AI response with potential graphs/tables
-                    ai_response = generate_ai_response_with_visuals(prompt)
+                    ai_response = generate_ai_response_with_visuals(prompt, approximate=approximate)
                     st.session_state.messages.append(ai_response)
 
                     st.session_state.input_key += 1
                     st.rerun()
-        with col3:
+        with col4:
             if st.button("🗑️ Clear", use_container_width=True):
                 st.session_state.messages = []
+                st.session_state.pop("result_history", None)
                 st.session_state.input_key += 1
                 st.rerun()
 
-def get_database_connection(db_path='db/database.db'):
-    """Create and return a database connection."""
+def get_database_connection(db_path=None):
+    """Create and return a connection to the current dataset snapshot."""
     try:
-        if os.path.exists(db_path):
-            conn = sqlite3.connect(db_path)
+        db_path = db_path or current_snapshot()[1]
+        if db_path and os.path.exists(db_path):
+            conn = sharding.connect(db_path)
             return conn
         else:
             st.error(f"Database file not found at: {db_path}")
@@ -148,7 +172,7 @@ def get_database_connection(db_path='db/database.db'):
         st.error(f"Error connecting to database: {str(e)}")
         return None
 
-def generate_ai_response_with_visuals(prompt):
+def generate_ai_response_with_visuals(prompt, approximate=False):
     # Get database connection
     conn = get_database_connection()
     if not conn:
@@ -172,8 +196,13 @@ def generate_ai_response_with_visuals(prompt):
         if not api_key:
             return {"role": "assistant", "content": f"API key not configured for {provider}. Please add your API key in the sidebar."}
 
+        # The pipeline pulls in langchain and the LLM clients, so load it on the first question
+        from llm_agent_pipeline import run_llm_data_flow, get_llm
+        from utils.followups import ResultHistory
         llm = get_llm(provider, api_key)
-        result, response = run_llm_data_flow(conn, prompt, llm)
+        # Previous results of this chat, so follow-ups like "plot that as a pie" skip the database
+        history = st.session_state.setdefault("result_history", ResultHistory())
+        result, response = run_llm_data_flow(conn, prompt, llm, approximate=approximate, history=history)
         message = {"role": "assistant", "content": ""}
         message = {
             "role": "assistant",
@@ -182,8 +211,17 @@ def generate_ai_response_with_visuals(prompt):
         if "plot_figure" in response:
             message["plot_figure"]=response["plot_figure"]
 
+        if "plot_figures" in response:
+            message["plot_figures"]=response["plot_figures"]
+
+        if "approximation" in response:
+            message["approximation"]=response["approximation"]
+
         if "table_df" in response:
             message["table_df"]=response["table_df"]
+
+        if "example" in response:
+            message["example"]=response["example"]
         
         return message
     finally:
@@ -250,109 +288,14 @@ def render_sidebar_controls():
             import_clicked = st.form_submit_button("📥 Import Data", use_container_width=True, type="primary")
         
         if import_clicked:
-            st.write("🔄 Starting import process...")
-            
-            # Initialize pipeline status
-            if 'pipeline_status' not in st.session_state:
-                st.session_state.pipeline_status = {
-                    'data_loaded': False,
-                    'synthetic_fields_added': False,
-                    'data_encrypted': False,
-                    'database_stored': False
-                }
-            
-            # Step 1: Load data
-            st.write("Step 1: Loading data...")
-            try:
-                df = pd.read_csv('data/raw_customer_churn.csv')
-                st.session_state.pipeline_status['data_loaded'] = True
-                st.success(f"✅ Loaded {len(df)} rows of data")
-            except Exception as e:
-                st.error(f"❌ Failed to load data: {e}")
-                st.stop()
-            
-            # Step 2: Add synthetic fields
-            st.write("Step 2: Adding synthetic fields...")
-            try:
-                # Generate synthetic email addresses
-                df['email'] = [f"customer{i}@example.com" for i in range(len(df))]
-                
-                # Generate synthetic phone numbers
-                df['phone_number'] = [f"+1-555-{str(i).zfill(3)}-{str(i*2).zfill(4)}" for i in range(len(df))]
-                
-                # Generate synthetic join dates
-                base_date = datetime(2020, 1, 1)
-                df['join_date'] = [base_date + timedelta(days=i*30) for i in range(len(df))]
-                
-                # Generate synthetic last login dates
-                df['last_login'] = [base_date + timedelta(days=i*30 + np.random.randint(1, 365)) for i in range(len(df))]
-                
-                # Generate synthetic monthly transaction amounts
-                df['avg_monthly_txn'] = np.random.uniform(100, 5000, len(df))
-                
-                # Generate synthetic credit card types
-                card_types = ['Visa', 'MasterCard', 'American Express', 'Discover']
-                df['credit_card_type'] = np.random.choice(card_types, len(df))
-                
-                st.session_state.pipeline_status['synthetic_fields_added'] = True
-                st.success("✅ Added synthetic fields")
-            except Exception as e:
-                st.error(f"❌ Failed to add synthetic fields: {e}")
-                st.stop()
-            
-            # Step 3: Encrypt data
-            st.write("Step 3: Encrypting data...")
-            try:
-                df_encrypted = df.copy()
-                
-                # Fields to encrypt
-                sensitive_fields = ['email', 'phone_number', 'credit_card_type']
-                
-                for field in sensitive_fields:
-                    if field in df_encrypted.columns:
-                        # Encrypt the field
-                        encrypted_values = []
-                        for value in df_encrypted[field]:
-                            encrypted_value = cipher_suite.encrypt(str(value).encode())
-                            encrypted_values.append(base64.b64encode(encrypted_value).decode())
-                        
-                        # Rename column to indicate encryption
-                        new_field_name = f"{field}_encrypted"
-                        df_encrypted[new_field_name] = encrypted_values
-                        df_encrypted.drop(columns=[field], inplace=True)
-                
-                st.session_state.pipeline_status['data_encrypted'] = True
-                st.success("✅ Encrypted sensitive data")
-            except Exception as e:
-                st.error(f"❌ Failed to encrypt data: {e}")
-                st.stop()
-            
-            # Step 4: Store in database
-            st.write("Step 4: Storing in database...")
-            try:
-                # Create database directory if it doesn't exist
-                os.makedirs('db', exist_ok=True)
-                
-                # Connect to database
-                conn = sqlite3.connect('db/database.db')
-                
-                # Store the data
-                df_encrypted.to_sql('customer_data', conn, if_exists='replace', index=False)
-                
-                # Verify storage
-                result = pd.read_sql_query("SELECT COUNT(*) as count FROM customer_data", conn)
-                conn.close()
-                
-                st.session_state.pipeline_status['database_stored'] = True
-                st.session_state.data_processed = True
-                st.session_state.df_encrypted = df_encrypted
-                
-                st.success(f"✅ Stored {result['count'].iloc[0]} rows in database")
-                # st.balloons()
-                
-            except Exception as e:
-                st.error(f"❌ Failed to store in database: {e}")
-                st.stop()
+            job = get_import_job(st.session_state.get('import_job_id'))
+            if job is None or not job.active:
+                # Imports run in a background worker; the previous data stays queryable meanwhile
+                job = start_import_job()
+                st.session_state.import_job_id = job.id
+                st.session_state.pipeline_status = {key: False for key in st.session_state.pipeline_status}
+
+        import_running = render_import_progress()
         
         # Check if all pipeline steps are completed for button styling
         pipeline_completed = False
@@ -399,39 +342,160 @@ def render_sidebar_controls():
         if not data_available:
             st.caption("📥 Import the data to download the files")
         
+        export_format = st.selectbox(
+            "File format",
+            options=list(EXPORT_FORMATS),
+            format_func=EXPORT_FORMAT_LABELS.get,
+            disabled=not data_available
+        )
         download_encrypted = st.button("Download Encrypted Data", use_container_width=True, disabled=not data_available)
         download_decrypted = st.button("Download Decrypted Data", use_container_width=True, disabled=not data_available)
         
         return {
             'preview_database': preview_database,
+            'export_format': export_format,
             'download_encrypted': download_encrypted,
-            'download_decrypted': download_decrypted
+            'download_decrypted': download_decrypted,
+            'import_running': import_running
         }
 
-def render_database_preview(show_preview=False):
-    """Render the database preview section."""
-    if show_preview:
-        st.header("Database Preview")
-        
-        # Get data from database using helper function
-        df_db = get_database_data()
-        
-        if df_db is not None:
-            st.dataframe(
-                df_db, 
-                use_container_width=True,
-                hide_index=True
+EXPORT_FORMAT_LABELS = {
+    'csv': 'CSV',
+    'csv.gz': 'CSV (gzip)',
+    'csv.zst': 'CSV (zstd)',
+    'parquet': 'Parquet',
+}
+
+IMPORT_STAGE_LABELS = {
+    'load': 'Loading data',
+    'synthetic': 'Adding synthetic fields',
+    'encrypt': 'Encrypting data',
+    'store': 'Storing in database',
+    'sample': 'Building sample tables',
+    'profile': 'Profiling columns',
+    'tables': 'Loading related tables',
+    'catalog': 'Building the table catalog',
+    'publish': 'Publishing the new snapshot',
+}
+
+def render_import_progress():
+    """Show progress of the background import job. Returns True while it is still running."""
+    job = get_import_job(st.session_state.get('import_job_id'))
+    if job is None:
+        return False
+
+    progress = job.progress()
+    for key in progress['completed_stages']:
+        st.session_state.pipeline_status[key] = True
+
+    if job.active:
+        label = IMPORT_STAGE_LABELS.get(progress['stage'], 'Starting import')
+        st.progress(
+            min(progress['fraction'], 1.0),
+            text=f"🔄 {label}: {progress['rows_processed']}/{progress['total_rows']} rows "
+                 f"({progress['rows_per_sec']} rows/sec)"
+        )
+        if st.button("Cancel Import", use_container_width=True):
+            job.cancel()
+        return True
+
+    if progress['status'] == 'completed':
+        if st.session_state.get('import_applied') != job.id:
+            st.session_state.data_processed = True
+            st.session_state.import_applied = job.id
+        st.success(f"✅ Stored {progress['total_rows']} rows in database ({progress['rows_per_sec']} rows/sec)")
+        st.caption(f"Dataset version {progress['version']}")
+    elif progress['status'] == 'cancelled':
+        st.warning("⚠️ Import cancelled. The previous data is still available.")
+    elif progress['status'] == 'failed':
+        st.error(f"❌ Import failed: {progress['error']}")
+    return False
+
+def render_export(export_format, decrypt=False):
+    """Stream the table into an export file and offer it for download."""
+    kind = "Decrypted" if decrypt else "Encrypted"
+    try:
+        with st.spinner(f"Exporting {kind.lower()} data..."):
+            result = export_table(export_format, decrypt=decrypt)
+    except Exception as e:
+        st.error(f"Export failed: {str(e)}")
+        return
+    try:
+        with open(result.path, 'rb') as f:
+            st.download_button(
+                label=f"Download {kind} Data ({EXPORT_FORMAT_LABELS[export_format]}, {result.size_bytes / 1e6:.1f} MB)",
+                data=f,
+                file_name=result.file_name,
+                mime=result.mime,
+                use_container_width=True
             )
-            
-            # Show database info
-            with st.expander("Database Schema"):
-                schema = get_database_schema()
-                if schema:
-                    st.write("Database Schema:")
-                    for col in schema:
-                        st.write(f"• {col[1]} ({col[2]})")
-        else:
-            st.info("Database not created yet. Run the pipeline first.")
+    finally:
+        # The button holds the bytes now; decrypted PII must not stay on disk
+        remove_export(result)
+
+def render_database_preview(show_preview=False):
+    """Render the paginated database explorer."""
+    if not show_preview:
+        return
+    st.header("Database Preview")
+    try:
+        columns = [name for name, _ in db_explorer.table_columns(current_snapshot()[1])]
+    except Exception:
+        st.info("Database not created yet. Run the pipeline first.")
+        return
+
+    col1, col2 = st.columns([4, 1])
+    with col1:
+        selected = st.multiselect("Columns", options=columns, default=columns[:8], key="explorer_columns")
+    with col2:
+        page_size = st.selectbox("Rows per page", options=[50, 100, 250, 500], index=1, key="explorer_page_size")
+
+    fcol1, fcol2, fcol3 = st.columns([2, 1, 2])
+    with fcol1:
+        filter_column = st.selectbox("Filter column", options=["(none)"] + columns, key="explorer_filter_column")
+    with fcol2:
+        filter_operator = st.selectbox("Operator", options=db_explorer.FILTER_OPERATORS, key="explorer_filter_operator")
+    with fcol3:
+        filter_value = st.text_input("Value", key="explorer_filter_value", placeholder="e.g. France, or 1,2 for IN")
+    filters = [(filter_column, filter_operator, filter_value)] if filter_column != "(none)" and filter_value else []
+
+    # Start keys of the pages visited so far; reset when the query changes
+    query = (tuple(selected), tuple(filters), page_size, current_snapshot()[0])
+    if st.session_state.get('explorer_query') != query:
+        st.session_state.explorer_query = query
+        st.session_state.explorer_cursors = [None]
+    cursors = st.session_state.explorer_cursors
+
+    try:
+        page, next_key, stats = db_explorer.get_page(selected, filters, after_key=cursors[-1], page_size=page_size)
+    except Exception as e:
+        st.error(f"Could not load the page: {str(e)}")
+        return
+
+    # st.dataframe only renders the visible rows, so a whole page scrolls smoothly
+    st.dataframe(page, use_container_width=True, hide_index=True, height=400)
+
+    nav1, nav2, nav3 = st.columns([1, 3, 1])
+    with nav1:
+        if st.button("◀ Previous", use_container_width=True, disabled=len(cursors) == 1):
+            cursors.pop()
+            st.rerun()
+    with nav2:
+        first_row = (len(cursors) - 1) * page_size + 1
+        st.caption(f"Page {len(cursors)} · rows {first_row}–{first_row + len(page) - 1} · "
+                   f"{stats['ms']} ms from {stats['source']}")
+    with nav3:
+        if st.button("Next ▶", use_container_width=True, disabled=next_key is None):
+            cursors.append(next_key)
+            st.rerun()
+
+    # Show database info
+    with st.expander("Database Schema"):
+        schema = get_database_schema()
+        if schema:
+            st.write("Database Schema:")
+            for col in schema:
+                st.write(f"• {col[1]} ({col[2]})")
 
 def render_pipeline_logs(pipeline_status):
     """Render the pipeline logs section."""
@@ -481,17 +545,9 @@ def main():
         
         # Handle download requests
         if user_selections['download_encrypted']:
-            download_dataframe_as_csv(
-                st.session_state.df_encrypted, 
-                "encrypted_customer_data.csv",
-                "Download Encrypted Data"
-            )
+            render_export(user_selections['export_format'], decrypt=False)
         if user_selections['download_decrypted']:
-            download_dataframe_as_csv(
-                st.session_state.df_decrypted, 
-                "decrypted_customer_data.csv",
-                "Download Decrypted Data"
-            )
+            render_export(user_selections['export_format'], decrypt=True)
         
         # # Render data view
         # render_data_view(
@@ -507,6 +563,12 @@ def main():
         
         # Render footer
         render_footer()
+        startup_profiler.mark_first_paint(SCRIPT_STARTED)
+
+        # Poll the background import until it finishes
+        if user_selections['import_running']:
+            time.sleep(1)
+            st.rerun()
         
     except Exception as e:
         # Handle any unexpected errors
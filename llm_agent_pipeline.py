@@ -2,35 +2,102 @@
 import sqlite3
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-import streamlit as st
-from langchain_openai import ChatOpenAI
-from langchain_groq import ChatGroq
-from langchain.schema import HumanMessage
+from langchain_core.messages import HumanMessage
 from pydantic import BaseModel, Field
 from typing import Optional, List, Dict, Any, Literal
+from functools import lru_cache
 import utils.DataModels as dm
-from langchain.output_parsers import PydanticOutputParser
-from langchain.schema.messages import HumanMessage
 from utils.plotting import plot_chart
+from utils.llm_cache import RecordReplayLLM, DEFAULT_CACHE_DIR
+from utils.llm_clients import client_registry
+from utils.llm_scheduler import scheduler
+from utils.prompt_compiler import PromptCompiler, collect_prompt_reports, merge_prompt_reports, count_tokens
+from utils.question_router import route_question, log_routing_decision, ROUTER_CONFIDENCE_THRESHOLD
+from utils.speculation import speculation_stats
+from utils.stage_timings import collect_stage_timings, stage_timer
+from utils.db_pool import get_pool
+from utils.planner import plan_question
+from utils.sql_validator import validate_and_repair
+from utils.answer_formatter import format_answer, choose_chart, LOCAL_ANSWERS
+from utils.model_router import (ModelRouter, MODEL_ROUTING, select_model, record_outcome, route_stats,
+                                question_complexity, sql_complexity, result_complexity)
+from utils import snapshots, sharding, sampling, blind_index, followups, data_profile, query_log, example_store, catalog
+from utils.example_store import EXAMPLE_STORE, LEARN_EXAMPLES
+from concurrent.futures import ThreadPoolExecutor
+import os
+import queue
 import re
-
-# Create parser for your LLMResponse model
-parser = PydanticOutputParser(pydantic_object=dm.LLMResponse)
-
-def get_llm(provider, api_key):
-    if provider == "openai":
-        return ChatOpenAI(model="gpt-4.1-nano", api_key=api_key)
-    elif provider == "groq":
-        return ChatGroq(model="llama3-8b-8192", api_key=api_key)
+import time
+
+@lru_cache(maxsize=1)
+def get_parser():
+    """Parser for the LLMResponse model, created once per process on first use."""
+    from langchain_core.output_parsers import PydanticOutputParser
+    return PydanticOutputParser(pydantic_object=dm.LLMResponse)
+
+# Speculative routing: run llm_needs_sql and generate_structured_sql concurrently
+SPECULATIVE_ROUTING = os.environ.get("SPECULATIVE_ROUTING", "0") == "1"
+SPECULATIVE_EXECUTE = os.environ.get("SPECULATIVE_EXECUTE", "0") == "1"
+_speculation_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="speculative")
+# Sub-questions of a compound question run here, each on its own pooled connection
+_plan_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="sub-question")
+# How long a sub-question waits for a pooled connection before opening its own
+PLAN_POOL_WAIT_SECONDS = 1.0
+
+DEFAULT_MODELS = {
+    "openai": "gpt-4.1-nano",
+    "groq": "llama3-8b-8192",
+    "fake": "fake-llm",
+}
+
+def get_llm(provider, api_key, cache_mode=None, cache_dir=DEFAULT_CACHE_DIR, model_routing=None):
+    """
+    Return a chat model for the provider.
+
+    cache_mode selects the record/replay layer (see utils/llm_cache.py):
+    "off", "record", "replay" or "passthrough". When not given it is read from
+    the LLM_CACHE_MODE environment variable and defaults to "off".
+
+    With model_routing (MODEL_ROUTING=1) a ModelRouter is returned that picks a
+    model per stage and question complexity (see utils/model_router.py).
+    """
+    cache_mode = cache_mode or os.environ.get("LLM_CACHE_MODE", "off")
+    model_routing = MODEL_ROUTING if model_routing is None else model_routing
+    if model_routing:
+        return ModelRouter(provider, lambda model: _build_llm(provider, model, api_key, cache_mode, cache_dir))
+    return _build_llm(provider, DEFAULT_MODELS.get(provider), api_key, cache_mode, cache_dir)
+
+def _build_llm(provider, model, api_key, cache_mode, cache_dir):
+    llm = None
+    # Replay mode never talks to the provider, so it works without an API key
+    if cache_mode != "replay" or api_key:
+        # Clients are pooled per (provider, model, key) and reused across questions and sessions
+        llm = client_registry.get(provider, model, api_key)
+
+    if cache_mode == "off":
+        return llm
+    return RecordReplayLLM(llm, provider, model, mode=cache_mode, cache_dir=cache_dir)
+
+# Schema and sample rows per (database file, modification time, table)
+_schema_cache = {}
+
+def _database_path(conn):
+    rows = conn.execute("PRAGMA database_list").fetchall()
+    return next((row[2] for row in rows if row[1] == "main"), "")
 
 def get_db_schema_and_sample(conn, table_name="customer_data"):
-    cursor = conn.cursor()
-    cursor.execute(f"PRAGMA table_info({table_name})")
-    schema_info = cursor.fetchall()
+    db_path = _database_path(conn)
+    mtime = os.path.getmtime(db_path) if db_path and os.path.exists(db_path) else None
+    cache_key = (db_path, mtime, table_name)
+    if db_path and cache_key in _schema_cache:
+        return _schema_cache[cache_key]
+
+    schema_info = sharding.table_info(conn, table_name)
     columns = [(col[1], col[2]) for col in schema_info]  # (column_name, data_type)
 
     df_sample = pd.read_sql_query(f"SELECT * FROM {table_name} LIMIT 5", conn)
+    if db_path:
+        _schema_cache[cache_key] = (columns, df_sample)
     return columns, df_sample
 
 def generate_prompt(user_question, schema):
@@ -64,17 +131,24 @@ def generate_prompt(user_question, schema):
 #         return None, None
 
 
-def generate_structured_sql(llm, question, columns, df_sample, table_name="customer_data"):
-    context = build_prompt_context(question, columns, df_sample, table_name)
-
-    prompt = f"""
-{context}
-
+def generate_structured_sql(llm, question, columns, df_sample, table_name="customer_data", profile=None,
+                            selection=None):
+    compiler = PromptCompiler("sql_generation")
+    compiler.add_static("context", build_static_context(columns, df_sample, table_name, profile, selection))
+    compiler.add_static("instructions", """
 You are an AI that generates SQLite queries.
 
 Return only the raw SQL query (no markdown, no explanation).
-"""
-    response = llm.invoke([HumanMessage(content=prompt)])
+""")
+    if EXAMPLE_STORE:
+        # Validated SQL for similar past questions, most similar first
+        matches = example_store.search(question, selection.column_names() if selection else [c[0] for c in columns])
+        compiler.add_examples("examples", example_store.format_examples(matches),
+                              header="## SQL that answered similar questions:", dynamic=True)
+    compiler.set_question(f'User question: "{question}"')
+    prompt = compiler.compile()
+
+    response = scheduler.invoke(llm, [HumanMessage(content=prompt)], stage="sql_generation")
     sql_query = response.content.strip()
     
     return dm.SQLQuery(sql=sql_query, explanation="Generated by LLM")
@@ -99,14 +173,31 @@ def extract_sql(text):
     return "\n".join(clean_lines).strip()
 
 
-def execute_sql_query(conn, sql_query):
+def execute_sql_query(conn, sql_query, approximate=False, question=None):
+    """Run the SQL and return (df_result, error); every run is recorded in the query log."""
+    started = time.perf_counter()
+    mode = "direct"
     try:
         sql_query = sql_query.strip()
         sql_query=extract_sql(sql_query)
-        df_result = pd.read_sql_query(sql_query, conn)
+        if approximate:
+            # Aggregates run on a sample table; df_result.attrs["approximation"] describes it
+            df_result = sampling.execute_approximate(conn, sql_query)
+            if df_result is not None:
+                query_log.log_query(conn, question, df_result.attrs.get("executed_sql", sql_query),
+                                    time.perf_counter() - started, df_result, mode="approximate")
+                return df_result, None
+        manifest = sharding.load_manifest(_database_path(conn))
+        if manifest:
+            mode = "sharded"
+            df_result = sharding.execute_sharded(conn, sql_query, manifest)
+        else:
+            df_result = pd.read_sql_query(sql_query, conn)
+        query_log.log_query(conn, question, sql_query, time.perf_counter() - started, df_result, mode=mode)
         return df_result, None
     except Exception as e:
         error_msg = f"SQL Error: {str(e)}\nGenerated SQL: {sql_query}"
+        query_log.log_query(conn, question, sql_query, time.perf_counter() - started, error=str(e), mode=mode)
         return None, error_msg
 
 
@@ -153,23 +244,7 @@ def execute_sql_query(conn, sql_query):
 #         # Fallback: assume SQL needed if unclear
 #         return True, ""
 
-def llm_needs_sql(llm, question, columns, df_sample, table_name="customer_data"):
-    context = build_prompt_context(question, columns, df_sample, table_name)
-
-# ## Sample Questions:
-# Q: "What is the total revenue per category?" → yes  
-# Q: "Summarize the table" → yes  
-# Q: "What is a DataFrame?" → no | A DataFrame is a tabular data structure with labeled rows and columns.  
-# Q: "What does the dataset contain?" → no | The table contains customer data related to bank activity and churn.
-# Q: "Show me average age by gender and country" → yes  
-# Q: "What columns are available?" → no | The table contains: {', '.join(columns)}  
-# Q: "How is 'churn' defined in the table?" → no | Based on column name, churn indicates whether a customer left.  
-# Q: "Plot a histogram of balance column" → yes  
-# Q: "Count how many customers are active" → yes
-
-    prompt = f"""
-{context}
-
+NEEDS_SQL_INSTRUCTIONS = """
 You are an AI data analyst. Your job is to determine whether answering the user's question requires executing a SQL query on the dataset.
 
 ## All the questions are related to this database, the schema of which is provided above.
@@ -202,29 +277,36 @@ You are an AI data analyst. Your job is to determine whether answering the user'
 - You MUST reply `yes` if the answer requires accessing the actual data values, even for a simple count or filter.
 - You MUST reply `no | <short explanation>` only if the question is purely about schema, column names, or metadata.
 - If you are unsure, default to `yes`.
-
-## Examples:
-Q: "What is the total revenue per category?" → yes  
-Q: "Summarize the table" → yes  
-Q: "What is a DataFrame?" → no | A DataFrame is a tabular data structure...
-Q: "List last few things I asked" → no  
-Q: "What is the data about?" → no | The data contains customer bank activity and churn information.  
-Q: "What is the SQL syntax for inner join?" → no
-Q: "Show me the average age and credit score by country and gender." → yes  
-Q: "Provide a chart of churn rate by country." → yes  
-Q: "Plot the distribution of account balances." → yes  
-Q: "How many male customers are there?" → yes  
-Q: "Which country has the highest average salary?" → yes  
-Q: "Give the standard deviation of age per gender." → yes  
-Q: "Which gender has higher churn?" → yes  
-Q: "What columns are in the data?" → no | The dataset contains columns like age, country, churn, etc.  
-Q: "What does the churn column represent?" → no | It shows whether the customer left the bank (1) or stayed (0).
-
-## Now answer this:
-Q: "{question}"
 """
 
-    result = llm.invoke([HumanMessage(content=prompt)])
+# Ordered by usefulness: trim_examples keeps them from the top until the few-shot budget is spent
+NEEDS_SQL_EXAMPLES = [
+    'Q: "What columns are in the data?" → no | The dataset contains columns like age, country, churn, etc.',
+    'Q: "How many male customers are there?" → yes',
+    'Q: "What is the data about?" → no | The data contains customer bank activity and churn information.',
+    'Q: "Provide a chart of churn rate by country." → yes',
+    'Q: "What does the churn column represent?" → no | It shows whether the customer left the bank (1) or stayed (0).',
+    'Q: "Show me the average age and credit score by country and gender." → yes',
+    'Q: "What is a DataFrame?" → no | A DataFrame is a tabular data structure...',
+    'Q: "Summarize the table" → yes',
+    'Q: "Plot the distribution of account balances." → yes',
+    'Q: "Which country has the highest average salary?" → yes',
+    'Q: "What is the SQL syntax for inner join?" → no',
+    'Q: "Give the standard deviation of age per gender." → yes',
+    'Q: "List last few things I asked" → no',
+    'Q: "Which gender has higher churn?" → yes',
+    'Q: "What is the total revenue per category?" → yes',
+]
+
+def llm_needs_sql(llm, question, columns, df_sample, table_name="customer_data", profile=None, selection=None):
+    compiler = PromptCompiler("routing")
+    compiler.add_static("context", build_static_context(columns, df_sample, table_name, profile, selection))
+    compiler.add_static("instructions", NEEDS_SQL_INSTRUCTIONS)
+    compiler.add_examples("examples", NEEDS_SQL_EXAMPLES)
+    compiler.set_question(f'## Now answer this:\nQ: "{question}"')
+    prompt = compiler.compile()
+
+    result = scheduler.invoke(llm, [HumanMessage(content=prompt)], stage="routing")
     output = result.content.strip()
     if output.lower().startswith("yes"):
         return True, ""
@@ -238,29 +320,52 @@ Q: "{question}"
         return True, ""
 
 
-def build_prompt_context(question, columns, df_sample, table_name="customer_data"):
-    schema_str = "\n".join([f"{name}: {dtype}" for name, dtype in columns])
-
-    # Detailed column descriptions for accurate SQL generation
-    column_details = """
-Column Details:
-- customer_id: Unique integer identifier for each customer (Primary Key, e.g., 15634602). Not used for analytics, mainly for identification.
-- credit_score: Customer's credit score (integer, typically 300-850). Indicates creditworthiness.
-- country: Country where the customer resides (categorical: France, Spain, Germany). Useful for regional segmentation.
-- gender: Customer's gender (categorical: Male, Female).
-- age: Customer's age in years (integer, e.g., 42). Numeric, suitable for range queries, aggregation, and segmentation.
-- tenure: Number of years the customer has been with the bank (integer, 0-10). Useful for loyalty/retention analytics.
-- balance: Account balance (float, can be 0, e.g., 159660.8). Represents the money in the customer's account.
-- products_number: Number of bank products held by the customer (integer, e.g., 1-4). Useful for understanding customer engagement.
-- credit_card: Whether the customer has a credit card (binary: 1 = Yes, 0 = No).
-- active_member: Whether the customer is an active member (binary: 1 = Yes, 0 = No).
-- estimated_salary: Estimated annual salary of the customer (float, e.g., 101348.88). Useful for income-based segmentation.
-- churn: Target column. Indicates if the customer has left the bank (1 = Yes, 0 = No). Use this for churn prediction, not as a filter for retained customers unless explicitly asked.
+# Semantic descriptions of the known customer_data columns; value ranges and
+# categories come from the column profile stored with each snapshot
+COLUMN_DESCRIPTIONS = {
+    "customer_id": "Unique integer identifier for each customer (Primary Key). Not used for analytics, mainly for identification.",
+    "credit_score": "Customer's credit score. Indicates creditworthiness.",
+    "country": "Country where the customer resides. Useful for regional segmentation.",
+    "gender": "Customer's gender.",
+    "age": "Customer's age in years. Suitable for range queries, aggregation, and segmentation.",
+    "tenure": "Number of years the customer has been with the bank. Useful for loyalty/retention analytics.",
+    "balance": "Account balance (can be 0). Represents the money in the customer's account.",
+    "products_number": "Number of bank products held by the customer. Useful for understanding customer engagement.",
+    "credit_card": "Whether the customer has a credit card (1 = Yes, 0 = No).",
+    "active_member": "Whether the customer is an active member (1 = Yes, 0 = No).",
+    "estimated_salary": "Estimated annual salary of the customer. Useful for income-based segmentation.",
+    "email": "Customer email, stored encrypted as email_encrypted. Only exact matches work (email = 'name@example.com'); they run on a keyed blind index.",
+    "phone_number": "Customer phone number, stored encrypted as phone_number_encrypted. Only exact matches work; they run on a keyed blind index.",
+    "credit_card_type": "Card brand, stored encrypted as credit_card_type_encrypted. Filter with = or IN and GROUP BY credit_card_type as usual; this runs on a keyed blind index.",
+    "churn": "Target column. Indicates if the customer has left the bank (1 = Yes, 0 = No). Use this for churn prediction, not as a filter for retained customers unless explicitly asked.",
+}
+
+COLUMN_NOTES = """
 
 Notes:
 - Some numeric fields may be stored as TEXT. Use `CAST(column AS INTEGER/REAL)` as needed in SQL.
 """
 
+# Used for snapshots imported before column profiles existed
+COLUMN_DETAILS = "\nColumn Details:\n" + "\n".join(
+    f"- {name}: {description}" for name, description in COLUMN_DESCRIPTIONS.items()
+) + COLUMN_NOTES
+
+def build_static_context(columns, df_sample, table_name="customer_data", profile=None, selection=None):
+    """
+    Question-independent table context; identical across questions so it can be prefix-cached.
+    With a catalog.SchemaSelection (multi-table datasets) it is the pruned schema of the
+    tables the question needs instead, which varies per question but stays bounded in size.
+    """
+    if selection is not None:
+        details = {}
+        if profile and table_name in selection.columns:
+            kept = [name for name, _ in selection.columns[table_name]]
+            details[table_name] = data_profile.column_details(profile, COLUMN_DESCRIPTIONS, only=kept) + COLUMN_NOTES
+        return "\n" + catalog.render_schema(selection, details)
+    schema_str = "\n".join([f"{name}: {dtype}" for name, dtype in columns])
+    details = data_profile.column_details(profile, COLUMN_DESCRIPTIONS) + COLUMN_NOTES if profile else COLUMN_DETAILS
+
     return f"""
 You are working with a SQLite table.
 
@@ -269,17 +374,16 @@ Table name: {table_name}
 Schema:
 {schema_str}
 
-{column_details}
+{details}
+"""
 
+def build_prompt_context(question, columns, df_sample, table_name="customer_data", profile=None):
+    # Static context first, question last so the prefix stays cacheable
+    return f"""{build_static_context(columns, df_sample, table_name, profile)}
 User question: "{question}"
 """
 
-def build_prompt(question: str, df_markdown: str, columns: list, parser) -> str:
-    allowed_charts = ['bar', 'pie', 'line', 'scatter']
-    format_instructions = parser.get_format_instructions()
-    column_str = ", ".join(columns)
-
-    return f"""
+ANALYSIS_INSTRUCTIONS = """
 You are a data analyst. A user has asked a question, and the data shown below has already been **filtered or aggregated appropriately using a SQL query** based on that question.
 
 This means:
@@ -300,19 +404,21 @@ If a chart will make the answer clearer, set the 'chart' field to a JSON object
 - reason: (why this chart helps the answer)
 
 If no chart is needed, set 'chart' to null.
+"""
 
----
-
-Data:
-{df_markdown}
-
-User Question:
-{question}
-
-Columns in the data are: {column_str}
+def build_prompt(question: str, df_markdown: str, columns: list, parser, notes: str = "") -> str:
+    allowed_charts = ['bar', 'pie', 'line', 'scatter']
+    format_instructions = parser.get_format_instructions()
+    column_str = ", ".join(columns)
 
-{format_instructions}
-"""
+    compiler = PromptCompiler("analysis")
+    compiler.add_static("instructions", ANALYSIS_INSTRUCTIONS.format(allowed_charts=allowed_charts))
+    compiler.add_static("format_instructions", format_instructions)
+    compiler.add_dynamic("data", f"---\n\nData:\n{df_markdown}\n\nColumns in the data are: {column_str}")
+    if notes:
+        compiler.add_dynamic("notes", f"Notes about the data:\n{notes}")
+    compiler.set_question(f"User Question:\n{question}")
+    return compiler.compile()
 
 # def plot_chart(df, chart_metadata: ChartMetadata):
 #     if not chart_metadata or not chart_metadata.chart_type:
@@ -376,25 +482,320 @@ Columns in the data are: {column_str}
 
 
 
-def analyze_data_with_llm(llm, question, df_result, parser, columns):
+def analyze_data_with_llm(llm, question, df_result, parser, columns, notes=""):
     df_markdown = df_result.to_markdown(index=False)
-    prompt = build_prompt(question, df_markdown, columns, parser)
+    prompt = build_prompt(question, df_markdown, columns, parser, notes)
 
-    response = llm.invoke([HumanMessage(content=prompt)])
+    response = scheduler.invoke(llm, [HumanMessage(content=prompt)], stage="analysis")
     print(response)
     parsed = parser.parse(response.content)
     return parsed
 
 
+def answer_from_result(llm, question, df_result, parser, columns, notes="", approximation=None, sql=None):
+    """
+    Answer locally from a template when the result shape is trivial, otherwise
+    with the analysis LLM call. Returns (LLMResponse, "template" or "llm").
+    """
+    if LOCAL_ANSWERS:
+        local = format_answer(question, df_result, approximation)
+        if local is not None:
+            print("answered from a template, skipped the analysis call")
+            return local, "template"
+    analysis_llm = select_model(llm, "analysis", result_complexity(sql, df_result))
+    try:
+        final_result = analyze_data_with_llm(analysis_llm, question, df_result, parser, columns, notes)
+    except Exception:
+        record_outcome(analysis_llm, False)
+        raise
+    record_outcome(analysis_llm, True)
+    return final_result, "llm"
+
+
+def _speculate_routing_and_sql(conn, llm, question, columns, df_sample, table_name, pre_execute, approximate=False,
+                               profile=None, sql_llm=None, selection=None):
+    """
+    Issue the routing call and SQL generation concurrently.
+
+    Returns (needs_sql, answer, sql_query_obj, pre_result). When routing says "no"
+    the in-flight SQL is discarded and its tokens are booked as wasted. With
+    pre_execute the SQL also runs on its own read-only connection while routing
+    is still in flight, and pre_result holds its (df_result, error).
+    """
+    db_path = _database_path(conn)
+
+    def timed(fn, *args, **kwargs):
+        start = time.perf_counter()
+        with collect_prompt_reports() as reports:
+            result = fn(*args, **kwargs)
+        return result, reports, time.perf_counter() - start
+
+    def generate_and_pre_execute():
+        sql_query_obj = generate_structured_sql(sql_llm or llm, question, columns, df_sample, table_name=table_name,
+                                                profile=profile, selection=selection)
+        pre_result = None
+        if pre_execute and db_path:
+            # sqlite3 connections are bound to their thread, so open a private one
+            spec_conn = sharding.connect(db_path, read_only=True)
+            try:
+                pre_result = execute_sql_query(spec_conn, sql_query_obj.sql, approximate, question)
+            finally:
+                spec_conn.close()
+        return sql_query_obj, pre_result
+
+    start = time.perf_counter()
+    routing_future = _speculation_pool.submit(timed, llm_needs_sql, llm, question, columns, df_sample, table_name,
+                                              profile, selection)
+    sql_future = _speculation_pool.submit(timed, generate_and_pre_execute)
+
+    (needs_sql, answer), routing_reports, routing_seconds = routing_future.result()
+    merge_prompt_reports(routing_reports)
+
+    def book(future, discarded):
+        try:
+            (sql_query_obj, pre_result), sql_reports, sql_seconds = future.result()
+        except Exception as e:
+            print(f"speculative SQL generation failed: {e}")
+            return
+        sql_tokens = sum(r["total_tokens"] for r in sql_reports.values()) + count_tokens(sql_query_obj.sql)
+        speculation_stats.record(routing_seconds, sql_seconds, time.perf_counter() - start,
+                                 sql_tokens, discarded, pre_result is not None)
+
+    if not needs_sql:
+        # Don't wait for the discarded SQL; book its tokens once it finishes
+        sql_future.add_done_callback(lambda future: book(future, discarded=True))
+        return False, answer, None, None
+
+    (sql_query_obj, pre_result), sql_reports, _ = sql_future.result()
+    merge_prompt_reports(sql_reports)
+    book(sql_future, discarded=False)
+    return True, answer, sql_query_obj, pre_result
+
+
+def _answer_followup(llm, question, intent, history, parser):
+    """
+    Answer a follow-up from the previous results of the conversation.
+    Returns (df_result, response_dict), or None to run the question normally.
+    """
+    frame = history.latest
+    if intent.kind == "replot":
+        df_result, sql = frame.df, frame.sql
+        text, chart = followups.describe_reuse(intent), followups.followup_chart(frame, frame.df, intent.chart_type)
+    elif intent.kind in ("sort", "top"):
+        sql = followups.reuse_sql(intent)
+        df_result = history.query(sql)
+        text, chart = followups.describe_reuse(intent), followups.followup_chart(frame, df_result)
+    else:
+        complexity = question_complexity(question)
+        sql_llm = select_model(llm, "followup_sql", complexity)
+        sql_query_obj = followups.generate_followup_sql(sql_llm, question, history)
+        with history.connection() as result_conn:
+            sql, error, repairs = validate_and_repair(
+                result_conn, sql_query_obj.sql, list(frame.df.columns), followups.LATEST_TABLE,
+                llm=select_model(llm, "sql_repair", complexity, escalate=True),
+                question=question, schema_context=history.describe())
+        record_outcome(sql_llm, not error and "llm repair" not in repairs)
+        if error:
+            print(f"follow-up SQL failed validation ({error}), querying the database instead")
+            return None
+        print(f"follow-up SQL\n{sql}")
+        try:
+            df_result = history.query(sql)
+        except Exception as e:
+            print(f"follow-up SQL failed ({e}), querying the database instead")
+            return None
+        final_result, answered_by = answer_from_result(llm, question, df_result, parser, list(df_result.columns),
+                                                       sql=sql)
+        text, chart = final_result.text, final_result.chart
+
+    response_dict = {"text": text, "sql": sql, "followup": intent.kind, "chart": chart}
+    if intent.kind == "reaggregate":
+        response_dict["answered_by"] = answered_by
+    if intent.kind in ("sort", "top"):
+        response_dict["table_df"] = df_result
+    if chart:
+        try:
+            fig = plot_chart(df_result, chart)
+        except Exception as e:
+            print(f"could not plot the follow-up: {e}")
+            fig = None
+        if fig:
+            response_dict["plot_figure"] = fig
+    return df_result, response_dict
+
+
+def _run_sub_question(conn, db_path, question, llm, table_name, parser, speculative, speculative_execute,
+                      approximate):
+    """
+    Answer one sub-question, on `conn` or else on a connection from the pool of db_path.
+    Returns (df_result, response_dict, prompt reports, stage timings).
+    """
+    release = None
+    if conn is None:
+        pool = get_pool(db_path)
+        try:
+            conn = pool.acquire(timeout=PLAN_POOL_WAIT_SECONDS)
+            pool.borrowed += 1
+            release = pool.release
+        except queue.Empty:
+            # Every pooled connection is held, possibly by the callers waiting on us
+            conn = sharding.connect(db_path, read_only=True, check_same_thread=False)
+            release = lambda c: c.close()
+    try:
+        with collect_prompt_reports() as reports, collect_stage_timings() as timings:
+            df_result, response_dict = _run_question(conn, question, llm, table_name, parser, speculative,
+                                                     speculative_execute, approximate, planning=False)
+    except Exception as e:
+        print(f"sub-question failed: {e}")
+        df_result, response_dict, reports, timings = None, {"type": "error", "error": str(e)}, {}, {}
+    finally:
+        if release:
+            release(conn)
+    return df_result, response_dict, reports, timings
+
+
+def _run_plan(conn, plan, llm, table_name, parser, speculative, speculative_execute, approximate, history=None):
+    """
+    Answer the sub-questions of a QueryPlan concurrently and merge them into one answer
+    with a chart per part under "plot_figures". The first part runs on `conn` in this
+    thread, the others on pooled connections.
+    """
+    db_path = _database_path(conn)
+    args = (llm, table_name, parser, speculative, speculative_execute, approximate)
+    with stage_timer("sub_questions"):
+        # In-memory databases can't be shared with other connections, so their parts run one by one
+        futures = [_plan_pool.submit(_run_sub_question, None, db_path, sub_question, *args)
+                   for sub_question in plan.sub_questions[1:]] if db_path else []
+        results = [_run_sub_question(conn, db_path, plan.sub_questions[0], *args)]
+        if futures:
+            results += [future.result() for future in futures]
+        else:
+            results += [_run_sub_question(conn, db_path, sub_question, *args) for sub_question in plan.sub_questions[1:]]
+
+    data_version = snapshots.version_of(db_path)
+    sections, sqls, figures, sub_answers = [], [], [], []
+    for number, (sub_question, (df_result, response, reports, timings)) in enumerate(zip(plan.sub_questions, results), 1):
+        merge_prompt_reports({f"{stage}[{number}]": report for stage, report in reports.items()})
+        title = sub_question[0].upper() + sub_question[1:]
+        answer = {"question": sub_question, "sql": response.get("sql"), "answered_by": response.get("answered_by"),
+                  "approximation": response.get("approximation"), "timings": timings, "df": df_result}
+        if response.get("type") == "error":
+            answer["error"] = response["error"]
+            sections.append(f"**{title}**\nCould not answer this part: {response['error'].splitlines()[0]}")
+            sub_answers.append(answer)
+            continue
+        sections.append(f"**{title}**\n{response.get('text', '')}")
+        if response.get("sql"):
+            sqls.append(response["sql"])
+        fig = response.get("plot_figure")
+        if fig is None and plan.plot_all and df_result is not None:
+            # "... and plot both": every part gets a chart, even where the answer alone had none
+            chart = choose_chart(df_result)
+            fig = plot_chart(df_result, chart) if chart else None
+        if fig is not None:
+            figures.append(fig)
+        if history is not None and df_result is not None:
+            history.add(sub_question, response.get("sql"), df_result, response.get("chart"), data_version)
+        sub_answers.append(answer)
+
+    if all("error" in answer for answer in sub_answers):
+        return None, {"type": "error", "error": "\n".join(a["error"] for a in sub_answers)}
+    response_dict = {"text": "\n\n".join(sections), "sql": "\n\n".join(sqls), "plot_figures": figures,
+                     "sub_questions": sub_answers, "plan": plan.source}
+    return None, response_dict
+
+
 #main caller function
-def run_llm_data_flow(conn, question, llm, table_name="customer_data", parser=parser):
+def run_llm_data_flow(conn, question, llm, table_name="customer_data", parser=None,
+                      speculative=None, speculative_execute=None, approximate=False, history=None):
+    """
+    history is an optional followups.ResultHistory for the conversation: follow-ups
+    such as "sort that by balance" are answered from it, and new results are added.
+    """
+    parser = parser or get_parser()
+    speculative = SPECULATIVE_ROUTING if speculative is None else speculative
+    speculative_execute = SPECULATIVE_EXECUTE if speculative_execute is None else speculative_execute
+
+    started = time.perf_counter()
+    with collect_prompt_reports() as prompt_reports, collect_stage_timings() as timings:
+        df_result, response_dict = _run_question(conn, question, llm, table_name, parser,
+                                                 speculative, speculative_execute, approximate, history)
+
+    # Dataset version the answer was computed on, usable as a cache key
+    response_dict["data_version"] = snapshots.version_of(_database_path(conn))
+    if history is not None and df_result is not None:
+        history.add(question, response_dict.get("sql"), df_result, response_dict.get("chart"),
+                    response_dict["data_version"])
+    # Prompt size per stage for this question
+    response_dict["prompt_tokens"] = {stage: report["total_tokens"] for stage, report in prompt_reports.items()}
+    # Seconds per pipeline stage, and for the whole question
+    response_dict["timings"] = dict(timings, total=time.perf_counter() - started)
+    if speculative:
+        response_dict["speculation"] = speculation_stats.snapshot()
+    if isinstance(llm, ModelRouter):
+        response_dict["model_routes"] = route_stats.snapshot()
+    return df_result, response_dict
+
+
+def _run_question(conn, question, llm, table_name, parser, speculative=False, speculative_execute=False,
+                  approximate=False, history=None, planning=True):
 
     # Step 1: Get database schema
-    columns, df_sample = get_db_schema_and_sample(conn, table_name=table_name)
+    with stage_timer("schema"):
+        columns, df_sample = get_db_schema_and_sample(conn, table_name=table_name)
+        # Column statistics computed at import; None for older snapshots
+        profile = data_profile.load_profile(conn)
+        # With related tables loaded, prompts carry only the tables and columns this question needs
+        table_catalog = catalog.load_catalog(conn)
+        selection = catalog.select_schema(question, table_catalog) if table_catalog.multi_table else None
     print("fetching schema sucessful")
-
-    # needs_sql = llm_needs_sql(llm, question, columns, df_sample, table_name)
-    needs_sql, answer = llm_needs_sql(llm, question, columns, df_sample, table_name)
+    if selection:
+        print(f"schema pruned to {', '.join(selection.tables)} of {len(table_catalog.tables)} tables")
+
+    # Follow-ups on the previous answer don't need the database
+    if history is not None:
+        intent = followups.classify_followup(question, history, columns,
+                                             snapshots.version_of(_database_path(conn)))
+        if intent:
+            print(f"follow-up on the previous result ({intent.kind})")
+            with stage_timer("followup"):
+                answered = _answer_followup(llm, question, intent, history, parser)
+            if answered:
+                return answered
+
+    # Compound questions are split into independent parts that are answered concurrently
+    if planning:
+        with stage_timer("planning"):
+            plan = plan_question(question, select_model(llm, "planning", "simple"),
+                                 schema_names=[name for name, _ in columns] + list(table_catalog.tables))
+        if plan:
+            print(f"planned {len(plan.sub_questions)} sub-questions ({plan.source}): {plan.sub_questions}")
+            return _run_plan(conn, plan, llm, table_name, parser, speculative, speculative_execute, approximate,
+                             history)
+
+    sql_query_obj = None
+    pre_result = None
+    # With a ModelRouter each stage gets a model sized for the question; otherwise these are all `llm`
+    complexity = question_complexity(question)
+    routing_llm = select_model(llm, "routing", complexity)
+    sql_llm = select_model(llm, "sql_generation", complexity)
+    # Route locally first; only ask the LLM when the local router is not confident
+    decision = route_question(question, columns, COLUMN_DESCRIPTIONS, table_name, profile=profile)
+    if decision.confidence >= ROUTER_CONFIDENCE_THRESHOLD:
+        print(f"routed locally ({decision.source}, confidence {decision.confidence:.2f})")
+        needs_sql, answer = decision.needs_sql, decision.answer
+    elif speculative:
+        # Routing and SQL generation overlap, so they are timed together
+        with stage_timer("speculation"):
+            needs_sql, answer, sql_query_obj, pre_result = _speculate_routing_and_sql(
+                conn, routing_llm, question, columns, df_sample, table_name, speculative_execute, approximate,
+                profile, sql_llm, selection)
+        log_routing_decision(question, needs_sql)
+    else:
+        with stage_timer("routing"):
+            needs_sql, answer = llm_needs_sql(routing_llm, question, columns, df_sample, table_name, profile,
+                                              selection)
+        log_routing_decision(question, needs_sql)
     if not needs_sql:
         print("No sql needed")
         response_dict = {"text": answer}
@@ -402,23 +803,78 @@ def run_llm_data_flow(conn, question, llm, table_name="customer_data", parser=pa
         return dummy_df, response_dict
     print("SQL needed")
     
-    # Step 2: Generate SQL query using LLM
-    sql_query_obj = generate_structured_sql(llm, question, columns, df_sample, table_name=table_name)
+    # Step 2: Generate SQL query using LLM (unless speculation already did)
+    if sql_query_obj is None:
+        with stage_timer("sql_generation"):
+            sql_query_obj = generate_structured_sql(sql_llm, question, columns, df_sample, table_name=table_name,
+                                                    profile=profile, selection=selection)
     print(f"generated SQL query\n{sql_query_obj.sql}")
-    # Step 3: Execute SQL to get data
-    df_result, error = execute_sql_query(conn, sql_query_obj.sql)
+
+    column_names = [c[0] for c in columns]
+    # Columns of joined tables are valid in the SQL too
+    known_columns = sorted(set(column_names) | set(selection.column_names())) if selection else column_names
+    # Filters and grouping on encrypted fields run on their blind index columns
+    try:
+        bidx_sql, bidx_fields = blind_index.rewrite_sql(sql_query_obj.sql, conn, column_names)
+    except ValueError as e:
+        return None, {"type": "error", "error": str(e)}
+    if bidx_fields:
+        print(f"blind index rewrite ({', '.join(bidx_fields)})\n{bidx_sql}")
+        sql_query_obj = dm.SQLQuery(sql=bidx_sql, explanation=sql_query_obj.explanation)
+        pre_result = None
+
+    # Step 3: Validate locally and repair cheaply before paying for execution; an LLM
+    # repair escalates to a stronger model than the one that wrote the SQL
+    repair_complexity = "complex" if "complex" in (complexity, sql_complexity(sql_query_obj.sql)) else "simple"
+    with stage_timer("validation"):
+        validated_sql, error, repairs = validate_and_repair(
+            conn, sql_query_obj.sql, known_columns, table_name,
+            llm=select_model(llm, "sql_repair", repair_complexity, escalate=True), question=question,
+            schema_context=build_static_context(columns, df_sample, table_name, profile, selection))
+    record_outcome(sql_llm, not error and "llm repair" not in repairs)
+    if error:
+        print(f"SQL failed validation,\n{error} ")
+        return None, {"type": "error", "error": f"SQL Error: {error}\nGenerated SQL: {validated_sql}"}
+    if repairs:
+        print(f"repaired SQL ({', '.join(repairs)})\n{validated_sql}")
+        sql_query_obj = dm.SQLQuery(sql=validated_sql, explanation=sql_query_obj.explanation)
+        # Speculative results were computed from the unrepaired SQL
+        pre_result = None
+
+    # Step 4: Execute SQL to get data
+    if pre_result is not None:
+        df_result, error = pre_result
+    else:
+        with stage_timer("execution"):
+            df_result, error = execute_sql_query(conn, sql_query_obj.sql, approximate, question)
     if error:
         print(f"error occured,\n{error} ")
         return None, {"type": "error", "error": error}
-
-    # Step 4: Send data + user question to LLM for final analysis
-    column_names = [c[0] for c in columns]
-    final_result = analyze_data_with_llm(llm, question, df_result, parser, column_names)
-    response_dict = {"text": final_result.text}
+    # SQL that validated without an LLM repair and returned rows can become a few-shot example
+    # once the user accepts the answer; blind index rewrites are skipped since their literals are keyed hashes
+    learnable = EXAMPLE_STORE and not bidx_fields and "llm repair" not in repairs and len(df_result) > 0
+    if learnable and LEARN_EXAMPLES:
+        example_store.add_example(question, sql_query_obj.sql, known_columns)
+    approximation = df_result.attrs.get("approximation")
+    df_result = blind_index.label_results(conn, df_result)
+    notes = sampling.approximation_note(approximation) if approximation else ""
+
+    # Step 5: Answer from a template, or send data + user question to LLM for final analysis
+    with stage_timer("analysis"):
+        final_result, answered_by = answer_from_result(llm, question, df_result, parser, column_names, notes,
+                                                       approximation, sql_query_obj.sql)
+    response_dict = {"text": final_result.text, "sql": sql_query_obj.sql, "chart": final_result.chart,
+                     "answered_by": answered_by}
+    if approximation:
+        response_dict["approximation"] = approximation
+    if learnable and not LEARN_EXAMPLES:
+        # Arguments for example_store.add_example() when the user accepts the answer
+        response_dict["example"] = {"question": question, "sql": sql_query_obj.sql, "column_names": known_columns}
     print(final_result.text)
     if final_result.chart:
         print(final_result.chart)
-        fig = plot_chart(df_result, final_result.chart)
+        with stage_timer("chart"):
+            fig = plot_chart(df_result, final_result.chart)
         if fig:
             response_dict["plot_figure"] = fig
 
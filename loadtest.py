@@ -0,0 +1,280 @@
+"""
+Concurrent-session load test for the question pipeline.
+
+Simulates N analysts asking questions at the same time, each with their own
+chat history, against one process: the same pooled connections, LLM clients
+and scheduler the app and server.py share. The LLM is the offline fake model
+with a configurable latency distribution, so the numbers show what the
+pipeline itself costs under contention rather than what a provider charges.
+
+    python loadtest.py --users 16 --questions 20
+    python loadtest.py --users 32 --duration 120 --rows 200000 \
+        --latency "routing=0.1;sql_generation=lognormal:0.6,0.4;analysis=lognormal:0.9,0.5"
+
+With --rows the bundled CSV is resampled to that many rows and imported into
+a fresh dataset under --workdir, so the test never touches your own data.
+Reports throughput, p50/p95/p99 per pipeline stage and per question, error
+rates and peak RSS; --json writes the same report to a file. Imports run in a
+child process, so the peak RSS is that of serving questions only.
+"""
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+RAW_CSV = os.path.join(ROOT, "data", "raw_customer_churn.csv")
+DEFAULT_LATENCY = "routing=uniform:0.05,0.2;sql_generation=lognormal:0.5,0.4;sql_repair=lognormal:0.6,0.4;" \
+                  "followup_sql=lognormal:0.4,0.4;analysis=lognormal:0.8,0.5"
+
+# (weight, question); follow-ups only make sense after a result, see _next_question
+QUESTION_MIX = [
+    (10, "how many customers are there"),
+    (8, "how many customers have churned"),
+    (10, "average balance by country"),
+    (8, "average salary by gender"),
+    (6, "churn rate by age"),
+    (5, "what are the churn rates by country and gender"),
+    (3, "average balance by country and churn rate by gender"),
+    (4, "why do customers in Germany churn more"),
+    (4, "what columns are in the dataset"),
+    (3, "what values does country take"),
+    (3, "what is the range of age"),
+]
+FOLLOWUP_MIX = [
+    (4, "sort that by the second column"),
+    (3, "top 3 of those"),
+    (3, "plot that as a pie chart"),
+    (2, "what share of the total is each of those"),
+]
+# Share of questions asked as a follow-up when the user has a previous result
+FOLLOWUP_RATE = 0.25
+PERCENTILES = (50, 95, 99)
+
+
+def _weighted(rng, mix):
+    weights, questions = zip(*mix)
+    return rng.choices(questions, weights=weights)[0]
+
+
+def _next_question(rng, has_result):
+    if has_result and rng.random() < FOLLOWUP_RATE:
+        return _weighted(rng, FOLLOWUP_MIX)
+    return _weighted(rng, QUESTION_MIX)
+
+
+def build_dataset(rows, workdir, seed=0):
+    """Resample the bundled CSV to `rows` rows with fresh customer IDs and import it into workdir."""
+    source = pd.read_csv(RAW_CSV)
+    df = source.sample(n=rows, replace=rows > len(source), random_state=seed).reset_index(drop=True)
+    if "customer_id" in df.columns:
+        df["customer_id"] = np.arange(1, rows + 1)
+    csv_path = os.path.join(workdir, f"loadtest_{rows}.csv")
+    df.to_csv(csv_path, index=False)
+
+    print(f"importing {rows:,} rows ...")
+    started = time.perf_counter()
+    version = import_csv(csv_path)
+    print(f"imported {rows:,} rows in {time.perf_counter() - started:.1f}s (snapshot v{version})")
+
+
+def import_csv(csv_path):
+    from utils import import_jobs
+
+    job = import_jobs.start_import_job(csv_path)
+    while job.active:
+        time.sleep(0.2)
+    if job.status != "completed":
+        raise RuntimeError(f"import failed: {job.error or job.status}")
+    return job.version
+
+
+def run_in_child(target, *args):
+    """Run an import in a child process; its peak memory would otherwise be reported as the load test's."""
+    process = multiprocessing.get_context("spawn").Process(target=target, args=args)
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        raise SystemExit(f"dataset import failed (exit code {process.exitcode})")
+
+
+class LoadResults:
+    """Per-question outcomes and stage timings collected from every simulated user."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stage_seconds = defaultdict(list)
+        self.errors = Counter()
+        self.questions = 0
+        self.followups = 0
+        self.answered_by = Counter()
+
+    def record(self, response=None, error=None):
+        with self._lock:
+            self.questions += 1
+            if error is not None:
+                self.errors[error] += 1
+                return
+            if response.get("type") == "error":
+                self.errors["pipeline_error"] += 1
+            if response.get("followup"):
+                self.followups += 1
+            if response.get("answered_by"):
+                self.answered_by[response["answered_by"]] += 1
+            for stage, seconds in response.get("timings", {}).items():
+                self.stage_seconds[stage].append(seconds)
+
+    def report(self, elapsed, users):
+        stages = {}
+        for stage, values in sorted(self.stage_seconds.items(), key=lambda item: item[0] == "total"):
+            stages[stage] = {"count": len(values), "mean_ms": round(float(np.mean(values)) * 1000, 1)}
+            stages[stage].update({f"p{p}_ms": round(float(np.percentile(values, p)) * 1000, 1) for p in PERCENTILES})
+        error_count = sum(self.errors.values())
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return {
+            "users": users,
+            "questions": self.questions,
+            "followups": self.followups,
+            "elapsed_sec": round(elapsed, 2),
+            "throughput_qps": round(self.questions / elapsed, 2) if elapsed else 0.0,
+            "error_rate": round(error_count / self.questions, 4) if self.questions else 0.0,
+            "errors": dict(self.errors),
+            "answered_by": dict(self.answered_by),
+            "stages": stages,
+            # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+            "peak_rss_mb": round(rss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1),
+        }
+
+
+def simulate_user(user_id, llm, results, deadline, max_questions, think, options, seed):
+    from llm_agent_pipeline import run_llm_data_flow
+    from utils import snapshots
+    from utils.db_pool import get_pool
+    from utils.followups import ResultHistory
+
+    rng = random.Random(seed + user_id)
+    history = ResultHistory()
+    asked = 0
+    while asked < max_questions and time.time() < deadline:
+        question = _next_question(rng, history.latest is not None)
+        try:
+            # Like server.py: one snapshot per question, connections from the shared pool
+            with snapshots.pinned_snapshot() as (version, db_path):
+                with get_pool(db_path, size=options["pool_size"]).connection() as conn:
+                    _, response = run_llm_data_flow(conn, question, llm, history=history,
+                                                    speculative=options["speculative"])
+        except Exception as e:
+            results.record(error=type(e).__name__)
+        else:
+            results.record(response)
+            if response.get("plot_figure") is not None:
+                plt.close(response["plot_figure"])
+            for fig in response.get("plot_figures", []):
+                plt.close(fig)
+        asked += 1
+        time.sleep(think())
+
+
+def run_load_test(users, questions, duration, latency, think, speculative=False, ramp=0.0, seed=0):
+    # The fake client reads its latency when it is first created
+    os.environ["FAKE_LLM_LATENCY"] = latency
+    from llm_agent_pipeline import get_llm
+    from utils.fake_llm import parse_latency
+
+    llm = get_llm("fake", "")
+    results = LoadResults()
+    options = {"pool_size": users, "speculative": speculative}
+    deadline = time.time() + duration if duration else float("inf")
+    max_questions = questions if questions else float("inf")
+    think_sampler = parse_latency(think)
+
+    threads = []
+    started = time.perf_counter()
+    for user_id in range(users):
+        thread = threading.Thread(target=simulate_user, name=f"user-{user_id}", daemon=True,
+                                  args=(user_id, llm, results, deadline, max_questions, think_sampler, options, seed))
+        thread.start()
+        threads.append(thread)
+        if ramp:
+            time.sleep(ramp / users)
+    for thread in threads:
+        thread.join()
+    return results.report(time.perf_counter() - started, users)
+
+
+def print_report(report):
+    print(f"\n{report['users']} users, {report['questions']} questions ({report['followups']} follow-ups) "
+          f"in {report['elapsed_sec']}s: {report['throughput_qps']} questions/s")
+    print(f"error rate {report['error_rate']:.2%} {report['errors'] or ''}".rstrip())
+    print(f"answered by {report['answered_by']}")
+    print(f"peak RSS {report['peak_rss_mb']} MB\n")
+    print(f"{'stage':<16}{'count':>7}{'mean ms':>10}" + "".join(f"{f'p{p} ms':>10}" for p in PERCENTILES))
+    for stage, stats in report["stages"].items():
+        print(f"{stage:<16}{stats['count']:>7}{stats['mean_ms']:>10}"
+              + "".join(f"{stats[f'p{p}_ms']:>10}" for p in PERCENTILES))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent-session load test with the fake LLM")
+    parser.add_argument("--users", type=int, default=8, help="Concurrent simulated users")
+    parser.add_argument("--questions", type=int, default=10, help="Questions per user (0 for no limit)")
+    parser.add_argument("--duration", type=float, default=0, help="Stop after this many seconds (0 for no limit)")
+    parser.add_argument("--rows", type=int, default=0, help="Import a resampled dataset of this many rows first")
+    parser.add_argument("--workdir", default=None, help="Directory for the dataset; a temporary one with --rows")
+    parser.add_argument("--latency", default=DEFAULT_LATENCY,
+                        help='Fake LLM latency, e.g. "0.2" or "routing=0.1;analysis=lognormal:0.8,0.4"')
+    parser.add_argument("--think", default="0", help='Pause between a user\'s questions, e.g. "uniform:1,5"')
+    parser.add_argument("--ramp", type=float, default=0.0, help="Seconds over which users start")
+    parser.add_argument("--speculative", action="store_true", help="Run routing and SQL generation concurrently")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", default=None, help="Also write the report to this file")
+    parser.add_argument("--verbose", action="store_true", help="Show the pipeline's own log output")
+    args = parser.parse_args()
+    if not args.questions and not args.duration:
+        parser.error("set --questions or --duration")
+
+    # Dataset paths (db/...) are relative, so the working directory selects the dataset
+    workdir = args.workdir or (tempfile.mkdtemp(prefix="loadtest_") if args.rows else None)
+    if workdir:
+        os.makedirs(workdir, exist_ok=True)
+        os.chdir(workdir)
+    sys.path.insert(0, ROOT)
+    from utils import snapshots
+
+    if args.rows:
+        run_in_child(build_dataset, args.rows, workdir, args.seed)
+    elif snapshots.current_db_path() is None:
+        print("no dataset imported yet, importing the bundled CSV")
+        run_in_child(import_csv, RAW_CSV)
+
+    print(f"running {args.users} users ...")
+    # The pipeline logs every step; at load that drowns the report (and a buffer would count in the RSS)
+    with open(os.devnull, "w") as devnull:
+        quiet = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(devnull)
+        with quiet:
+            report = run_load_test(args.users, args.questions, args.duration, args.latency, args.think,
+                                   args.speculative, args.ramp, args.seed)
+    report["rows"] = args.rows or None
+    report["latency"] = args.latency
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+"""
+Headless HTTP service over the question pipeline.
+
+Runs run_llm_data_flow behind an async HTTP API so many users can share one
+process: SQLite connections, LLM clients and caches are pooled for the whole
+process and questions run on a fixed-size worker pool.
+
+    python server.py --port 8080 --workers 8
+    curl -X POST localhost:8080/query \
+         -d '{"question": "average balance by country", "provider": "fake"}'
+
+API keys come from the request body ("api_key") or OPENAI_API_KEY / GROQ_API_KEY.
+The "fake" provider needs no key and answers offline (see utils/fake_llm.py).
+Requests with the same "session_id" share their previous results, so follow-ups
+like "sort that by balance" are answered without the database.
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import matplotlib
+matplotlib.use("Agg")
+from aiohttp import web
+
+from llm_agent_pipeline import run_llm_data_flow, get_llm
+from utils.db_pool import get_pool, pool_metrics, retire_pools, retire_stale_pools
+from utils.plotting import figure_png
+from utils import snapshots
+from utils.followups import ResultHistory
+from utils.llm_clients import client_registry
+from utils.llm_scheduler import scheduler
+from utils.speculation import speculation_stats
+from utils.model_router import route_stats
+
+DEFAULT_WORKERS = 8
+MAX_RESULT_ROWS = 1000
+PROVIDERS = ("openai", "groq", "fake")
+# Result histories of the most recently active sessions
+MAX_SESSIONS = 1000
+
+_histories = OrderedDict()
+_histories_lock = threading.Lock()
+
+
+def _history_for(session_id):
+    if not session_id:
+        return None
+    with _histories_lock:
+        history = _histories.pop(session_id, None) or ResultHistory()
+        _histories[session_id] = history
+        while len(_histories) > MAX_SESSIONS:
+            _histories.popitem(last=False)
+        return history
+
+
+def _figure_to_png(fig):
+    return base64.b64encode(figure_png(fig)).decode("ascii")
+
+
+def _pool_for(db_path, workers):
+    # A newer snapshot was published: drop connections to the old ones
+    retire_stale_pools(db_path)
+    return get_pool(db_path, size=workers)
+
+
+def answer_question(question, provider, api_key, options, workers=DEFAULT_WORKERS, session_id=None):
+    """Run one question through the pipeline and return a JSON-serialisable payload."""
+    started = time.perf_counter()
+    llm = get_llm(provider, api_key)
+    # Stay on one snapshot for the whole question even if an import publishes meanwhile
+    with snapshots.pinned_snapshot() as (version, db_path):
+        if db_path is None:
+            raise FileNotFoundError("No dataset has been imported yet")
+        with _pool_for(db_path, workers).connection() as conn:
+            df_result, response = run_llm_data_flow(conn, question, llm, history=_history_for(session_id), **options)
+
+    payload = {
+        "text": response.get("text", ""),
+        "sql": response.get("sql"),
+        "error": response.get("error"),
+        "prompt_tokens": response.get("prompt_tokens", {}),
+        "data_version": version,
+        "approximation": response.get("approximation"),
+        "followup": response.get("followup"),
+        "answered_by": response.get("answered_by"),
+    }
+    if df_result is not None:
+        payload["columns"] = [str(c) for c in df_result.columns]
+        payload["row_count"] = len(df_result)
+        payload["rows"] = json.loads(df_result.head(MAX_RESULT_ROWS).to_json(orient="records", date_format="iso"))
+    if response.get("plot_figure") is not None:
+        payload["chart_png"] = _figure_to_png(response["plot_figure"])
+    if response.get("sub_questions"):
+        # Compound questions: one result and chart per part
+        payload["sub_questions"] = [{
+            "question": sub["question"],
+            "sql": sub.get("sql"),
+            "error": sub.get("error"),
+            "answered_by": sub.get("answered_by"),
+            "approximation": sub.get("approximation"),
+            "row_count": len(sub["df"]) if sub.get("df") is not None else None,
+            "rows": json.loads(sub["df"].head(MAX_RESULT_ROWS).to_json(orient="records", date_format="iso"))
+            if sub.get("df") is not None else None,
+        } for sub in response["sub_questions"]]
+        payload["chart_pngs"] = [_figure_to_png(fig) for fig in response.get("plot_figures", [])]
+    payload["elapsed_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    return payload
+
+
+async def handle_query(request):
+    try:
+        body = await request.json()
+    except ValueError:
+        return web.json_response({"error": "Request body must be JSON"}, status=400)
+
+    question = (body.get("question") or "").strip()
+    provider = body.get("provider") or request.app["default_provider"]
+    if not question:
+        return web.json_response({"error": "question is required"}, status=400)
+    if provider not in PROVIDERS:
+        return web.json_response({"error": f"provider must be one of {PROVIDERS}"}, status=400)
+
+    api_key = body.get("api_key") or os.environ.get(f"{provider.upper()}_API_KEY", "")
+    if provider != "fake" and not api_key:
+        return web.json_response({"error": f"API key not configured for {provider}"}, status=400)
+
+    options = {k: body[k] for k in ("speculative", "speculative_execute", "approximate") if k in body}
+    loop = asyncio.get_running_loop()
+    try:
+        payload = await loop.run_in_executor(
+            request.app["executor"], answer_question,
+            question, provider, api_key, options, request.app["workers"], body.get("session_id"))
+    except Exception as e:
+        return web.json_response({"error": str(e)}, status=500)
+    return web.json_response(payload, status=200 if not payload.get("error") else 422)
+
+
+async def handle_health(request):
+    version, db_path = snapshots.current_snapshot()
+    return web.json_response({"status": "ok", "data_version": version, "db_path": db_path})
+
+
+async def handle_metrics(request):
+    db_path = snapshots.current_db_path()
+    return web.json_response({
+        "db_pool": pool_metrics(db_path) if db_path else None,
+        "llm_clients": client_registry.metrics(),
+        "llm_scheduler": scheduler.metrics(),
+        "speculation": speculation_stats.snapshot(),
+        "model_routes": route_stats.snapshot(),
+    })
+
+
+def create_app(workers=DEFAULT_WORKERS, default_provider="openai"):
+    app = web.Application()
+    app["workers"] = workers
+    app["default_provider"] = default_provider
+    app["executor"] = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="query")
+
+    async def shutdown(app):
+        app["executor"].shutdown(wait=False)
+        retire_pools()
+
+    app.on_cleanup.append(shutdown)
+    app.router.add_post("/query", handle_query)
+    app.router.add_get("/health", handle_health)
+    app.router.add_get("/metrics", handle_metrics)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Financial Copilot query service")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("SERVICE_WORKERS", DEFAULT_WORKERS)))
+    parser.add_argument("--provider", default="openai", choices=PROVIDERS, help="Provider used when a request names none")
+    args = parser.parse_args()
+
+    if snapshots.current_db_path() is None:
+        parser.error("No dataset found. Import the data first.")
+    web.run_app(create_app(args.workers, args.provider), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -17,4 +17,25 @@ class ChartMetadata(BaseModel):
 
 class LLMResponse(BaseModel):
     text: str = Field(..., description="Mandatory textual explanation or answer")
-    chart: Optional[ChartMetadata] = Field(None, description="If chart is helpful, metadata to create it; otherwise, null.")
\ No newline at end of file
+    chart: Optional[ChartMetadata] = Field(None, description="If chart is helpful, metadata to create it; otherwise, null.")
+
+class RoutingDecision(BaseModel):
+    """Whether a question needs SQL, decided locally or by the LLM"""
+    needs_sql: bool = Field(description="True when the question has to be answered from the data")
+    confidence: float = Field(description="Confidence of the decision between 0 and 1")
+    answer: str = Field("", description="Direct answer when no SQL is needed")
+    source: Literal['rules', 'model', 'llm'] = Field(description="What made the decision")
+
+class QueryPlan(BaseModel):
+    """A compound question split into independent sub-questions"""
+    sub_questions: List[str] = Field(description="Independent questions, each answerable with one SQL query")
+    plot_all: bool = Field(False, description="The user asked for a chart of every part")
+    source: Literal['rules', 'llm'] = Field(description="What split the question")
+
+class FollowupIntent(BaseModel):
+    """A follow-up question that can be answered from the previous result"""
+    kind: Literal['replot', 'sort', 'top', 'reaggregate'] = Field(description="How the previous result is reused")
+    chart_type: Optional[Literal['bar', 'pie', 'line', 'scatter']] = Field(None, description="Chart type for a replot")
+    column: Optional[str] = Field(None, description="Result column to sort by")
+    descending: bool = Field(False, description="Sort direction")
+    limit: Optional[int] = Field(None, description="Number of rows to keep for top/bottom N")
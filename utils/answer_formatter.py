@@ -0,0 +1,150 @@
+"""
+Local answers for trivial result shapes.
+
+A single value ("how many male customers") or a small two-column group-by
+("average balance by country") does not need an analysis LLM call: the text
+is filled into a template and the chart is chosen from the column dtypes and
+cardinality. format_answer() returns None for anything more complex, and for
+questions that ask for an explanation, and the caller falls back to the LLM.
+
+Chart rules for a key column x and a value column y:
+- categorical x (or an integer code with few values): bar, or pie for counts
+  and shares with at most PIE_MAX_SLICES groups
+- ordered numeric x with many values: line when the rows are sorted by x,
+  scatter otherwise
+"""
+import os
+import re
+
+import pandas as pd
+from pandas.api import types as ptypes
+
+import utils.DataModels as dm
+
+LOCAL_ANSWERS = os.environ.get("LOCAL_ANSWERS", "1") == "1"
+# Larger group-bys go to the LLM, which can summarise them better than a list
+MAX_GROUPS = int(os.environ.get("LOCAL_ANSWER_MAX_GROUPS", "12"))
+# Integer keys with at most this many values are treated as categories (churn, tenure)
+MAX_CODE_VALUES = 12
+PIE_MAX_SLICES = 5
+MAX_SCALAR_COLUMNS = 4
+CI_SUFFIX = "_ci95"
+
+# Questions that ask for reasoning rather than the numbers
+EXPLAIN_WORDS = re.compile(r"\b(why|explain|insight|insights|recommend|suggest|interpret|reason|reasons|cause|causes)\b")
+COUNT_NAME = re.compile(r"(^|_)(count|cnt|num|number|customers|total_customers|n)(_|$)")
+SHARE_NAME = re.compile(r"(^|_)(rate|ratio|share|pct|percent|percentage|proportion|fraction)(_|$)")
+LABEL_WORDS = {"avg": "average", "cnt": "count", "num": "number of", "pct": "percentage", "std": "standard deviation",
+               "min": "minimum", "max": "maximum", "sum": "total"}
+
+
+def humanize(column):
+    words = [LABEL_WORDS.get(word, word) for word in str(column).lower().split("_") if word]
+    return " ".join(words) or str(column)
+
+
+def format_value(column, value):
+    if value is None or (isinstance(value, float) and pd.isna(value)):
+        return "no value"
+    if isinstance(value, bool) or not ptypes.is_number(value):
+        return str(value)
+    if SHARE_NAME.search(str(column).lower()) and 0 <= value <= 1:
+        return f"{value:.2%}"
+    if float(value).is_integer():
+        return f"{int(value):,}"
+    return f"{value:,.2f}"
+
+
+def _with_interval(df, row, column):
+    text = format_value(column, df[column].iloc[row])
+    ci_column = f"{column}{CI_SUFFIX}"
+    if ci_column in df.columns:
+        text += f" ± {format_value(column, df[ci_column].iloc[row])}"
+    return text
+
+
+def _is_categorical(series):
+    if ptypes.is_bool_dtype(series) or not ptypes.is_numeric_dtype(series):
+        return True
+    return ptypes.is_integer_dtype(series) and series.nunique() <= MAX_CODE_VALUES
+
+
+def _chart(chart_type, x, y, reason):
+    return dm.ChartMetadata(chart_type=chart_type, x_column=x, y_column=y, groupby_column=None,
+                            aggregation=None, reason=reason)
+
+
+def choose_chart(df):
+    """ChartMetadata for a key column followed by a value column, or None."""
+    columns = [c for c in df.columns if not str(c).endswith(CI_SUFFIX)]
+    if len(columns) != 2 or len(df) < 2:
+        return None
+    x, y = columns
+    if not ptypes.is_numeric_dtype(df[y]) or ptypes.is_bool_dtype(df[y]):
+        return None
+    if _is_categorical(df[x]):
+        if len(df) > 2 * MAX_GROUPS:
+            return None
+        name = str(y).lower()
+        if len(df) <= PIE_MAX_SLICES and (COUNT_NAME.search(name) or SHARE_NAME.search(name)) and (df[y] >= 0).all():
+            return _chart("pie", x, y, f"Share of {humanize(y)} per {humanize(x)}")
+        return _chart("bar", x, y, f"Compare {humanize(y)} across {humanize(x)}")
+    if ptypes.is_numeric_dtype(df[x]) or ptypes.is_datetime64_any_dtype(df[x]):
+        if df[x].is_monotonic_increasing or df[x].is_monotonic_decreasing:
+            return _chart("line", x, y, f"{humanize(y).capitalize()} over {humanize(x)}")
+        return _chart("scatter", x, y, f"{humanize(y).capitalize()} against {humanize(x)}")
+    return None
+
+
+def _scalar_text(df):
+    columns = [c for c in df.columns if not str(c).endswith(CI_SUFFIX)]
+    if len(columns) == 1:
+        return f"The {humanize(columns[0])} is {_with_interval(df, 0, columns[0])}."
+    return "\n".join(f"- {humanize(c).capitalize()}: {_with_interval(df, 0, c)}" for c in columns)
+
+
+def _grouped_text(df, x, y):
+    def key(i):
+        value = format_value(x, df[x].iloc[i])
+        # Bare codes such as churn 0/1 read better with the column name
+        return f"{humanize(x)} {value}" if ptypes.is_numeric_dtype(df[x]) else value
+
+    label = humanize(y)
+    lines = [f"{label.capitalize()} by {humanize(x)}:"]
+    lines += [f"- {key(i)}: {_with_interval(df, i, y)}" for i in range(len(df))]
+    values = pd.to_numeric(df[y], errors="coerce")
+    if values.notna().sum() >= 2 and values.nunique() > 1:
+        high, low = values.idxmax(), values.idxmin()
+        counted = COUNT_NAME.search(str(y).lower()) and not re.search(r"\b(count|number|total)\b", label)
+        most, least = (f"the most {label}", "the fewest") if counted else (f"the highest {label}", "the lowest")
+        summary = (f"{key(high)} has {most} ({format_value(y, df[y].loc[high])}) "
+                   f"and {key(low)} {least} ({format_value(y, df[y].loc[low])}).")
+        lines.append(summary[0].upper() + summary[1:])
+    return "\n".join(lines)
+
+
+def format_answer(question, df, approximation=None):
+    """
+    LLMResponse built from templates when the result shape is trivial, else None.
+    """
+    if df is None or df.empty or EXPLAIN_WORDS.search(question.lower()):
+        return None
+    df = df.reset_index(drop=True)
+    columns = [c for c in df.columns if not str(c).endswith(CI_SUFFIX)]
+
+    if len(df) == 1 and len(columns) <= MAX_SCALAR_COLUMNS:
+        text = _scalar_text(df)
+        chart = None
+    elif len(columns) == 2 and len(df) <= MAX_GROUPS:
+        x, y = columns
+        if not ptypes.is_numeric_dtype(df[y]) or ptypes.is_bool_dtype(df[y]):
+            return None
+        text = _grouped_text(df, x, y)
+        chart = choose_chart(df)
+    else:
+        return None
+
+    if approximation:
+        text += (f"\n\nThese are estimates from a {approximation['fraction']:.1%} sample "
+                 f"(± is the 95% confidence interval).")
+    return dm.LLMResponse(text=text, chart=chart)
@@ -0,0 +1,218 @@
+"""
+Keyed blind indexes for the encrypted PII columns.
+
+Fernet ciphertexts are randomized, so SQL cannot compare them. At import each
+encrypted field also gets a <field>_bidx column holding a truncated
+HMAC-SHA256 of the normalised plaintext, indexed in SQLite. Equality filters,
+IN lists and GROUP BY on those fields then run as indexed queries without
+decrypting anything. Substring and range predicates can't use a keyed hash
+and are rejected.
+
+rewrite_sql() turns what the LLM writes (credit_card_type = 'Visa',
+GROUP BY credit_card_type) into queries on the _bidx columns with the
+literals replaced by their blind index. Connections also get a
+blind_index(field, value) SQL function.
+
+The HMAC key comes from FINCOPILOT_BLIND_INDEX_KEY (urlsafe base64, at least
+32 bytes) or from db/blind_index.key, created with mode 0600 on first use.
+The key must stay stable: snapshots record the key ID they were built with,
+and after a key change the data has to be imported again.
+"""
+import base64
+import hashlib
+import hmac
+import os
+import re
+import secrets
+from functools import lru_cache
+
+from utils.sql_parse import mask
+
+KEY_ENV_VAR = "FINCOPILOT_BLIND_INDEX_KEY"
+KEY_PATH = "db/blind_index.key"
+INDEXED_FIELDS = ["email", "phone_number", "credit_card_type"]
+# Low-cardinality, non-identifying fields whose plaintext labels may be stored
+# so grouped results can show "Visa" instead of a hash
+LABELLED_FIELDS = ["credit_card_type"]
+LABELS_TABLE = "blind_index_labels"
+INFO_TABLE = "blind_index_info"
+DIGEST_BYTES = 16
+
+
+@lru_cache(maxsize=1)
+def get_key():
+    encoded = os.environ.get(KEY_ENV_VAR)
+    if encoded:
+        key = base64.urlsafe_b64decode(encoded)
+        if len(key) < 32:
+            raise ValueError(f"{KEY_ENV_VAR} must decode to at least 32 bytes")
+        return key
+    try:
+        with open(KEY_PATH, "rb") as f:
+            return base64.urlsafe_b64decode(f.read().strip())
+    except FileNotFoundError:
+        pass
+    os.makedirs(os.path.dirname(KEY_PATH), exist_ok=True)
+    key = secrets.token_bytes(32)
+    try:
+        fd = os.open(KEY_PATH, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o600)
+    except FileExistsError:
+        # Another process created it first
+        with open(KEY_PATH, "rb") as f:
+            return base64.urlsafe_b64decode(f.read().strip())
+    with os.fdopen(fd, "wb") as f:
+        f.write(base64.urlsafe_b64encode(key))
+    return key
+
+
+def key_id():
+    """Public fingerprint of the key, stored with each snapshot."""
+    return hmac.new(get_key(), b"blind-index-key-id", hashlib.sha256).hexdigest()[:12]
+
+
+def normalise(field, value):
+    value = str(value).strip()
+    if field == "phone_number":
+        return re.sub(r"\D", "", value)
+    return value.lower()
+
+
+def compute(field, value):
+    """Blind index of one value; the field name is mixed in so equal values in different fields differ."""
+    message = f"{field}\x00{normalise(field, value)}".encode()
+    return hmac.new(get_key(), message, hashlib.sha256).hexdigest()[:DIGEST_BYTES * 2]
+
+
+def add_blind_indexes(df):
+    """Add <field>_bidx columns for the plaintext fields present in df (before they are encrypted)."""
+    df = df.copy()
+    for field in INDEXED_FIELDS:
+        if field in df.columns:
+            df[f"{field}_bidx"] = [compute(field, value) for value in df[field]]
+    return df
+
+
+def labels_for(df):
+    """(field, bidx, label) rows for the labelled fields present in df."""
+    return {(field, compute(field, value), str(value))
+            for field in LABELLED_FIELDS if field in df.columns
+            for value in df[field].dropna().unique()}
+
+
+def index_columns(columns):
+    return [f"{field}_bidx" for field in INDEXED_FIELDS if f"{field}_bidx" in columns]
+
+
+def create_indexes(conn, columns, table_name="customer_data"):
+    for column in columns:
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table_name}_{column} ON {table_name}({column})")
+
+
+def write_metadata(conn, labels):
+    """Record the key ID and the plaintext labels of the labelled fields in a snapshot."""
+    conn.execute(f"CREATE TABLE IF NOT EXISTS {INFO_TABLE} (key_id TEXT)")
+    conn.execute(f"DELETE FROM {INFO_TABLE}")
+    conn.execute(f"INSERT INTO {INFO_TABLE} VALUES (?)", (key_id(),))
+    conn.execute(f"CREATE TABLE IF NOT EXISTS {LABELS_TABLE} (field TEXT, bidx TEXT PRIMARY KEY, label TEXT)")
+    conn.executemany(f"INSERT OR REPLACE INTO {LABELS_TABLE} VALUES (?, ?, ?)", sorted(labels))
+    conn.commit()
+
+
+def register(conn):
+    """Make blind_index(field, value) available in SQL on this connection."""
+    conn.create_function("blind_index", 2, lambda field, value: None if value is None else compute(field, value),
+                         deterministic=True)
+    return conn
+
+
+def check_key(conn):
+    """Raise when the snapshot's blind indexes were built with another key."""
+    try:
+        row = conn.execute(f"SELECT key_id FROM {INFO_TABLE}").fetchone()
+    except Exception:
+        return  # snapshot without blind indexes
+    if row and row[0] != key_id():
+        raise ValueError("The blind index key changed since this dataset was imported; import the data again")
+
+
+_LITERAL = r"'(?:[^']|'')*'"
+
+
+def _hash_literal(field, literal):
+    return f"'{compute(field, literal[1:-1].replace(chr(39) * 2, chr(39)))}'"
+
+
+# Predicates a blind index can't answer: it only preserves equality
+_UNSUPPORTED_PREDICATE = re.compile(r"\s*(?:(?:NOT\s+)?(LIKE|GLOB|REGEXP|MATCH|BETWEEN)\b|(<=|>=|<|>))", re.IGNORECASE)
+_EQUALITY = re.compile(r"\s*(?:=|!=|<>|(?:NOT\s+)?IN\b)", re.IGNORECASE)
+_CALL_BEFORE = re.compile(r"\b(\w+)\s*\(\s*(?:DISTINCT\s+)?$", re.IGNORECASE)
+
+
+def rewrite_sql(sql, conn=None, columns=None):
+    """
+    Point filters and grouping on encrypted fields at their _bidx columns:
+    credit_card_type = 'Visa'            -> credit_card_type_bidx = '<hmac>'
+    email_encrypted IN ('a@x.com', ...)  -> email_bidx IN ('<hmac>', ...)
+    GROUP BY credit_card_type            -> GROUP BY credit_card_type_bidx
+    References to a grouped field (its SELECT item, ORDER BY) and COUNT(DISTINCT field)
+    follow. LIKE, ranges and functions of an encrypted field raise ValueError: on the
+    blind index they would silently match nothing.
+    Only fields whose _bidx column is in `columns` (when given) are rewritten.
+    Returns (sql, rewritten_fields).
+    """
+    if conn is not None:
+        check_key(conn)
+    rewritten = []
+    for field in INDEXED_FIELDS:
+        column = f"{field}_bidx"
+        if columns is not None and column not in columns:
+            continue
+        before = sql
+        # Case folding is already part of the blind index
+        sql = re.sub(rf"\b(?:LOWER|UPPER)\(\s*({field}(?:_encrypted)?)\s*\)", r"\1", sql, flags=re.IGNORECASE)
+        masked = mask(sql, mask_parens=False)
+        group_by = re.search(r"\bGROUP\s+BY\b(.*?)(?:\bHAVING\b|\bORDER\s+BY\b|\bLIMIT\b|$)", masked, re.IGNORECASE | re.DOTALL)
+        occurrences = [m.span() for m in re.finditer(rf"\b{field}(?:_encrypted)?\b", masked, re.IGNORECASE)]
+        grouped = bool(group_by) and any(group_by.start(1) <= start < group_by.end(1) for start, _ in occurrences)
+
+        spans = []
+        for start, end in occurrences:
+            following, preceding = masked[end:], masked[:start]
+            unsupported = _UNSUPPORTED_PREDICATE.match(following)
+            call = _CALL_BEFORE.search(preceding)
+            if unsupported or (call and call.group(1).upper() != "COUNT"):
+                what = (unsupported.group(1) or unsupported.group(2)).upper() if unsupported else f"{call.group(1).upper()}()"
+                raise ValueError(f"{field} is encrypted: queries can only compare it with =, <>, IN or group by it, "
+                                 f"not use {what}")
+            if _EQUALITY.match(following) or grouped or call:
+                spans.append((start, end))
+        for start, end in sorted(spans, reverse=True):
+            sql = sql[:start] + column + sql[end:]
+
+        def hash_comparison(match):
+            return match.group(1) + _hash_literal(field, match.group(2))
+
+        def hash_list(match):
+            values = re.sub(_LITERAL, lambda m: _hash_literal(field, m.group(0)), match.group(2))
+            return match.group(1) + values + ")"
+
+        sql = re.sub(rf"(\b{column}\s*(?:=|!=|<>)\s*)({_LITERAL})", hash_comparison, sql)
+        sql = re.sub(rf"(\b{column}\s+(?:NOT\s+)?IN\s*\()([^)]*)\)", hash_list, sql, flags=re.IGNORECASE)
+        if sql != before:
+            rewritten.append(field)
+    return sql, rewritten
+
+
+def label_results(conn, df):
+    """Replace blind index values of labelled fields by their plaintext labels and drop the _bidx suffix."""
+    columns = [c for c in df.columns if isinstance(c, str) and c.endswith("_bidx") and c[:-5] in LABELLED_FIELDS]
+    if not columns:
+        return df
+    try:
+        labels = dict(conn.execute(f"SELECT bidx, label FROM {LABELS_TABLE}").fetchall())
+    except Exception:
+        return df
+    df = df.copy()
+    for column in columns:
+        df[column] = df[column].map(lambda value: labels.get(value, value))
+    return df.rename(columns={c: c[:-5] for c in columns if c[:-5] not in df.columns})
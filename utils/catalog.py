@@ -0,0 +1,315 @@
+"""
+Catalog of the tables in a snapshot, and schema pruning for multi-table prompts.
+
+Besides customer_data, an import loads every CSV in data/tables/ as a table of
+its own (e.g. transactions.csv -> transactions). The catalog records each
+table's columns, row count, primary key, the values of low-cardinality text
+columns, and the foreign keys between tables. Foreign keys are taken from
+PRAGMA foreign_key_list, or inferred: a column such as customer_id that is
+unique in one table and appears in another. It is written to the snapshot at
+import and cached per database file version.
+
+With more than one table, prompts no longer carry every schema. select_schema()
+ranks tables and columns against the question with the same tokenizer as the
+example store, keeps at most MAX_PROMPT_TABLES tables and MAX_PROMPT_COLUMNS
+columns per table, adds the tables on the join path between them, and
+render_schema() writes their schemas with join hints. Prompt size stays
+bounded however many tables the dataset has.
+"""
+import json
+import os
+import re
+from collections import deque
+from dataclasses import dataclass, field
+
+from utils import sharding
+from utils.example_store import tokenize
+
+CATALOG_TABLE = "table_catalog"
+FOREIGN_KEY_TABLE = "table_foreign_keys"
+EXTRA_TABLES_DIR = "data/tables"
+MAIN_TABLE = "customer_data"
+MAX_PROMPT_TABLES = int(os.environ.get("MAX_PROMPT_TABLES", "4"))
+MAX_PROMPT_COLUMNS = int(os.environ.get("MAX_PROMPT_COLUMNS", "12"))
+# Text columns with at most this many distinct values have them listed in the catalog
+MAX_LISTED_VALUES = 20
+
+# Tables the app writes for itself; never shown to the LLM
+INTERNAL_TABLES = {"column_profile", "blind_index_labels", "blind_index_info", "sample_info", "shard_manifest",
+                   CATALOG_TABLE, FOREIGN_KEY_TABLE}
+
+
+@dataclass
+class TableInfo:
+    name: str
+    columns: list  # [(name, declared type)]
+    row_count: int
+    primary_key: list = field(default_factory=list)
+    values: dict = field(default_factory=dict)  # {column: [values]} for low-cardinality text columns
+
+
+@dataclass
+class ForeignKey:
+    table: str
+    column: str
+    ref_table: str
+    ref_column: str
+    source: str = "declared"  # declared or inferred
+
+    def hint(self):
+        return f"{self.table}.{self.column} = {self.ref_table}.{self.ref_column}"
+
+
+@dataclass
+class Catalog:
+    tables: dict  # {name: TableInfo}
+    foreign_keys: list
+
+    @property
+    def multi_table(self):
+        return len(self.tables) > 1
+
+    def neighbours(self, table):
+        for fk in self.foreign_keys:
+            if fk.table == table:
+                yield fk.ref_table, fk
+            elif fk.ref_table == table:
+                yield fk.table, fk
+
+    def join_path(self, start, goal):
+        """Foreign keys on the shortest join path from start to goal, or None when they are not connected."""
+        previous = {start: None}
+        queue = deque([start])
+        while queue:
+            table = queue.popleft()
+            if table == goal:
+                path = []
+                while previous[table] is not None:
+                    table, fk = previous[table]
+                    path.append(fk)
+                return path[::-1]
+            for neighbour, fk in self.neighbours(table):
+                if neighbour not in previous:
+                    previous[neighbour] = (table, fk)
+                    queue.append(neighbour)
+        return None
+
+
+@dataclass
+class SchemaSelection:
+    tables: list  # table names, most relevant first
+    columns: dict  # {table: [(name, type)]} kept for the prompt
+    hidden_columns: dict  # {table: number of columns left out}
+    joins: list  # ForeignKey
+    catalog: Catalog
+
+    def column_names(self):
+        return sorted({name for columns in self.columns.values() for name, _ in columns})
+
+
+def _user_tables(conn):
+    names = [row[0] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type IN ('table', 'view') AND name NOT LIKE 'sqlite_%'").fetchall()]
+    try:
+        samples = {row[0] for row in conn.execute("SELECT table_name FROM sample_info").fetchall()}
+    except Exception:
+        samples = set()
+    tables = [n for n in names if n not in INTERNAL_TABLES and n not in samples]
+    # Sharded snapshots expose customer_data as a TEMP view over the shards
+    if MAIN_TABLE not in tables and sharding.table_info(conn, MAIN_TABLE):
+        tables.insert(0, MAIN_TABLE)
+    return tables
+
+
+def _is_unique(conn, table, column):
+    count, distinct = conn.execute(f'SELECT COUNT("{column}"), COUNT(DISTINCT "{column}") FROM "{table}"').fetchone()
+    return count > 0 and count == distinct
+
+
+def build_catalog(conn):
+    """Catalog of the user tables reachable from conn (a sharding.connect() connection for sharded snapshots)."""
+    tables = {}
+    declared = []
+    for name in _user_tables(conn):
+        info = sharding.table_info(conn, name)
+        columns = [(row[1], row[2] or "TEXT") for row in info]
+        primary_key = [row[1] for row in sorted(info, key=lambda row: row[5]) if row[5]]
+        row_count = conn.execute(f'SELECT COUNT(*) FROM "{name}"').fetchone()[0]
+        values = {}
+        for column, declared_type in columns:
+            if declared_type.upper() == "TEXT" and not column.endswith(("_encrypted", "_bidx")):
+                distinct = [row[0] for row in conn.execute(
+                    f'SELECT DISTINCT "{column}" FROM "{name}" WHERE "{column}" IS NOT NULL LIMIT {MAX_LISTED_VALUES + 1}')]
+                if len(distinct) <= MAX_LISTED_VALUES:
+                    values[column] = sorted(str(v) for v in distinct)
+        tables[name] = TableInfo(name, columns, row_count, primary_key, values)
+        for row in conn.execute(f'PRAGMA foreign_key_list("{name}")').fetchall():
+            declared.append(ForeignKey(name, row[3], row[2], row[4] or row[3], "declared"))
+    return Catalog(tables, declared + _infer_foreign_keys(conn, tables, declared))
+
+
+def _infer_foreign_keys(conn, tables, declared):
+    """customer_id in transactions references customer_data when it is unique there."""
+    known = {(fk.table, fk.column) for fk in declared}
+    unique = {}
+
+    def is_unique(table, column):
+        if (table.name, column) not in unique:
+            unique[(table.name, column)] = column in table.primary_key or _is_unique(conn, table.name, column)
+        return unique[(table.name, column)]
+
+    inferred = []
+    for table in tables.values():
+        for column, _ in table.columns:
+            if (table.name, column) in known or not (column.endswith("_id") or column == "id"):
+                continue
+            for other in tables.values():
+                names = [c for c, _ in other.columns]
+                # customer_id matches customer_data.customer_id, and customers.id
+                if other.name == table.name:
+                    continue
+                if column in names:
+                    target = column
+                elif "id" in names and other.name.rstrip("s") == column[:-3]:
+                    target = "id"
+                else:
+                    continue
+                if not is_unique(other, target):
+                    continue
+                # Unique on both sides is one-to-one: keep a single direction
+                if is_unique(table, column) and (table.row_count, table.name) > (other.row_count, other.name):
+                    continue
+                inferred.append(ForeignKey(table.name, column, other.name, target, "inferred"))
+    return inferred
+
+
+def write_catalog(conn, catalog):
+    conn.execute(f"DROP TABLE IF EXISTS {CATALOG_TABLE}")
+    conn.execute(f"DROP TABLE IF EXISTS {FOREIGN_KEY_TABLE}")
+    conn.execute(f"CREATE TABLE {CATALOG_TABLE} (table_name TEXT PRIMARY KEY, row_count INTEGER, "
+                 "columns TEXT, primary_key TEXT, column_values TEXT)")
+    conn.execute(f"CREATE TABLE {FOREIGN_KEY_TABLE} (table_name TEXT, column_name TEXT, ref_table TEXT, "
+                 "ref_column TEXT, source TEXT)")
+    conn.executemany(f"INSERT INTO {CATALOG_TABLE} VALUES (?, ?, ?, ?, ?)",
+                     [(t.name, t.row_count, json.dumps(t.columns), json.dumps(t.primary_key), json.dumps(t.values))
+                      for t in catalog.tables.values()])
+    conn.executemany(f"INSERT INTO {FOREIGN_KEY_TABLE} VALUES (?, ?, ?, ?, ?)",
+                     [(fk.table, fk.column, fk.ref_table, fk.ref_column, fk.source) for fk in catalog.foreign_keys])
+    conn.commit()
+
+
+# Catalogs per (database file, modification time)
+_catalog_cache = {}
+
+
+def _database_path(conn):
+    rows = conn.execute("PRAGMA database_list").fetchall()
+    return next((row[2] for row in rows if row[1] == "main"), "")
+
+
+def load_catalog(conn):
+    """Catalog of the snapshot behind conn; built on the fly for snapshots imported without one."""
+    db_path = _database_path(conn)
+    mtime = os.path.getmtime(db_path) if db_path and os.path.exists(db_path) else None
+    cache_key = (db_path, mtime)
+    if db_path and cache_key in _catalog_cache:
+        return _catalog_cache[cache_key]
+    try:
+        tables = {row[0]: TableInfo(row[0], [tuple(c) for c in json.loads(row[2])], row[1], json.loads(row[3]),
+                                    json.loads(row[4] or "{}"))
+                  for row in conn.execute(f"SELECT table_name, row_count, columns, primary_key, column_values "
+                                          f"FROM {CATALOG_TABLE}").fetchall()}
+        foreign_keys = [ForeignKey(*row) for row in conn.execute(
+            f"SELECT table_name, column_name, ref_table, ref_column, source FROM {FOREIGN_KEY_TABLE}").fetchall()]
+        catalog = Catalog(tables, foreign_keys)
+    except Exception:
+        catalog = build_catalog(conn)
+    if db_path:
+        _catalog_cache[cache_key] = catalog
+    return catalog
+
+
+def _table_tokens(name):
+    return set(tokenize(name.replace("_data", "")))
+
+
+def select_schema(question, catalog, max_tables=MAX_PROMPT_TABLES, max_columns=MAX_PROMPT_COLUMNS):
+    """The tables and columns the question most likely needs, joined along foreign keys."""
+    words = set(tokenize(question))
+    text = question.lower()
+    # transactions.account_id is about accounts, not about transactions
+    references = {(fk.table, fk.column) for fk in catalog.foreign_keys}
+    table_scores = {}
+    column_hits = {}
+    for table in catalog.tables.values():
+        # A table named in the question counts more than any single column
+        score = 3.0 * len(words & _table_tokens(table.name))
+        hits = []
+        for column, _ in table.columns:
+            if (table.name, column) in references:
+                continue
+            column_words = set(tokenize(column)) - {"id"}
+            matched = len(words & column_words)
+            if any(re.search(rf"\b{re.escape(value.lower())}\b", text) for value in table.values.get(column, [])):
+                matched += 2  # "refund" names a value of transactions.type
+            if matched:
+                hits.append(column)
+                score += matched / max(len(column_words), 1)
+        table_scores[table.name] = score
+        column_hits[table.name] = hits
+
+    ranked = [name for name, score in sorted(table_scores.items(), key=lambda item: -item[1]) if score > 0]
+    if not ranked:
+        ranked = [MAIN_TABLE if MAIN_TABLE in catalog.tables else
+                  max(catalog.tables.values(), key=lambda t: t.row_count).name]
+    selected = ranked[:max_tables]
+
+    # Tables on the join path between the selected ones, e.g. accounts between customers and transactions
+    joins = []
+    for table in selected[1:]:
+        path = catalog.join_path(selected[0], table) or []
+        for fk in path:
+            if fk not in joins:
+                joins.append(fk)
+    tables = list(dict.fromkeys(selected + [t for fk in joins for t in (fk.table, fk.ref_table)]))
+
+    columns, hidden = {}, {}
+    for name in tables:
+        table = catalog.tables[name]
+        if len(table.columns) <= max_columns:
+            kept = table.columns
+        else:
+            keys = set(table.primary_key) | {fk.column for fk in joins if fk.table == name} \
+                | {fk.ref_column for fk in joins if fk.ref_table == name}
+            wanted = keys | set(column_hits[name])
+            kept = [c for c in table.columns if c[0] in wanted]
+            kept += [c for c in table.columns if c[0] not in wanted][:max(0, max_columns - len(kept))]
+            kept = [c for c in table.columns if c in kept]  # table order
+        columns[name] = kept
+        hidden[name] = len(table.columns) - len(kept)
+    return SchemaSelection(tables, columns, hidden, joins, catalog)
+
+
+def render_schema(selection, details=None):
+    """
+    Schema section for the selected tables with their join hints.
+    `details` maps a table name to extra text (e.g. the profiled column details of customer_data).
+    """
+    lines = [f"You are working with a SQLite database. The {len(selection.tables)} tables most relevant to "
+             f"this question are shown ({len(selection.catalog.tables)} in total)."]
+    for name in selection.tables:
+        table = selection.catalog.tables[name]
+        lines.append(f"\nTable name: {name} ({table.row_count:,} rows)")
+        for column, declared_type in selection.columns[name]:
+            # Profiled tables list their values in the details already
+            listed = None if details and details.get(name) else table.values.get(column)
+            suffix = f" (values: {', '.join(listed)})" if listed else ""
+            lines.append(f"{column}: {declared_type}{suffix}")
+        if selection.hidden_columns[name]:
+            lines.append(f"... {selection.hidden_columns[name]} more columns not relevant to this question")
+        if details and details.get(name):
+            lines.append(details[name].rstrip())
+    if selection.joins:
+        lines.append("\nJoin on:")
+        lines += [f"- {fk.hint()}" for fk in selection.joins]
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,241 @@
+"""
+Column profile of customer_data, computed once at import.
+
+The import profiles the stored table with SQL, so it never holds the whole
+table in memory: one scan for the null and distinct counts, min/max/mean of
+every column, then a GROUP BY per column for its most common values and, for
+numeric columns, its histogram. The profile is written to the column_profile
+table of the snapshot, so it always describes the data that was actually
+loaded.
+
+The pipeline builds the column details of its prompts from the profile and
+answers questions such as "what values does country take" or "what is the
+range of age" from it without scanning customer_data.
+"""
+import json
+import os
+from dataclasses import dataclass, field
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+from utils import sharding
+
+SOURCE_TABLE = "customer_data"
+PROFILE_TABLE = "column_profile"
+HISTOGRAM_BINS = 10
+TOP_VALUES = 10
+# Columns with at most this many distinct values are listed in full
+CATEGORICAL_MAX_DISTINCT = 20
+NUMERIC_TYPES = ("INTEGER", "REAL", "FLOAT", "NUMERIC")
+
+
+@dataclass
+class ColumnProfile:
+    name: str
+    declared_type: str
+    kind: str  # numeric, binary, categorical, text, datetime, encrypted or blind_index
+    row_count: int
+    null_count: int
+    distinct_count: int
+    min_value: Optional[str] = None
+    max_value: Optional[str] = None
+    mean: Optional[float] = None
+    top_values: list = field(default_factory=list)  # [(value, count)], most common first
+    histogram: Optional[dict] = None  # {"edges": [...], "counts": [...]}
+
+
+def _plain(value):
+    """JSON- and SQLite-friendly scalar."""
+    if isinstance(value, (np.integer, np.bool_)):
+        return int(value)
+    if isinstance(value, np.floating):
+        return float(value)
+    if isinstance(value, (pd.Timestamp, np.datetime64)):
+        return str(pd.Timestamp(value))
+    return value
+
+
+def _top(conn, column, labels=None, as_text=False):
+    rows = conn.execute(f'SELECT "{column}", COUNT(*) FROM {SOURCE_TABLE} WHERE "{column}" IS NOT NULL '
+                        f'GROUP BY "{column}" ORDER BY COUNT(*) DESC LIMIT {TOP_VALUES}').fetchall()
+    return [((labels or {}).get(value, str(value) if as_text else value), count) for value, count in rows]
+
+
+def _histogram(conn, column, low, high):
+    """Counts of HISTOGRAM_BINS equal-width bins over [low, high], with numpy's edges."""
+    edges = np.histogram_bin_edges([low, high], bins=HISTOGRAM_BINS)
+    width = (edges[-1] - edges[0]) / HISTOGRAM_BINS
+    # The last bin is closed, as in np.histogram
+    rows = conn.execute(f'SELECT MIN(CAST(("{column}" - ?) / ? AS INTEGER), {HISTOGRAM_BINS - 1}), COUNT(*) '
+                        f'FROM {SOURCE_TABLE} WHERE "{column}" IS NOT NULL GROUP BY 1',
+                        (float(edges[0]), float(width))).fetchall()
+    counts = [0] * HISTOGRAM_BINS
+    for bin_index, count in rows:
+        counts[bin_index] += count
+    return {"edges": [float(e) for e in edges], "counts": counts}
+
+
+def _aggregates(name, declared):
+    quoted = f'"{name}"'
+    mean = f"AVG({quoted})" if declared in NUMERIC_TYPES else "NULL"
+    return f"COUNT({quoted}), COUNT(DISTINCT {quoted}), MIN({quoted}), MAX({quoted}), {mean}"
+
+
+def profile_table(conn, labels=None):
+    """
+    Profiles of every column of customer_data. `labels` is {field: {bidx: label}} for
+    the blind-indexed fields whose plaintext labels may be shown; their profile is
+    stored under the field name.
+    """
+    columns = [(row[1], (row[2] or "TEXT").upper()) for row in sharding.table_info(conn, SOURCE_TABLE)]
+    aggregates = ", ".join(_aggregates(name, declared) for name, declared in columns)
+    stats = conn.execute(f"SELECT COUNT(*), {aggregates} FROM {SOURCE_TABLE}").fetchone()
+    row_count = stats[0]
+
+    profiles = []
+    for position, (name, declared) in enumerate(columns):
+        non_null, distinct, low, high, mean = stats[1 + 5 * position:6 + 5 * position]
+        profile = ColumnProfile(name=name, declared_type=declared, kind="text", row_count=row_count,
+                                null_count=row_count - non_null, distinct_count=distinct)
+        field_labels = (labels or {}).get(name[:-len("_bidx")]) if name.endswith("_bidx") else None
+        if name.endswith("_encrypted"):
+            profile.kind = "encrypted"
+        elif name.endswith("_bidx"):
+            profile.kind = "blind_index"
+            if field_labels:
+                profile.name, profile.declared_type, profile.kind = name[:-len("_bidx")], "TEXT", "categorical"
+                profile.top_values = _top(conn, name, field_labels)
+        elif declared in ("TIMESTAMP", "DATETIME", "DATE"):
+            profile.kind = "datetime"
+            if non_null:
+                profile.min_value, profile.max_value = str(low), str(high)
+        elif declared in NUMERIC_TYPES:
+            profile.kind = "binary" if distinct <= 2 and {low, high} <= {0, 1} else "numeric"
+            if non_null:
+                profile.min_value, profile.max_value, profile.mean = low, high, float(mean)
+                profile.histogram = _histogram(conn, name, low, high)
+            if distinct <= CATEGORICAL_MAX_DISTINCT:
+                profile.top_values = _top(conn, name)
+        else:
+            if distinct <= CATEGORICAL_MAX_DISTINCT:
+                profile.kind = "categorical"
+            profile.top_values = _top(conn, name, as_text=True)
+            if non_null:
+                profile.min_value, profile.max_value = str(low), str(high)
+        profiles.append(profile)
+    return profiles
+
+
+def write_profile(conn, profiles):
+    conn.execute(f"DROP TABLE IF EXISTS {PROFILE_TABLE}")
+    conn.execute(f"""CREATE TABLE {PROFILE_TABLE} (
+        column_name TEXT PRIMARY KEY, position INTEGER, declared_type TEXT, kind TEXT,
+        row_count INTEGER, null_count INTEGER, distinct_count INTEGER,
+        min_value TEXT, max_value TEXT, mean REAL, top_values TEXT, histogram TEXT)""")
+    conn.executemany(
+        f"INSERT INTO {PROFILE_TABLE} VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        [(p.name, position, p.declared_type, p.kind, p.row_count, p.null_count, p.distinct_count,
+          None if p.min_value is None else str(p.min_value), None if p.max_value is None else str(p.max_value),
+          p.mean, json.dumps(p.top_values), json.dumps(p.histogram) if p.histogram else None)
+         for position, p in enumerate(profiles)])
+    conn.commit()
+
+
+def build_profile(conn, labels=None):
+    """Profile the imported customer_data table and store it in the snapshot."""
+    label_map = {}
+    for field_name, bidx, label in labels or ():
+        label_map.setdefault(field_name, {})[bidx] = label
+    write_profile(conn, profile_table(conn, label_map))
+
+
+# Profiles per (database file, modification time)
+_profile_cache = {}
+
+
+def _database_path(conn):
+    rows = conn.execute("PRAGMA database_list").fetchall()
+    return next((row[2] for row in rows if row[1] == "main"), "")
+
+
+def load_profile(conn):
+    """{column name: ColumnProfile} in table order, or None for snapshots imported without a profile."""
+    db_path = _database_path(conn)
+    mtime = os.path.getmtime(db_path) if db_path and os.path.exists(db_path) else None
+    cache_key = (db_path, mtime)
+    if db_path and cache_key in _profile_cache:
+        return _profile_cache[cache_key]
+    try:
+        rows = conn.execute(
+            f"SELECT column_name, declared_type, kind, row_count, null_count, distinct_count, "
+            f"min_value, max_value, mean, top_values, histogram FROM {PROFILE_TABLE} ORDER BY position").fetchall()
+    except Exception:
+        return None
+    profile = {}
+    for row in rows:
+        profile[row[0]] = ColumnProfile(
+            name=row[0], declared_type=row[1], kind=row[2], row_count=row[3], null_count=row[4],
+            distinct_count=row[5], min_value=row[6], max_value=row[7], mean=row[8],
+            top_values=[tuple(v) for v in json.loads(row[9] or "[]")],
+            histogram=json.loads(row[10]) if row[10] else None)
+    if db_path:
+        _profile_cache[cache_key] = profile
+    return profile
+
+
+def _number(value):
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return str(value)
+    return f"{int(number):,}" if number.is_integer() else f"{number:,.2f}"
+
+
+def _listing(profile, limit=TOP_VALUES):
+    return ", ".join(f"{value} ({count / max(profile.row_count, 1):.1%})" for value, count in profile.top_values[:limit])
+
+
+def summarize(profile):
+    """One-line summary of a column profile for prompts and answers."""
+    if profile.kind == "encrypted":
+        text = f"encrypted, {profile.distinct_count:,} distinct values"
+    elif profile.kind == "blind_index":
+        text = "blind index of an encrypted field"
+    elif profile.kind == "binary":
+        ones = dict((str(_plain(v)), c) for v, c in profile.top_values).get("1", 0)
+        text = f"binary 0/1, {ones / max(profile.row_count, 1):.1%} are 1"
+    elif profile.kind == "numeric":
+        text = (f"numeric {profile.declared_type}, {_number(profile.min_value)} to {_number(profile.max_value)}, "
+                f"mean {_number(profile.mean)}, {profile.distinct_count:,} distinct values")
+    elif profile.kind == "datetime":
+        text = f"dates from {profile.min_value} to {profile.max_value}"
+    elif profile.kind == "categorical":
+        text = f"categorical, {profile.distinct_count} values: {_listing(profile)}"
+    else:
+        text = f"text, {profile.distinct_count:,} distinct values"
+    if profile.null_count:
+        text += f", {profile.null_count:,} missing"
+    return text
+
+
+def column_details(profile, descriptions, only=None):
+    """
+    Column Details prompt section from the profile and the semantic descriptions.
+    `only` limits it to those stored columns (a pruned multi-table schema).
+    """
+    names = list(descriptions) + [name for name, p in profile.items()
+                                  if name not in descriptions and p.kind not in ("encrypted", "blind_index")
+                                  and not name.endswith("_encrypted")]
+    if only is not None:
+        names = [name for name in names if name in only or f"{name}_encrypted" in only]
+    lines = []
+    for name in names:
+        column = profile.get(name) or profile.get(f"{name}_encrypted")
+        if column is None:
+            continue  # described, but not in this dataset
+        description = descriptions.get(name, "")
+        lines.append(f"- {name}: {description} Profile: {summarize(column)}.".replace(":  ", ": "))
+    row_count = next(iter(profile.values())).row_count if profile else 0
+    return f"\nColumn Details ({row_count:,} rows):\n" + "\n".join(lines)
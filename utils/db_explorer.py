@@ -0,0 +1,185 @@
+"""
+Paginated browsing of customer_data.
+
+Pages are read with keyset pagination on customer_id (WHERE customer_id > ?
+ORDER BY customer_id LIMIT n), which uses the customer_id index and costs
+the same on the first page and the millionth, unlike OFFSET. The selected
+columns and the filters are pushed down into the SQL. On sharded snapshots
+every shard returns its next n rows and the pages are merged.
+
+Pages are cached per snapshot in an LRU cache, and the next page is
+prefetched in the background while the current one is displayed.
+"""
+import heapq
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from utils import blind_index, sharding, snapshots
+from utils.db_pool import get_pool, retire_stale_pools
+
+TABLE_NAME = "customer_data"
+KEY_COLUMN = "customer_id"
+DEFAULT_PAGE_SIZE = 100
+CACHE_PAGES = 64
+FILTER_OPERATORS = ["=", "!=", "<", "<=", ">", ">=", "LIKE", "IN"]
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+_prefetching = {}
+_prefetch_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="explorer-prefetch")
+
+
+def _sources(db_path):
+    """Database files holding customer_data rows: the snapshot, or its shards."""
+    manifest = sharding.load_manifest(db_path)
+    return [s.path for s in manifest.shards] if manifest else [db_path]
+
+
+def table_columns(db_path):
+    """[(name, declared type)] of customer_data."""
+    retire_stale_pools(db_path)
+    with get_pool(db_path).connection() as conn:
+        return [(row[1], row[2]) for row in sharding.table_info(conn, TABLE_NAME)]
+
+
+def _coerce(value, declared_type):
+    value = str(value).strip()
+    if declared_type.upper() in ("INTEGER", "REAL", "FLOAT", "NUMERIC"):
+        number = float(value)
+        return int(number) if number.is_integer() and declared_type.upper() == "INTEGER" else number
+    return value
+
+
+def build_where(filters, column_types):
+    """
+    WHERE clause and parameters for [(column, operator, value)] filters.
+    Columns and operators are whitelisted and values are bound as parameters.
+    Equality on an encrypted field goes through its blind index.
+    """
+    clauses, params = [], []
+    for column, operator, value in filters:
+        if operator not in FILTER_OPERATORS:
+            raise ValueError(f"Unsupported operator {operator!r}")
+        if column in blind_index.INDEXED_FIELDS and f"{column}_bidx" in column_types:
+            if operator not in ("=", "!=", "IN"):
+                raise ValueError(f"{column} is encrypted; only =, != and IN are supported")
+            values = [blind_index.compute(column, v) for v in str(value).split(",")] if operator == "IN" \
+                else [blind_index.compute(column, value)]
+            column = f"{column}_bidx"
+        elif column in column_types:
+            declared = column_types[column]
+            values = [_coerce(v, declared) for v in str(value).split(",")] if operator == "IN" \
+                else [value if operator == "LIKE" else _coerce(value, declared)]
+        else:
+            raise ValueError(f"Unknown column {column!r}")
+        if operator == "IN":
+            clauses.append(f'"{column}" IN ({", ".join("?" * len(values))})')
+        else:
+            clauses.append(f'"{column}" {operator} ?')
+        params.extend(values)
+    return clauses, params
+
+
+def _query_source(path, columns, where, params, after_key, page_size):
+    clauses = list(where)
+    query_params = list(params)
+    if after_key is not None:
+        clauses.append(f'"{KEY_COLUMN}" > ?')
+        query_params.append(after_key)
+    projection = ", ".join(f'"{c}"' for c in columns)
+    sql = f"SELECT {projection} FROM {TABLE_NAME}"
+    if clauses:
+        sql += " WHERE " + " AND ".join(clauses)
+    sql += f' ORDER BY "{KEY_COLUMN}" LIMIT ?'
+    with get_pool(path).connection() as conn:
+        rows = conn.execute(sql, query_params + [page_size]).fetchall()
+    return rows
+
+
+def _fetch(db_path, columns, filters, after_key, page_size):
+    column_types = dict(table_columns(db_path))
+    for column in columns:
+        if column not in column_types:
+            raise ValueError(f"Unknown column {column!r}")
+    # The key column is always read so the next page can start after it
+    read_columns = [KEY_COLUMN] + [c for c in columns if c != KEY_COLUMN]
+    where, params = build_where(filters, column_types)
+
+    results = [_query_source(path, read_columns, where, params, after_key, page_size)
+               for path in _sources(db_path)]
+    rows = list(heapq.merge(*results, key=lambda row: row[0]))[:page_size]
+    page = pd.DataFrame(rows, columns=read_columns)
+    next_key = rows[-1][0] if len(rows) == page_size else None
+    return (page[columns] if columns else page), next_key
+
+
+def _cache_key(db_path, columns, filters, after_key, page_size):
+    return (db_path, snapshots.version_of(db_path), tuple(columns), tuple(map(tuple, filters)), after_key, page_size)
+
+
+def _cached(key):
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+    return None
+
+
+def _store(key, value):
+    with _cache_lock:
+        _cache[key] = value
+        _cache.move_to_end(key)
+        while len(_cache) > CACHE_PAGES:
+            _cache.popitem(last=False)
+
+
+def _prefetch(db_path, columns, filters, after_key, page_size):
+    key = _cache_key(db_path, columns, filters, after_key, page_size)
+    with _cache_lock:
+        if key in _cache or key in _prefetching:
+            return
+
+        def run():
+            try:
+                _store(key, _fetch(db_path, columns, filters, after_key, page_size))
+            except Exception as e:
+                print(f"explorer prefetch failed: {e}")
+            finally:
+                with _cache_lock:
+                    _prefetching.pop(key, None)
+
+        _prefetching[key] = _prefetch_pool.submit(run)
+
+
+def get_page(columns, filters=(), after_key=None, page_size=DEFAULT_PAGE_SIZE, db_path=None, prefetch=True):
+    """
+    One page of customer_data after `after_key` (None for the first page).
+    Returns (page DataFrame, next_key or None on the last page, stats dict).
+    """
+    db_path = db_path or snapshots.current_db_path()
+    if db_path is None:
+        raise FileNotFoundError("No dataset has been imported yet")
+    retire_stale_pools(db_path)
+    columns, filters = list(columns), [tuple(f) for f in filters]
+    key = _cache_key(db_path, columns, filters, after_key, page_size)
+
+    started = time.perf_counter()
+    result = _cached(key)
+    source = "cache"
+    if result is None:
+        pending = _prefetching.get(key)
+        if pending is not None:
+            pending.result()
+            result, source = _cached(key), "prefetch"
+        if result is None:
+            result, source = _fetch(db_path, columns, filters, after_key, page_size), "database"
+            _store(key, result)
+    page, next_key = result
+
+    if prefetch and next_key is not None:
+        _prefetch(db_path, columns, filters, next_key, page_size)
+    return page, next_key, {"source": source, "ms": round((time.perf_counter() - started) * 1000, 1)}
@@ -0,0 +1,128 @@
+import queue
+import threading
+from utils import sharding, snapshots
+from contextlib import contextmanager
+
+DEFAULT_POOL_SIZE = 8
+
+
+class SQLiteConnectionPool:
+    """
+    Fixed-size pool of SQLite connections to one database file.
+
+    Connections are opened with check_same_thread=False so any worker thread can
+    borrow one; a connection is only ever used by one thread at a time.
+    """
+
+    def __init__(self, db_path, size=DEFAULT_POOL_SIZE, read_only=True):
+        self.db_path = db_path
+        self.size = size
+        self.read_only = read_only
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._opened = 0
+        self.retired = False
+        self.borrowed = 0
+        self.waited = 0
+
+    def _connect(self):
+        # Sharded snapshots get their shards attached behind a customer_data view
+        return sharding.connect(self.db_path, read_only=self.read_only, check_same_thread=False)
+
+    def acquire(self, timeout=30):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._opened < self.size:
+                self._opened += 1
+                return self._connect()
+            self.waited += 1
+        return self._idle.get(timeout=timeout)
+
+    def release(self, conn):
+        if self.retired:
+            conn.close()
+        else:
+            self._idle.put(conn)
+
+    @contextmanager
+    def connection(self, timeout=30):
+        conn = self.acquire(timeout)
+        self.borrowed += 1
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        # Connections still borrowed are closed when they are released
+        self.retired = True
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+    def metrics(self):
+        return {
+            "db_path": self.db_path,
+            "size": self.size,
+            "opened": self._opened,
+            "idle": self._idle.qsize(),
+            "borrowed": self.borrowed,
+            "waited": self.waited,
+            "retired": self.retired,
+        }
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+# Snapshot the pools were last retired for
+_retired_for = None
+_retired_for_lock = threading.Lock()
+
+
+def get_pool(db_path, size=DEFAULT_POOL_SIZE):
+    """Process-wide pool per database file."""
+    with _pools_lock:
+        pool = _pools.get(db_path)
+        if pool is None or pool.retired:
+            pool = _pools[db_path] = SQLiteConnectionPool(db_path, size=size)
+        return pool
+
+
+def pool_metrics(db_path):
+    """Metrics of the pool for `db_path`, or None when none is open (does not create one)."""
+    with _pools_lock:
+        pool = _pools.get(db_path)
+    return pool.metrics() if pool is not None else None
+
+
+def retire_pools(keep=None):
+    """
+    Close the pools of every database except `keep` (a path or a list of paths, e.g. a
+    snapshot and its shards), e.g. after a new snapshot is published.
+    """
+    keep = {keep} if isinstance(keep, str) else set(keep or ())
+    with _pools_lock:
+        for path in [p for p in _pools if p not in keep]:
+            _pools.pop(path).close()
+
+
+def retire_stale_pools(db_path):
+    """
+    Once CURRENT points at `db_path`, close the pools of older snapshots and their shards
+    (they may hold connections to files already deleted). Only the first call after
+    CURRENT changes retires anything.
+    """
+    global _retired_for
+    if db_path != snapshots.current_db_path():
+        return
+    with _retired_for_lock:
+        if _retired_for == db_path:
+            return
+        _retired_for = db_path
+    manifest = sharding.load_manifest(db_path)
+    retire_pools(keep=[db_path] + [s.path for s in manifest.shards] if manifest else [db_path])
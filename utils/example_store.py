@@ -0,0 +1,346 @@
+"""
+Few-shot examples for SQL generation, retrieved from past question/SQL pairs.
+
+Pairs come from two JSONL files:
+- data/sql_examples.jsonl: curated pairs shipped with the app
+- db/sql_examples.jsonl: pairs learned at run time, when the user accepts an
+  answer (or, with EXAMPLE_STORE_LEARN=1, whenever generated SQL validated
+  without an LLM repair and returned rows). Only the latest
+  EXAMPLE_STORE_MAX_LEARNED pairs are kept.
+
+search() ranks the pairs against a question with BM25 over the words of the
+question and the identifiers of the SQL; the few most similar are added to
+the SQL generation prompt. Everything runs locally: the index is kept in
+db/sql_examples.index.json. Learned pairs are added to it in place and it is
+saved in the background; it is only rebuilt when a file changes otherwise.
+
+    python -m utils.example_store "average balance by country"   # show matches
+    python -m utils.example_store --import-query-log              # learn from db/query_log.jsonl
+"""
+import argparse
+import json
+import math
+import os
+import re
+import threading
+import time
+from collections import Counter
+
+from utils.query_log import fingerprint, QUERY_LOG_PATH
+
+CURATED_PATH = "data/sql_examples.jsonl"
+LEARNED_PATH = "db/sql_examples.jsonl"
+INDEX_PATH = "db/sql_examples.index.json"
+EXAMPLE_STORE = os.environ.get("EXAMPLE_STORE", "1") == "1"
+# Learn every validated pair automatically instead of only answers the user accepted.
+# Off by default: a wrong answer that returned rows would be taught back to the model.
+LEARN_EXAMPLES = os.environ.get("EXAMPLE_STORE_LEARN", "0") == "1"
+MAX_LEARNED = int(os.environ.get("EXAMPLE_STORE_MAX_LEARNED", "500"))
+# The learned file is trimmed back to MAX_LEARNED once it is this much larger
+COMPACT_SLACK = max(MAX_LEARNED // 4, 1)
+INDEX_SAVE_DELAY_SECONDS = 5.0
+TOP_K = int(os.environ.get("EXAMPLE_STORE_TOP_K", "3"))
+# Matches below this BM25 score share little more than a stop word with the question
+MIN_SCORE = float(os.environ.get("EXAMPLE_STORE_MIN_SCORE", "1.0"))
+BM25_K1 = 1.2
+BM25_B = 0.75
+# SQL identifiers describe what a pair is about, but less precisely than the question
+SQL_TOKEN_WEIGHT = 0.5
+
+STOP_WORDS = {
+    "a", "an", "the", "of", "in", "on", "for", "to", "and", "or", "is", "are", "was", "were", "be", "by",
+    "what", "which", "who", "how", "me", "show", "give", "list", "tell", "do", "does", "with", "from",
+    "there", "their", "that", "this", "those", "these", "it", "its", "all", "each", "per", "as", "at",
+    "select", "where", "group", "order", "having", "limit", "desc", "asc", "customer_data",
+}
+_WORD = re.compile(r"[a-z][a-z0-9_]*|\d+")
+_SQL_LITERAL = re.compile(r"'(?:[^']|'')*'")
+
+_lock = threading.Lock()
+_index = None
+_index_key = None
+# (question tokens, SQL fingerprint) of every indexed pair, for duplicate checks
+_index_pairs = set()
+_save_timer = None
+
+
+def tokenize(text):
+    """Lower-case words with stop words removed; snake_case names also yield their parts."""
+    tokens = []
+    for word in _WORD.findall((text or "").lower()):
+        if word in STOP_WORDS:
+            continue
+        parts = [word] + ([p for p in word.split("_") if p] if "_" in word else [])
+        for part in parts:
+            if part in STOP_WORDS:
+                continue
+            # Crude plural folding: "customers" and "customer" match
+            tokens.append(part[:-1] if len(part) > 3 and part.endswith("s") and not part.endswith("ss") else part)
+    return tokens
+
+
+def _document(example):
+    """Weighted term counts of a pair: question words count fully, SQL identifiers half."""
+    terms = Counter(tokenize(example["question"]))
+    for token in tokenize(_SQL_LITERAL.sub(" ", example["sql"])):
+        terms[token] += SQL_TOKEN_WEIGHT
+    return terms
+
+
+def _read(path):
+    examples = []
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if entry.get("question") and entry.get("sql"):
+                    examples.append(entry)
+    return examples
+
+
+def _sources_key():
+    return tuple((path, os.path.getmtime(path) if os.path.exists(path) else None)
+                 for path in (CURATED_PATH, LEARNED_PATH))
+
+
+def _pair_key(question, sql):
+    return " ".join(tokenize(question)), fingerprint(sql)
+
+
+def build_index():
+    """BM25 statistics over all pairs, deduplicated by question and SQL fingerprint."""
+    examples, seen = [], set()
+    learned = 0
+    for path in (CURATED_PATH, LEARNED_PATH):
+        for example in _read(path):
+            learned += path == LEARNED_PATH
+            key = _pair_key(example["question"], example["sql"])
+            if key not in seen:
+                seen.add(key)
+                examples.append(example)
+    documents = [_document(example) for example in examples]
+    document_frequency = Counter(term for terms in documents for term in terms)
+    lengths = [sum(terms.values()) for terms in documents]
+    return {
+        "sources": [list(source) for source in _sources_key()],
+        "examples": examples,
+        "documents": [dict(terms) for terms in documents],
+        "lengths": lengths,
+        "average_length": sum(lengths) / len(lengths) if lengths else 0.0,
+        "document_frequency": dict(document_frequency),
+        "learned_lines": learned,
+    }
+
+
+def _add_to_index(index, example):
+    """Add one pair to the BM25 statistics, in an order that keeps concurrent searches consistent."""
+    terms = _document(example)
+    for term in terms:
+        index["document_frequency"][term] = index["document_frequency"].get(term, 0) + 1
+    index["documents"].append(dict(terms))
+    index["lengths"].append(sum(terms.values()))
+    index["average_length"] = sum(index["lengths"]) / len(index["lengths"])
+    # Last: search() zips the lists, so the pair is only seen once it is complete
+    index["examples"].append(example)
+
+
+def _save_index():
+    global _save_timer
+    with _lock:
+        _save_timer = None
+        data = json.dumps(_index) if _index is not None else None
+    if data is None:
+        return
+    try:
+        os.makedirs(os.path.dirname(INDEX_PATH), exist_ok=True)
+        tmp_path = f"{INDEX_PATH}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(data)
+        os.replace(tmp_path, INDEX_PATH)
+    except OSError as e:
+        print(f"could not write the example index: {e}")
+
+
+def _schedule_save():
+    """Save the index a few seconds from now, once for a burst of learned pairs. Call with _lock held."""
+    global _save_timer
+    if _save_timer is None:
+        _save_timer = threading.Timer(INDEX_SAVE_DELAY_SECONDS, _save_index)
+        _save_timer.daemon = True
+        _save_timer.start()
+
+
+def load_index():
+    """The index for the current example files, from memory, from disk or rebuilt."""
+    global _index, _index_key, _index_pairs
+    key = [list(source) for source in _sources_key()]
+    with _lock:
+        if _index is not None and _index_key == key:
+            return _index
+        index = None
+        if os.path.exists(INDEX_PATH):
+            try:
+                with open(INDEX_PATH, "r", encoding="utf-8") as f:
+                    index = json.load(f)
+            except (OSError, ValueError):
+                index = None
+        if index is None or index.get("sources") != key or "learned_lines" not in index:
+            index = build_index()
+            try:
+                os.makedirs(os.path.dirname(INDEX_PATH), exist_ok=True)
+                with open(INDEX_PATH, "w", encoding="utf-8") as f:
+                    json.dump(index, f)
+            except OSError as e:
+                print(f"could not write the example index: {e}")
+        _index, _index_key = index, key
+        _index_pairs = {_pair_key(e["question"], e["sql"]) for e in index["examples"]}
+        return index
+
+
+def _columns_of(sql, column_names):
+    words = set(re.findall(r"[A-Za-z_][A-Za-z0-9_]*", _SQL_LITERAL.sub(" ", sql)))
+    return sorted(name for name in column_names if name in words)
+
+
+def search(question, column_names=None, k=TOP_K, min_score=MIN_SCORE):
+    """
+    The k pairs most similar to the question, best first, as (score, example).
+    With column_names, pairs that use columns missing from the table are skipped.
+    """
+    index = load_index()
+    if not index["examples"]:
+        return []
+    query = set(tokenize(question))
+    total = len(index["examples"])
+    average_length = index["average_length"] or 1.0
+    available = set(column_names) if column_names is not None else None
+
+    scored = []
+    for example, terms, length in zip(index["examples"], index["documents"], index["lengths"]):
+        score = 0.0
+        for term in query:
+            frequency = terms.get(term)
+            if not frequency:
+                continue
+            df = index["document_frequency"][term]
+            idf = math.log(1 + (total - df + 0.5) / (df + 0.5))
+            score += idf * frequency * (BM25_K1 + 1) / (
+                frequency + BM25_K1 * (1 - BM25_B + BM25_B * length / average_length))
+        if score < min_score:
+            continue
+        if available is not None and not set(example.get("columns") or []) <= available:
+            continue
+        scored.append((score, example))
+    scored.sort(key=lambda item: item[0], reverse=True)
+
+    results, fingerprints = [], set()
+    for score, example in scored:
+        # Two phrasings of the same SQL teach the model nothing new
+        fp = fingerprint(example["sql"])
+        if fp in fingerprints:
+            continue
+        fingerprints.add(fp)
+        results.append((score, example))
+        if len(results) == k:
+            break
+    return results
+
+
+def format_examples(matches):
+    return [f'Q: "{example["question"]}"\nSQL: {example["sql"]}' for _, example in matches]
+
+
+def add_example(question, sql, column_names, source="validated"):
+    """
+    Store a question/SQL pair that validated and returned rows, and add it to the index in
+    place. Returns False for duplicates.
+    """
+    global _index_key
+    key = _pair_key(question, sql)
+    index = load_index()
+    entry = {"ts": time.time(), "question": question, "sql": sql.strip(), "source": source,
+             "columns": _columns_of(sql, column_names)}
+    with _lock:
+        if key in _index_pairs:
+            return False
+        current = _index is index and _index_key == [list(source) for source in _sources_key()]
+        try:
+            os.makedirs(os.path.dirname(LEARNED_PATH), exist_ok=True)
+            with open(LEARNED_PATH, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry) + "\n")
+        except OSError as e:
+            print(f"could not store the example: {e}")
+            return False
+        if current:
+            # No rebuild: the file only changed by the line just added
+            _add_to_index(index, entry)
+            _index_pairs.add(key)
+            index["learned_lines"] = index.get("learned_lines", 0) + 1
+            index["sources"] = _index_key = [list(source) for source in _sources_key()]
+            _schedule_save()
+        compact = index.get("learned_lines", 0) > MAX_LEARNED + COMPACT_SLACK
+    if compact:
+        _compact_learned()
+    return True
+
+
+def _compact_learned():
+    """Keep only the latest MAX_LEARNED learned pairs; the index is rebuilt on the next load."""
+    with _lock:
+        lines = []
+        if os.path.exists(LEARNED_PATH):
+            with open(LEARNED_PATH, "r", encoding="utf-8") as f:
+                lines = f.readlines()
+        if len(lines) <= MAX_LEARNED:
+            return
+        tmp_path = f"{LEARNED_PATH}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.writelines(lines[-MAX_LEARNED:])
+            os.replace(tmp_path, LEARNED_PATH)
+        except OSError as e:
+            print(f"could not trim the learned examples: {e}")
+            return
+    print(f"kept the latest {MAX_LEARNED} of {len(lines)} learned examples")
+    # Rebuild off the question path
+    threading.Thread(target=load_index, name="example-index", daemon=True).start()
+
+
+def import_query_log(column_names, log_path=QUERY_LOG_PATH):
+    """Learn pairs from the query log: queries that ran without error and returned rows."""
+    added = 0
+    if not os.path.exists(log_path):
+        return added
+    with open(log_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if entry.get("question") and not entry.get("error") and entry.get("rows") \
+                    and entry.get("mode") != "approximate" and "_bidx" not in entry["sql"]:
+                added += add_example(entry["question"], entry["sql"], column_names, source="query_log")
+    return added
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Search or fill the few-shot example store")
+    parser.add_argument("question", nargs="?")
+    parser.add_argument("--import-query-log", action="store_true", help="Learn pairs from the query log")
+    parser.add_argument("-k", type=int, default=TOP_K)
+    args = parser.parse_args()
+    if args.import_query_log:
+        from utils import snapshots, sharding
+        db_path = snapshots.current_db_path()
+        if not db_path:
+            raise SystemExit("Import a dataset first: examples are checked against its columns.")
+        conn = sharding.connect(db_path, read_only=True)
+        names = [row[1] for row in sharding.table_info(conn)]
+        conn.close()
+        print(f"added {import_query_log(names)} examples from {QUERY_LOG_PATH}")
+    if args.question:
+        for score, example in search(args.question, k=args.k):
+            print(f"{score:6.2f}  {example['question']}\n        {example['sql']}")
@@ -0,0 +1,245 @@
+"""
+Streaming export of customer_data to CSV, gzip/zstd CSV or Parquet.
+
+Rows are read from SQLite in chunks of EXPORT_CHUNK_ROWS and appended to a
+temporary file, so memory use depends on the chunk size and not on the table
+size. With decrypt=True the chunks are decrypted on a thread pool while the
+next chunks are read; at most 2 x workers chunks are in flight at a time.
+
+Exports are written to a private directory (mode 0700, files 0600) created
+per process. Encrypted exports are kept per (snapshot, format) and reused
+until a new snapshot is published; decrypted exports hold plaintext PII and
+are written under a unique name, to be removed with remove_export() once they
+have been served.
+"""
+import atexit
+import base64
+import glob
+import gzip
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+import pandas as pd
+from cryptography.fernet import InvalidToken
+
+from utils import sharding, snapshots
+from utils.helper import cipher_suite
+
+EXPORT_CHUNK_ROWS = int(os.environ.get("EXPORT_CHUNK_ROWS", "5000"))
+EXPORT_WORKERS = int(os.environ.get("EXPORT_WORKERS", str(min(4, os.cpu_count() or 1))))
+# format -> (file extension, MIME type)
+EXPORT_FORMATS = {
+    "csv": (".csv", "text/csv"),
+    "csv.gz": (".csv.gz", "application/gzip"),
+    "csv.zst": (".csv.zst", "application/zstd"),
+    "parquet": (".parquet", "application/vnd.apache.parquet"),
+}
+
+
+@dataclass
+class ExportResult:
+    path: str
+    file_name: str
+    mime: str
+    rows: int
+    size_bytes: int
+    seconds: float
+    # Decrypted exports are deleted after they have been served
+    temporary: bool = False
+
+
+_export_dir = None
+_export_dir_lock = threading.Lock()
+
+
+def export_dir():
+    """This process's export directory, private to the user (mkdtemp creates it with mode 0700)."""
+    global _export_dir
+    with _export_dir_lock:
+        if _export_dir is None:
+            _export_dir = tempfile.mkdtemp(prefix="fincopilot_exports_")
+            atexit.register(shutil.rmtree, _export_dir, True)
+        return _export_dir
+
+
+def _snapshot_id(db_path):
+    """Identifies the snapshot file itself, so a reset db/ reusing a version number gets new exports."""
+    stat = os.stat(db_path)
+    return hashlib.sha1(f"{os.path.realpath(db_path)}:{stat.st_mtime_ns}:{stat.st_size}".encode()).hexdigest()[:12]
+
+
+def decrypt_chunk(df):
+    """Decrypt the <field>_encrypted columns of a chunk back to <field>; blind index columns are dropped."""
+    df = df.drop(columns=[c for c in df.columns if c.endswith("_bidx")])
+    for column in [c for c in df.columns if c.endswith("_encrypted")]:
+        values = []
+        for value in df[column]:
+            if value is None:
+                values.append(None)
+                continue
+            try:
+                values.append(cipher_suite.decrypt(base64.b64decode(value.encode())).decode())
+            except InvalidToken:
+                # Every value would fail: the data was encrypted with another key
+                raise ValueError("The data was encrypted with a different key; set FINCOPILOT_ENCRYPTION_KEY "
+                                 "to the key used at import, or import the data again") from None
+            except Exception:
+                values.append("Decryption failed")
+        df[column[:-len("_encrypted")]] = values
+        df = df.drop(columns=[column])
+    return df
+
+
+def _read_chunks(conn, table_name, chunk_rows):
+    yield from pd.read_sql_query(f"SELECT * FROM {table_name}", conn, chunksize=chunk_rows)
+
+
+def _decrypted_chunks(chunks, workers):
+    """Decrypt chunks on a thread pool, keeping their order and a bounded number in flight."""
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="export-decrypt") as pool:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.submit(decrypt_chunk, chunk))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+class _CsvWriter:
+    def __init__(self, path, compression):
+        if compression == "gzip":
+            self._raw = None
+            self._file = gzip.open(path, "wt", newline="", encoding="utf-8")
+        elif compression == "zstd":
+            import zstandard
+            self._raw = open(path, "wb")
+            self._zstd = zstandard.ZstdCompressor().stream_writer(self._raw, closefd=False)
+            self._file = io.TextIOWrapper(self._zstd, encoding="utf-8", newline="")
+        else:
+            self._raw = None
+            self._file = open(path, "w", newline="", encoding="utf-8")
+        self._header = True
+
+    def write(self, df):
+        df.to_csv(self._file, index=False, header=self._header)
+        self._header = False
+
+    def close(self):
+        self._file.close()
+        if self._raw is not None:
+            self._raw.close()
+
+
+class _ParquetWriter:
+    def __init__(self, path):
+        import pyarrow
+        import pyarrow.parquet
+        self._pa = pyarrow
+        self._path = path
+        self._writer = None
+        self._schema = None
+
+    def write(self, df):
+        if self._writer is None:
+            table = self._pa.Table.from_pandas(df, preserve_index=False)
+            self._schema = table.schema
+            self._writer = self._pa.parquet.ParquetWriter(self._path, self._schema)
+        else:
+            # Later chunks are cast to the first chunk's schema (e.g. an all-NULL column)
+            table = self._pa.Table.from_pandas(df, schema=self._schema, preserve_index=False)
+        self._writer.write_table(table)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+
+
+def _open_writer(fmt, path):
+    if fmt == "parquet":
+        return _ParquetWriter(path)
+    return _CsvWriter(path, {"csv.gz": "gzip", "csv.zst": "zstd"}.get(fmt))
+
+
+def export_table(fmt="csv", decrypt=False, db_path=None, table_name="customer_data",
+                 chunk_rows=EXPORT_CHUNK_ROWS, workers=EXPORT_WORKERS):
+    """
+    Export `table_name` of the current snapshot to a file in export_dir() and return an ExportResult.
+    Pass decrypted results to remove_export() once they have been served.
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format {fmt!r}, expected one of {list(EXPORT_FORMATS)}")
+    extension, mime = EXPORT_FORMATS[fmt]
+    db_path = db_path or snapshots.current_db_path()
+    if db_path is None:
+        raise FileNotFoundError("No dataset has been imported yet")
+    version = snapshots.version_of(db_path)
+    prefix = f"v{version}_{_snapshot_id(db_path)}_"
+    kind = "decrypted" if decrypt else "encrypted"
+    file_name = f"{kind}_{table_name}{extension}"
+    directory = export_dir()
+    if decrypt:
+        # Never shared or reused: each request gets its own file, removed after serving
+        fd, path = tempfile.mkstemp(prefix=f"{prefix}{kind}_", suffix=extension, dir=directory)
+        os.close(fd)
+    else:
+        path = os.path.join(directory, f"{prefix}{kind}_{table_name}{extension}")
+        if os.path.exists(path):
+            return ExportResult(path, file_name, mime, -1, os.path.getsize(path), 0.0)
+
+    started = time.perf_counter()
+    rows = 0
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    os.close(os.open(tmp_path, os.O_CREAT | os.O_TRUNC | os.O_WRONLY, 0o600))
+    conn = sharding.connect(db_path, read_only=True)
+    writer = _open_writer(fmt, tmp_path)
+    try:
+        chunks = _read_chunks(conn, table_name, chunk_rows)
+        if decrypt:
+            chunks = _decrypted_chunks(chunks, workers)
+        for chunk in chunks:
+            writer.write(chunk)
+            rows += len(chunk)
+        writer.close()
+        # Writers that recreate the file (Parquet) don't keep the mode it was created with
+        os.chmod(tmp_path, 0o600)
+        os.replace(tmp_path, path)
+    except BaseException:
+        writer.close()
+        for leftover in (tmp_path, path if decrypt else None):
+            if leftover and os.path.exists(leftover):
+                os.remove(leftover)
+        raise
+    finally:
+        conn.close()
+    cleanup_exports(keep_prefix=prefix)
+    seconds = time.perf_counter() - started
+    print(f"exported {rows} rows to {path} in {seconds:.2f}s")
+    return ExportResult(path, file_name, mime, rows, os.path.getsize(path), seconds, temporary=decrypt)
+
+
+def remove_export(result):
+    """Delete a temporary (decrypted) export once it has been served; cached ones are kept."""
+    if result.temporary:
+        try:
+            os.remove(result.path)
+        except OSError:
+            pass
+
+
+def cleanup_exports(keep_prefix):
+    """Remove exports of snapshots other than the one whose file names start with `keep_prefix`."""
+    for path in glob.glob(os.path.join(export_dir(), "v*_*")):
+        if not os.path.basename(path).startswith(keep_prefix):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
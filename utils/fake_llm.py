@@ -0,0 +1,136 @@
+import json
+import math
+import random
+import re
+import time
+from langchain_core.messages import AIMessage
+
+# Canned SQL per question keyword; the first match wins
+FAKE_SQL = [
+    ("country", "SELECT country, AVG(balance) AS avg_balance FROM customer_data GROUP BY country"),
+    ("gender", "SELECT gender, AVG(estimated_salary) AS avg_salary FROM customer_data GROUP BY gender"),
+    ("age", "SELECT age, AVG(churn) AS churn_rate FROM customer_data GROUP BY age ORDER BY age"),
+    ("how many", "SELECT COUNT(*) AS customer_count FROM customer_data"),
+    ("count", "SELECT COUNT(*) AS customer_count FROM customer_data"),
+    ("", "SELECT churn, COUNT(*) AS customers FROM customer_data GROUP BY churn"),
+]
+# Follow-ups run over the previous result (see utils/followups.py)
+FAKE_FOLLOWUP_SQL = "SELECT * FROM last_result"
+
+
+def parse_latency(spec):
+    """
+    Parse a latency distribution spec into a zero-argument sampler (seconds).
+
+      "0.2"                  fixed 200 ms
+      "uniform:0.1,0.5"      uniform between 100 and 500 ms
+      "normal:0.3,0.05"      normal with mean 300 ms, sd 50 ms
+      "lognormal:0.3,0.5"    lognormal with median 300 ms and sigma 0.5
+    """
+    if spec is None or spec == "":
+        return lambda: 0.0
+    if isinstance(spec, (int, float)):
+        return lambda: float(spec)
+    kind, _, args = str(spec).partition(":")
+    if not args:
+        value = float(kind)
+        return lambda: value
+    a, b = (float(x) for x in args.split(","))
+    if kind == "uniform":
+        return lambda: random.uniform(a, b)
+    if kind == "normal":
+        return lambda: max(random.gauss(a, b), 0.0)
+    if kind == "lognormal":
+        return lambda: random.lognormvariate(math.log(a), b)
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+
+def parse_stage_latencies(spec):
+    """
+    Latency per stage from "routing=0.1;analysis=lognormal:0.8,0.4;default=0.05",
+    or the spec unchanged when it names no stages.
+    """
+    if not isinstance(spec, str) or "=" not in spec:
+        return spec
+    latencies = {}
+    for part in spec.split(";"):
+        if part.strip():
+            stage, _, value = part.partition("=")
+            latencies[stage.strip()] = value.strip()
+    return latencies
+
+
+class FakeLLM:
+    """
+    Offline stand-in for a chat model, for local load tests and service runs.
+
+    It recognises the pipeline stage from the prompt and answers with a
+    plausible canned completion after sleeping for a sampled latency.
+    Latency can be set per stage: latency={"routing": "0.1", "analysis": "lognormal:0.8,0.4"},
+    or as the string "routing=0.1;analysis=lognormal:0.8,0.4" (FAKE_LLM_LATENCY).
+    """
+
+    provider = "fake"
+    model = "fake-llm"
+
+    def __init__(self, latency="0.05"):
+        latency = parse_stage_latencies(latency)
+        if isinstance(latency, dict):
+            self._samplers = {stage: parse_latency(spec) for stage, spec in latency.items()}
+        else:
+            self._samplers = {"default": parse_latency(latency)}
+        self.calls = 0
+
+    @staticmethod
+    def stage_of(prompt):
+        if "determine whether answering the user's question requires" in prompt:
+            return "routing"
+        if "split a user's question about a database" in prompt:
+            return "planning"
+        if "fixing a SQLite query" in prompt:
+            return "sql_repair"
+        if "over the results of earlier questions" in prompt:
+            return "followup_sql"
+        if "generates SQLite queries" in prompt:
+            return "sql_generation"
+        if "You are a data analyst" in prompt:
+            return "analysis"
+        return "default"
+
+    @staticmethod
+    def _question(prompt):
+        quoted = re.findall(r'(?:Q|User question|Question to split): "(.*?)"', prompt)
+        if quoted:
+            return quoted[-1].lower()
+        tail = prompt.strip().splitlines()
+        return tail[-1].lower() if tail else ""
+
+    def _complete(self, stage, prompt):
+        question = self._question(prompt)
+        if stage == "routing":
+            return "yes"
+        if stage == "followup_sql":
+            return FAKE_FOLLOWUP_SQL
+        if stage == "planning":
+            parts = [part.strip() for part in re.split(r"\s+and\s+|;", question) if part.strip()]
+            return json.dumps(parts if len(parts) > 1 else [])
+        if stage in ("sql_generation", "sql_repair"):
+            return next(sql for keyword, sql in FAKE_SQL if keyword in question)
+        if stage == "analysis":
+            # Header row of the markdown result table
+            header = re.search(r"Data:\n\|(.*)\|", prompt)
+            names = [c.strip() for c in header.group(1).split("|")] if header else []
+            chart = None
+            if len(names) >= 2:
+                chart = {"chart_type": "bar", "x_column": names[0], "y_column": names[1],
+                         "groupby_column": None, "aggregation": None, "reason": "Compare groups"}
+            return json.dumps({"text": "Here is a summary of the result.", "chart": chart})
+        return "ok"
+
+    def invoke(self, messages, **kwargs):
+        self.calls += 1
+        prompt = "\n".join(getattr(m, "content", str(m)) for m in messages)
+        stage = self.stage_of(prompt)
+        sampler = self._samplers.get(stage) or self._samplers.get("default") or (lambda: 0.0)
+        time.sleep(sampler())
+        return AIMessage(content=self._complete(stage, prompt))
@@ -0,0 +1,230 @@
+"""
+Follow-up questions answered from the previous results of a conversation.
+
+A ResultHistory keeps the last FOLLOWUP_HISTORY result frames of one session
+and registers them in a private in-memory SQLite database: the latest as
+last_result, older ones as result_2, result_3, ... in recency order.
+
+classify_followup() is a cheap, local intent check. It only fires when the
+question refers back to the previous answer ("that", "those", "instead", ...)
+and every column it mentions is in the previous result; otherwise the question
+goes through the normal pipeline. Re-plots, sorts and top-N follow-ups need no
+LLM call at all; other re-aggregations need one SQL call against the
+in-memory tables instead of the routing, SQL and database round trips.
+"""
+import os
+import re
+import sqlite3
+import threading
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Optional
+
+import pandas as pd
+from langchain_core.messages import HumanMessage
+
+import utils.DataModels as dm
+from utils.llm_scheduler import scheduler
+from utils.prompt_compiler import PromptCompiler
+
+FOLLOWUP_HISTORY = int(os.environ.get("FOLLOWUP_HISTORY", "3"))
+# Larger results are not kept; follow-ups on them go back to the database
+MAX_FOLLOWUP_ROWS = int(os.environ.get("MAX_FOLLOWUP_ROWS", "100000"))
+LATEST_TABLE = "last_result"
+
+REFERS_BACK = re.compile(
+    r"\b(that|those|this|these|it|them|same|instead|previous|above|last (result|answer|table|chart))\b")
+CHART_WORDS = {
+    "pie": re.compile(r"\bpie\b"),
+    "bar": re.compile(r"\b(bar|bars|column chart|histogram)\b"),
+    "line": re.compile(r"\b(line|trend)\b"),
+    "scatter": re.compile(r"\bscatter\b"),
+}
+REPLOT_WORDS = re.compile(r"\b(plot|chart|graph|draw|visuali[sz]e|show)\b")
+SORT_WORDS = re.compile(r"\b(sort|sorted|order|ordered|rank|ranked)\b")
+DESCENDING_WORDS = re.compile(r"\b(desc|descending|highest|largest|biggest|most|decreasing|top)\b")
+REAGGREGATE_WORDS = re.compile(
+    r"\b(total|sum|average|avg|mean|count|percent|percentage|share|ratio|group|combine|only|exclude|"
+    r"without|filter|per|difference|compare|split|break (it|that|them) down)\b")
+TOP_N = re.compile(r"\b(top|bottom|first|last|highest|lowest)\s+(\d+)\b")
+
+
+@dataclass
+class ResultFrame:
+    question: str
+    sql: Optional[str]
+    df: pd.DataFrame
+    chart: Optional[dm.ChartMetadata]
+    data_version: Optional[int]
+
+
+def _table_name(position):
+    return LATEST_TABLE if position == 0 else f"result_{position + 1}"
+
+
+class ResultHistory:
+    """The last few result frames of one conversation, queryable as in-memory SQLite tables."""
+
+    def __init__(self, size=FOLLOWUP_HISTORY):
+        self.frames = deque(maxlen=size)
+        self._conn = sqlite3.connect(":memory:", check_same_thread=False)
+        self._lock = threading.Lock()
+
+    @property
+    def latest(self):
+        return self.frames[0] if self.frames else None
+
+    def add(self, question, sql, df, chart=None, data_version=None):
+        if df is None or df.empty or len(df) > MAX_FOLLOWUP_ROWS:
+            return
+        df = df.copy()
+        df.columns = [str(c) for c in df.columns]
+        df.attrs = {}
+        with self._lock:
+            self.frames.appendleft(ResultFrame(question, sql, df, chart, data_version))
+            # Re-register every frame so the table names follow recency
+            for position in range(self.frames.maxlen):
+                self._conn.execute(f"DROP TABLE IF EXISTS {_table_name(position)}")
+            for position, frame in enumerate(self.frames):
+                frame.df.to_sql(_table_name(position), self._conn, index=False)
+
+    def clear(self):
+        with self._lock:
+            for position in range(len(self.frames)):
+                self._conn.execute(f"DROP TABLE IF EXISTS {_table_name(position)}")
+            self.frames.clear()
+
+    @contextmanager
+    def connection(self):
+        with self._lock:
+            yield self._conn
+
+    def query(self, sql):
+        with self.connection() as conn:
+            return pd.read_sql_query(sql, conn)
+
+    def describe(self, sample_rows=5):
+        """Prompt context listing the result tables, their columns and a few rows."""
+        parts = []
+        for position, frame in enumerate(self.frames):
+            columns = ", ".join(f"{name} ({dtype})" for name, dtype in frame.df.dtypes.astype(str).items())
+            parts.append(
+                f"Table {_table_name(position)} ({len(frame.df)} rows), the answer to \"{frame.question}\"\n"
+                f"Columns: {columns}\n{frame.df.head(sample_rows).to_markdown(index=False)}")
+        return "\n\n".join(parts)
+
+
+def _column_variants(name):
+    name = name.lower()
+    return {name, name.replace("_", " ")}
+
+
+def _mentions(text, name):
+    return any(re.search(rf"\b{re.escape(v)}\b", text) for v in _column_variants(name))
+
+
+def _covers(result_columns, name):
+    """Whether the result has `name` itself or an aggregate of it such as avg_balance."""
+    pattern = re.compile(rf"(^|_){re.escape(name.lower())}(_|$)")
+    return any(pattern.search(c.lower()) for c in result_columns)
+
+
+def _match_result_column(text, columns):
+    """Result column named in the question, allowing 'churn' for churn_rate."""
+    for name in columns:
+        if _mentions(text, name):
+            return name
+    words = set(re.findall(r"[a-z]{4,}", text))
+    for name in columns:
+        if words & set(name.lower().split("_")):
+            return name
+    return None
+
+
+def _first_numeric(df):
+    numeric = df.select_dtypes("number").columns
+    return numeric[-1] if len(numeric) else None
+
+
+def classify_followup(question, history, schema_columns, data_version=None):
+    """
+    FollowupIntent when the question can be answered from the previous result,
+    None when it needs the database.
+    """
+    frame = history.latest if history is not None else None
+    if frame is None or frame.data_version != data_version:
+        return None
+    text = re.sub(r"\s+", " ", question.lower()).strip()
+    if not REFERS_BACK.search(text):
+        return None
+    result_columns = list(frame.df.columns)
+    # A table column that the previous result does not have means new data is needed
+    for name, _ in schema_columns:
+        if _mentions(text, name) and not _covers(result_columns, name):
+            return None
+
+    column = _match_result_column(text, result_columns)
+    top = TOP_N.search(text)
+    if top:
+        descending = top.group(1) not in ("bottom", "lowest")
+        column = column or _first_numeric(frame.df)
+        if column:
+            return dm.FollowupIntent(kind="top", column=column, descending=descending, limit=int(top.group(2)))
+    if SORT_WORDS.search(text) and column:
+        return dm.FollowupIntent(kind="sort", column=column, descending=bool(DESCENDING_WORDS.search(text)))
+    chart_type = next((kind for kind, pattern in CHART_WORDS.items() if pattern.search(text)), None)
+    if chart_type and (REPLOT_WORDS.search(text) or re.search(r"\bas an? \w+", text)):
+        return dm.FollowupIntent(kind="replot", chart_type=chart_type)
+    if column or REAGGREGATE_WORDS.search(text):
+        return dm.FollowupIntent(kind="reaggregate")
+    return None
+
+
+def followup_chart(frame, df, chart_type=None):
+    """The previous chart for `df`, optionally as another chart type."""
+    chart = frame.chart
+    if chart is None:
+        if chart_type is None or df.shape[1] < 2:
+            return None
+        y = _first_numeric(df)
+        x = next((c for c in df.columns if c != y), None)
+        if y is None or x is None:
+            return None
+        chart = dm.ChartMetadata(chart_type=chart_type, x_column=x, y_column=y, groupby_column=None,
+                                 aggregation=None, reason="follow-up")
+    if chart_type:
+        chart = chart.model_copy(update={"chart_type": chart_type})
+    return chart
+
+
+def reuse_sql(intent):
+    """SQL over last_result for sort and top-N follow-ups."""
+    sql = f'SELECT * FROM {LATEST_TABLE} ORDER BY "{intent.column}" {"DESC" if intent.descending else "ASC"}'
+    if intent.kind == "top":
+        sql += f" LIMIT {int(intent.limit)}"
+    return sql
+
+
+def describe_reuse(intent):
+    direction = "descending" if intent.descending else "ascending"
+    if intent.kind == "replot":
+        return f"Here is the previous result as a {intent.chart_type} chart."
+    if intent.kind == "top":
+        return f"The {'top' if intent.descending else 'bottom'} {intent.limit} rows of the previous result by {intent.column}."
+    return f"The previous result sorted by {intent.column} ({direction})."
+
+
+def generate_followup_sql(llm, question, history):
+    """One SQL generation call against the in-memory result tables."""
+    compiler = PromptCompiler("followup_sql")
+    compiler.add_static("instructions", """
+You are an AI that generates SQLite queries over the results of earlier questions.
+Only the tables listed below exist. Prefer last_result, the most recent answer.
+
+Return only the raw SQL query (no markdown, no explanation).
+""")
+    compiler.add_dynamic("results", history.describe())
+    compiler.set_question(f'Follow-up question: "{question}"')
+    response = scheduler.invoke(llm, [HumanMessage(content=compiler.compile())], stage="followup_sql")
+    return dm.SQLQuery(sql=response.content.strip(), explanation="Follow-up over previous results")
@@ -11,9 +11,38 @@ import base64
 from cryptography.fernet import Fernet
 import json
 import time
+from utils.snapshots import current_db_path
+from utils import sharding
 
-# Generate encryption key
-ENCRYPTION_KEY = Fernet.generate_key()
+ENCRYPTION_KEY_ENV_VAR = "FINCOPILOT_ENCRYPTION_KEY"
+ENCRYPTION_KEY_PATH = "db/encryption.key"
+
+def load_encryption_key():
+    """
+    Fernet key from FINCOPILOT_ENCRYPTION_KEY or db/encryption.key (created with mode 0600 on
+    first use). It must outlive the process: persisted snapshots are decrypted with it.
+    """
+    key = os.environ.get(ENCRYPTION_KEY_ENV_VAR)
+    if key:
+        return key.encode()
+    try:
+        with open(ENCRYPTION_KEY_PATH, "rb") as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        pass
+    os.makedirs(os.path.dirname(ENCRYPTION_KEY_PATH), exist_ok=True)
+    try:
+        fd = os.open(ENCRYPTION_KEY_PATH, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o600)
+    except FileExistsError:
+        # Another process created it first
+        with open(ENCRYPTION_KEY_PATH, "rb") as f:
+            return f.read().strip()
+    key = Fernet.generate_key()
+    with os.fdopen(fd, "wb") as f:
+        f.write(key)
+    return key
+
+ENCRYPTION_KEY = load_encryption_key()
 cipher_suite = Fernet(ENCRYPTION_KEY)
 
 def cleanup_database(db_path='db/database.db'):
@@ -201,11 +230,12 @@ def run_complete_pipeline():
     
     return True, df_encrypted, df_with_synthetic
 
-def get_database_data(db_path='db/database.db'):
+def get_database_data(db_path=None):
     """Get data from database."""
     try:
-        if os.path.exists(db_path):
-            conn = sqlite3.connect(db_path)
+        db_path = db_path or current_db_path()
+        if db_path and os.path.exists(db_path):
+            conn = sharding.connect(db_path)
             df_db = pd.read_sql_query("SELECT * FROM customer_data LIMIT 10", conn)
             conn.close()
             return df_db
@@ -215,14 +245,13 @@ def get_database_data(db_path='db/database.db'):
         st.error(f"Error loading from database: {str(e)}")
         return None
 
-def get_database_schema(db_path='db/database.db'):
+def get_database_schema(db_path=None):
     """Get database schema information."""
     try:
-        if os.path.exists(db_path):
-            conn = sqlite3.connect(db_path)
-            cursor = conn.cursor()
-            cursor.execute("PRAGMA table_info(customer_data)")
-            columns = cursor.fetchall()
+        db_path = db_path or current_db_path()
+        if db_path and os.path.exists(db_path):
+            conn = sharding.connect(db_path)
+            columns = sharding.table_info(conn, 'customer_data')
             conn.close()
             return columns
         else:
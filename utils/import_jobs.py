@@ -0,0 +1,254 @@
+import base64
+import glob
+import os
+import re
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from utils.helper import cipher_suite
+from utils import snapshots, sharding, sampling, blind_index, data_profile, catalog
+
+DEFAULT_CSV_PATH = 'data/raw_customer_churn.csv'
+DEFAULT_CHUNK_SIZE = 2000
+SENSITIVE_FIELDS = ['email', 'phone_number', 'credit_card_type']
+CARD_TYPES = ['Visa', 'MasterCard', 'American Express', 'Discover']
+# Wide enough that the bundled 10k-row dataset never wraps
+JOIN_DATE_SPAN_DAYS = 365 * 1000
+
+# Stages in order, mapped to the pipeline_status keys shown in the UI
+STAGES = [
+    ('load', 'data_loaded'),
+    ('synthetic', 'synthetic_fields_added'),
+    ('encrypt', 'data_encrypted'),
+    ('store', 'database_stored'),
+]
+
+
+def import_extra_tables(conn, directory=catalog.EXTRA_TABLES_DIR, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Load every CSV in `directory` as a table named after the file; *_id columns get an index for joins."""
+    names = []
+    for path in sorted(glob.glob(os.path.join(directory, "*.csv"))):
+        name = re.sub(r"\W", "_", os.path.splitext(os.path.basename(path))[0]).lower()
+        if name == 'customer_data' or name in catalog.INTERNAL_TABLES:
+            print(f"skipping {path}: {name} is a reserved table name")
+            continue
+        conn.execute(f'DROP TABLE IF EXISTS "{name}"')
+        columns = []
+        for chunk in pd.read_csv(path, chunksize=chunk_size):
+            chunk.to_sql(name, conn, if_exists='append', index=False)
+            columns = list(chunk.columns)
+        for column in columns:
+            if column.endswith('_id') or column == 'id':
+                conn.execute(f'CREATE INDEX IF NOT EXISTS "idx_{name}_{column}" ON "{name}" ("{column}")')
+        names.append(name)
+    conn.commit()
+    return names
+
+
+class ImportCancelled(Exception):
+    """Raised inside the worker when the job was cancelled."""
+
+
+def add_synthetic_fields_chunk(df, offset):
+    """Vectorised version of the synthetic fields, continuing the row numbering at `offset`."""
+    df = df.copy()
+    index = np.arange(offset, offset + len(df))
+    df['email'] = [f"customer{i}@example.com" for i in index]
+    df['phone_number'] = [f"+1-555-{str(i).zfill(3)}-{str(i*2).zfill(4)}" for i in index]
+    base_date = np.datetime64(datetime(2020, 1, 1))
+    # Join dates step 30 days per row and wrap around, so large imports stay within real dates
+    join_days = (index * 30) % JOIN_DATE_SPAN_DAYS
+    df['join_date'] = base_date + join_days.astype('timedelta64[D]')
+    df['last_login'] = base_date + (join_days + np.random.randint(1, 365, len(df))).astype('timedelta64[D]')
+    df['avg_monthly_txn'] = np.random.uniform(100, 5000, len(df))
+    df['credit_card_type'] = np.random.choice(CARD_TYPES, len(df))
+    return df
+
+
+def encrypt_chunk(df):
+    """Encrypt the sensitive fields of a chunk and rename them to <field>_encrypted, next to their blind indexes."""
+    df = blind_index.add_blind_indexes(df)
+    for field in SENSITIVE_FIELDS:
+        if field in df.columns:
+            df[f"{field}_encrypted"] = [
+                base64.b64encode(cipher_suite.encrypt(str(value).encode())).decode()
+                for value in df[field]
+            ]
+            df.drop(columns=[field], inplace=True)
+    return df
+
+
+class ImportJob:
+    """One background import: CSV -> synthetic fields -> encryption -> new snapshot -> publish."""
+
+    def __init__(self, csv_path=DEFAULT_CSV_PATH, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.id = uuid.uuid4().hex[:8]
+        self.csv_path = csv_path
+        self.version = None
+        self.db_path = None
+        self.chunk_size = chunk_size
+        self.status = 'queued'
+        self.stage = None
+        self.completed_stages = []
+        self.rows_processed = 0
+        self.total_rows = 0
+        self.started_at = None
+        self.finished_at = None
+        self.error = None
+        self._cancel = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name=f"import-{self.id}", daemon=True)
+        self._thread.start()
+        return self
+
+    def cancel(self):
+        self._cancel.set()
+
+    @property
+    def active(self):
+        return self.status in ('queued', 'running')
+
+    def _check_cancelled(self):
+        if self._cancel.is_set():
+            raise ImportCancelled()
+
+    def _complete(self, *stages):
+        self.completed_stages.extend(s for s in stages if s not in self.completed_stages)
+
+    def progress(self):
+        elapsed = ((self.finished_at or time.time()) - self.started_at) if self.started_at else 0.0
+        stage_keys = dict(STAGES)
+        return {
+            'job_id': self.id,
+            'status': self.status,
+            'stage': self.stage,
+            'completed_stages': [stage_keys[s] for s in self.completed_stages],
+            'rows_processed': self.rows_processed,
+            'total_rows': self.total_rows,
+            'fraction': (self.rows_processed / self.total_rows) if self.total_rows else 0.0,
+            'rows_per_sec': round(self.rows_processed / elapsed, 1) if elapsed > 0 else 0.0,
+            'elapsed_sec': round(elapsed, 1),
+            'error': self.error,
+            'version': self.version,
+        }
+
+    def _run(self):
+        self.status = 'running'
+        self.started_at = time.time()
+        conn = None
+        writer = None
+        try:
+            self.stage = 'load'
+            # Counted up front (one column only) so progress has a total; the rows are read in chunks below
+            self.total_rows = sum(len(chunk) for chunk in
+                                  pd.read_csv(self.csv_path, usecols=[0], chunksize=self.chunk_size * 10))
+            self._complete('load')
+            self._check_cancelled()
+
+            # Write into a fresh snapshot file; readers stay on the published one
+            self.version, self.db_path = snapshots.reserve_snapshot()
+            conn = sqlite3.connect(self.db_path)
+            # With SHARD_MODE set, rows go to shard files and the snapshot keeps the manifest
+            writer = sharding.ShardWriter(self.db_path) if sharding.SHARD_MODE != 'off' else None
+
+            # Synthetic fields, encryption and storage run chunk by chunk so the job
+            # reports progress, can stop between chunks and never holds the whole file
+            columns = []
+            labels = set()
+            offset = 0
+            for chunk in pd.read_csv(self.csv_path, chunksize=self.chunk_size):
+                self._check_cancelled()
+                self.stage = 'synthetic'
+                chunk = add_synthetic_fields_chunk(chunk, offset)
+                self.stage = 'encrypt'
+                labels |= blind_index.labels_for(chunk)
+                chunk = encrypt_chunk(chunk)
+                self.stage = 'store'
+                if writer:
+                    writer.write(chunk)
+                else:
+                    chunk.to_sql('customer_data', conn, if_exists='append', index=False)
+                columns = list(chunk.columns)
+                offset += len(chunk)
+                self.rows_processed = offset
+            if not offset:
+                raise ValueError(f"{self.csv_path} has no rows")
+            # customer_id backs keyset pagination in the database explorer
+            index_columns = ['customer_id'] + blind_index.index_columns(columns)
+            if writer:
+                writer.close(conn, index_columns=index_columns)
+                writer = None
+            else:
+                blind_index.create_indexes(conn, index_columns)
+            blind_index.write_metadata(conn, labels)
+            conn.commit()
+            self._complete('synthetic', 'encrypt')
+            self._check_cancelled()
+
+            # Sample tables for approximate answers and the column profile live in the snapshot, sharded or
+            # not; both are built from the stored table with SQL and chunked reads
+            stored = sharding.connect(self.db_path)
+            try:
+                self.stage = 'sample'
+                sampling.build_samples(stored, chunk_size=self.chunk_size)
+                self._check_cancelled()
+                self.stage = 'profile'
+                data_profile.build_profile(stored, labels)
+            finally:
+                stored.close()
+            self._check_cancelled()
+
+            # Related tables (transactions, accounts, ...) and the catalog that links them to customer_data
+            self.stage = 'tables'
+            import_extra_tables(conn, chunk_size=self.chunk_size)
+            self._check_cancelled()
+            self.stage = 'catalog'
+            catalog_conn = sharding.connect(self.db_path)
+            try:
+                catalog.write_catalog(conn, catalog.build_catalog(catalog_conn))
+            finally:
+                catalog_conn.close()
+            self._check_cancelled()
+
+            self.stage = 'publish'
+            conn.close()
+            conn = None
+            snapshots.publish_snapshot(self.version)
+            self._complete('store')
+            self.status = 'completed'
+        except ImportCancelled:
+            self.status = 'cancelled'
+        except Exception as e:
+            self.status = 'failed'
+            self.error = str(e)
+        finally:
+            if writer is not None:
+                writer.abort()
+            if conn is not None:
+                conn.close()
+            if self.status != 'completed' and self.version is not None:
+                snapshots.discard_snapshot(self.version)
+            self.finished_at = time.time()
+
+
+# Jobs outlive Streamlit reruns, so they are kept per process and looked up by ID
+_jobs = {}
+_jobs_lock = threading.Lock()
+
+
+def start_import_job(csv_path=DEFAULT_CSV_PATH, chunk_size=DEFAULT_CHUNK_SIZE):
+    job = ImportJob(csv_path, chunk_size)
+    with _jobs_lock:
+        _jobs[job.id] = job
+    return job.start()
+
+
+def get_import_job(job_id):
+    with _jobs_lock:
+        return _jobs.get(job_id)
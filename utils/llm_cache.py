@@ -0,0 +1,146 @@
+import hashlib
+import json
+import os
+import tempfile
+import time
+from langchain_core.messages import AIMessage
+
+# Supported cache modes for the record/replay layer
+#   off         - talk to the live provider, store nothing
+#   record      - always call the live provider and store every prompt -> completion pair
+#   replay      - serve completions from disk only, fail on a cache miss
+#   passthrough - serve from disk when possible, call (and record) the live provider on a miss
+CACHE_MODES = ("off", "record", "replay", "passthrough")
+DEFAULT_CACHE_DIR = ".llm_cache"
+
+
+class ReplayMiss(LookupError):
+    """Raised in replay mode when a prompt has no recorded completion."""
+
+
+def _message_payload(messages):
+    """Turn a list of langchain messages into a JSON friendly list."""
+    payload = []
+    for message in messages:
+        payload.append({
+            "type": getattr(message, "type", message.__class__.__name__),
+            "content": getattr(message, "content", str(message)),
+        })
+    return payload
+
+
+def cache_key(provider, model, messages):
+    """Content address of a prompt: sha256 over provider, model and the messages."""
+    raw = json.dumps(
+        {"provider": provider, "model": model, "messages": _message_payload(messages)},
+        sort_keys=True,
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class CompletionStore:
+    """Local content-addressed store of prompt -> completion pairs.
+
+    Each entry lives in <cache_dir>/<first two hex chars>/<sha256>.json so the
+    directory stays browsable even with many recorded runs.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR):
+        self.cache_dir = cache_dir
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def get(self, key):
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            # A truncated entry is treated as a miss and rewritten on the next record
+            return None
+
+    def put(self, key, entry):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # A temporary file of its own per writer, so two recorders of the same prompt don't clash
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=os.path.dirname(path),
+                                         prefix=f"{key}.", suffix=".tmp", delete=False) as f:
+            json.dump(entry, f, ensure_ascii=False, indent=2)
+        try:
+            # Atomic rename so concurrent readers never see a half-written file
+            os.replace(f.name, path)
+        except OSError:
+            os.remove(f.name)
+            raise
+
+
+class RecordReplayLLM:
+    """Wraps a chat model and records/replays its completions from a local store.
+
+    Only the `invoke(messages)` call used by the pipeline is intercepted; the
+    returned object exposes `.content` just like a live AIMessage.
+    """
+
+    def __init__(self, llm, provider, model, mode="passthrough", cache_dir=DEFAULT_CACHE_DIR):
+        if mode not in CACHE_MODES:
+            raise ValueError(f"Unsupported cache mode: {mode}. Use one of {CACHE_MODES}")
+        self.llm = llm
+        self.provider = provider
+        self.model = model
+        self.mode = mode
+        self.store = CompletionStore(cache_dir)
+        self.hits = 0
+        self.misses = 0
+
+    def cached(self, messages):
+        """
+        The recorded completion for these messages, or None when the provider has to be called.
+        Lets the scheduler serve hits without spending the provider's rate limit.
+        """
+        if self.mode not in ("replay", "passthrough"):
+            return None
+        key = cache_key(self.provider, self.model, messages)
+        entry = self.store.get(key)
+        if entry is None:
+            if self.mode == "replay":
+                self.misses += 1
+                raise ReplayMiss(f"No recorded completion for prompt {key[:12]} in {self.store.cache_dir}")
+            return None
+        self.hits += 1
+        return AIMessage(content=entry["completion"])
+
+    def invoke(self, messages, **kwargs):
+        key = cache_key(self.provider, self.model, messages)
+
+        if self.mode in ("replay", "passthrough"):
+            entry = self.store.get(key)
+            if entry is not None:
+                self.hits += 1
+                return AIMessage(content=entry["completion"])
+            self.misses += 1
+            if self.mode == "replay":
+                raise ReplayMiss(f"No recorded completion for prompt {key[:12]} in {self.store.cache_dir}")
+
+        if self.llm is None:
+            raise ReplayMiss("No live LLM configured to serve a cache miss")
+
+        response = self.llm.invoke(messages, **kwargs)
+        if self.mode != "off":
+            self.store.put(key, {
+                "provider": self.provider,
+                "model": self.model,
+                "recorded_at": time.time(),
+                "messages": _message_payload(messages),
+                "completion": response.content,
+            })
+        return response
+
+    def __getattr__(self, name):
+        # Delegate anything else (model_name, callbacks, ...) to the wrapped client
+        if name == "llm":
+            raise AttributeError(name)
+        return getattr(self.llm, name)
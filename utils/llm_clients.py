@@ -0,0 +1,110 @@
+import hashlib
+import os
+import threading
+import time
+
+# Idle clients are dropped after this many seconds without use
+CLIENT_IDLE_TTL = float(os.environ.get("LLM_CLIENT_IDLE_TTL", "900"))
+# Keep-alive pool shared by every client in the process
+HTTP_MAX_CONNECTIONS = int(os.environ.get("LLM_HTTP_MAX_CONNECTIONS", "50"))
+HTTP_MAX_KEEPALIVE = int(os.environ.get("LLM_HTTP_MAX_KEEPALIVE", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.environ.get("LLM_HTTP_KEEPALIVE_EXPIRY", "60"))
+
+
+def _key_hash(api_key):
+    # Never keep raw API keys in registry keys or metrics
+    return hashlib.sha256((api_key or "").encode("utf-8")).hexdigest()[:16]
+
+
+class LLMClientRegistry:
+    """
+    Process-wide registry of chat model clients keyed on (provider, model, key hash).
+
+    Streamlit reruns the script for every interaction but imported modules live
+    for the whole process, so one registry instance is shared across sessions.
+    All clients share a single keep-alive httpx connection pool, which saves the
+    TLS handshake and connection setup on every question.
+    """
+
+    def __init__(self, idle_ttl=CLIENT_IDLE_TTL):
+        self.idle_ttl = idle_ttl
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._last_used = {}
+        self._http_client = None
+        self.created = 0
+        self.reused = 0
+        self.evicted = 0
+
+    def http_client(self):
+        """The shared keep-alive connection pool, created on first use."""
+        if self._http_client is None:
+            import httpx
+            self._http_client = httpx.Client(
+                limits=httpx.Limits(
+                    max_connections=HTTP_MAX_CONNECTIONS,
+                    max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+                    keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+                ),
+                timeout=httpx.Timeout(60.0, connect=10.0),
+            )
+        return self._http_client
+
+    def _create(self, provider, model, api_key):
+        if provider == "openai":
+            from langchain_openai import ChatOpenAI
+            return ChatOpenAI(model=model, api_key=api_key, http_client=self.http_client())
+        elif provider == "groq":
+            from langchain_groq import ChatGroq
+            return ChatGroq(model=model, api_key=api_key, http_client=self.http_client())
+        elif provider == "fake":
+            # Offline model for load tests and local service runs
+            from utils.fake_llm import FakeLLM
+            return FakeLLM(latency=os.environ.get("FAKE_LLM_LATENCY", "0.05"))
+        return None
+
+    def get(self, provider, model, api_key):
+        """Return the client for (provider, model, api_key), creating it once."""
+        key = (provider, model, _key_hash(api_key))
+        with self._lock:
+            self._evict_idle_locked()
+            client = self._clients.get(key)
+            if client is None:
+                client = self._create(provider, model, api_key)
+                if client is None:
+                    return None
+                self._clients[key] = client
+                self.created += 1
+            else:
+                self.reused += 1
+            self._last_used[key] = time.monotonic()
+            return client
+
+    def _evict_idle_locked(self):
+        now = time.monotonic()
+        for key in [k for k, used in self._last_used.items() if now - used > self.idle_ttl]:
+            self._clients.pop(key, None)
+            self._last_used.pop(key, None)
+            self.evicted += 1
+
+    def evict_idle(self):
+        with self._lock:
+            self._evict_idle_locked()
+
+    def metrics(self):
+        with self._lock:
+            requests = self.created + self.reused
+            return {
+                "live_clients": len(self._clients),
+                "created": self.created,
+                "reused": self.reused,
+                "evicted": self.evicted,
+                "reuse_rate": round(self.reused / requests, 3) if requests else 0.0,
+                "clients": [
+                    {"provider": p, "model": m, "key": h, "idle_seconds": round(time.monotonic() - self._last_used[(p, m, h)], 1)}
+                    for (p, m, h) in self._clients
+                ],
+            }
+
+
+client_registry = LLMClientRegistry()
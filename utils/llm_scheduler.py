@@ -0,0 +1,224 @@
+import heapq
+import itertools
+import os
+import random
+import re
+import threading
+import time
+from concurrent.futures import Future
+from utils.llm_cache import cache_key
+from utils.prompt_compiler import count_tokens
+
+# Requests/min and tokens/min per provider; override with LLM_RPM_<PROVIDER> / LLM_TPM_<PROVIDER>
+PROVIDER_LIMITS = {
+    "openai": {"rpm": 500, "tpm": 200000},
+    "groq": {"rpm": 30, "tpm": 6000},
+    # The offline fake model has no quota; keep it from throttling load tests
+    "fake": {"rpm": 100000, "tpm": 100000000},
+}
+DEFAULT_LIMITS = {"rpm": 60, "tpm": 60000}
+
+# Lower number is served first when requests queue for the same provider
+STAGE_PRIORITIES = {
+    "routing": 0,
+    "planning": 0,
+    "sql_generation": 1,
+    "sql_repair": 1,
+    "followup_sql": 1,
+    "analysis": 2,
+}
+DEFAULT_PRIORITY = 1
+
+MAX_RETRIES = int(os.environ.get("LLM_MAX_RETRIES", "4"))
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_MAX_SECONDS = 20.0
+# Completion tokens reserved per request before the real size is known
+EXPECTED_COMPLETION_TOKENS = 256
+
+
+def provider_of(llm):
+    """Best-effort provider name for a chat model or one of our wrappers."""
+    provider = getattr(llm, "provider", None)
+    if isinstance(provider, str):
+        return provider
+    name = type(llm).__name__.lower()
+    if "groq" in name:
+        return "groq"
+    if "openai" in name:
+        return "openai"
+    return name
+
+
+def model_of(llm):
+    for attribute in ("model", "model_name"):
+        value = getattr(llm, attribute, None)
+        if isinstance(value, str):
+            return value
+    return type(llm).__name__
+
+
+def is_rate_limited(error):
+    """
+    True for HTTP 429 errors. The status code or the client's RateLimitError type decide
+    when available; the message is only matched when the error carries neither.
+    """
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    if status is not None:
+        return status == 429
+    if any(cls.__name__ == "RateLimitError" for cls in type(error).__mro__):
+        return True
+    text = str(error).lower()
+    return bool(re.search(r"\b429\b", text)) or "rate limit" in text
+
+
+def _retry_after(error):
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """Classic token bucket refilled continuously up to `capacity` per minute."""
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.tokens = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        """Seconds until `amount` is available (0 when it is available now)."""
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def take(self, amount):
+        self._refill()
+        self.tokens -= min(amount, self.capacity)
+
+
+class ProviderGate:
+    """Priority queue in front of a provider's request and token buckets."""
+
+    def __init__(self, limits):
+        self.requests = TokenBucket(limits["rpm"])
+        self.tokens = TokenBucket(limits["tpm"])
+        self._condition = threading.Condition()
+        self._waiting = []
+        self._sequence = itertools.count()
+
+    def acquire(self, token_estimate, priority):
+        with self._condition:
+            ticket = (priority, next(self._sequence))
+            heapq.heappush(self._waiting, ticket)
+            try:
+                while True:
+                    if self._waiting[0] == ticket:
+                        wait = max(self.requests.wait_time(1), self.tokens.wait_time(token_estimate))
+                        if wait == 0:
+                            self.requests.take(1)
+                            self.tokens.take(token_estimate)
+                            return
+                        self._condition.wait(timeout=wait)
+                    else:
+                        self._condition.wait()
+            finally:
+                self._waiting.remove(ticket)
+                heapq.heapify(self._waiting)
+                self._condition.notify_all()
+
+
+class LLMScheduler:
+    """
+    Single entry point for LLM calls: per-provider rate limiting with priorities,
+    jittered exponential backoff on 429s, and single-flight deduplication so
+    concurrent identical prompts share one in-flight request.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._gates = {}
+        self._inflight = {}
+        self.stats = {"calls": 0, "coalesced": 0, "cached": 0, "retries": 0, "rate_limited": 0}
+
+    def _gate(self, provider):
+        with self._lock:
+            gate = self._gates.get(provider)
+            if gate is None:
+                limits = dict(PROVIDER_LIMITS.get(provider, DEFAULT_LIMITS))
+                limits["rpm"] = int(os.environ.get(f"LLM_RPM_{provider.upper()}", limits["rpm"]))
+                limits["tpm"] = int(os.environ.get(f"LLM_TPM_{provider.upper()}", limits["tpm"]))
+                gate = self._gates[provider] = ProviderGate(limits)
+            return gate
+
+    def invoke(self, llm, messages, stage=None, priority=None):
+        provider = provider_of(llm)
+        key = cache_key(provider, model_of(llm), messages)
+
+        with self._lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = Future()
+                self.stats["calls"] += 1
+            else:
+                self.stats["coalesced"] += 1
+        if not leader:
+            return future.result()
+
+        try:
+            priority = STAGE_PRIORITIES.get(stage, DEFAULT_PRIORITY) if priority is None else priority
+            result = self._invoke_with_retry(llm, messages, provider, priority)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    def _invoke_with_retry(self, llm, messages, provider, priority):
+        # Completions served by the record/replay layer don't reach the provider, so they skip its limits
+        lookup = getattr(llm, "cached", None)
+        cached = lookup(messages) if callable(lookup) else None
+        if cached is not None:
+            with self._lock:
+                self.stats["cached"] += 1
+            return cached
+        gate = self._gate(provider)
+        token_estimate = sum(count_tokens(getattr(m, "content", "")) for m in messages) + EXPECTED_COMPLETION_TOKENS
+        for attempt in range(MAX_RETRIES + 1):
+            gate.acquire(token_estimate, priority)
+            try:
+                return llm.invoke(messages)
+            except Exception as e:
+                if not is_rate_limited(e) or attempt == MAX_RETRIES:
+                    raise
+                with self._lock:
+                    self.stats["rate_limited"] += 1
+                    self.stats["retries"] += 1
+                # Full jitter backoff, but never sooner than the provider's Retry-After
+                delay = random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+                delay = max(delay, _retry_after(e) or 0.0)
+                print(f"{provider} rate limited, retrying in {delay:.2f}s (attempt {attempt + 1}/{MAX_RETRIES})")
+                time.sleep(delay)
+
+    def metrics(self):
+        with self._lock:
+            return dict(self.stats, inflight=len(self._inflight))
+
+
+scheduler = LLMScheduler()
@@ -0,0 +1,262 @@
+"""
+Model routing per pipeline stage and question complexity.
+
+With MODEL_ROUTING=1, get_llm() returns a ModelRouter instead of a single
+chat model. The pipeline asks it for a model at each stage boundary with
+select_model(llm, stage, complexity):
+
+- routing and simple SQL run on the small tier
+- questions that need joins, window functions or ranking, and analyses of
+  large or complex results, run on the medium tier
+- SQL repair runs one tier above the model that wrote the failing SQL, so the
+  stronger model is only paid for after a validation failure
+
+Every call through a routed model is recorded per route (stage, complexity,
+tier, model): latency, prompt and completion tokens, and whether the output
+was usable. Calls are appended to db/model_routes.jsonl. Run
+`python -m utils.model_router` to print per-route statistics when tuning
+ROUTING_TABLE, which can also be overridden from a JSON file named in
+MODEL_ROUTING_TABLE.
+"""
+import json
+import os
+import re
+import threading
+import time
+from collections import defaultdict
+
+from utils.prompt_compiler import count_tokens
+
+MODEL_ROUTING = os.environ.get("MODEL_ROUTING", "0") == "1"
+ROUTE_LOG_PATH = "db/model_routes.jsonl"
+TIERS = ["small", "medium", "large"]
+
+# Models per provider and tier; override with MODEL_<PROVIDER>_<TIER>, e.g. MODEL_OPENAI_LARGE
+MODEL_TIERS = {
+    "openai": {"small": "gpt-4.1-nano", "medium": "gpt-4.1-mini", "large": "gpt-4.1"},
+    "groq": {"small": "llama3-8b-8192", "medium": "llama3-70b-8192", "large": "llama3-70b-8192"},
+    "fake": {"small": "fake-llm", "medium": "fake-llm", "large": "fake-llm"},
+}
+
+# (stage, complexity) -> tier
+ROUTING_TABLE = {
+    ("routing", "simple"): "small",
+    ("routing", "complex"): "small",
+    ("planning", "simple"): "small",
+    ("planning", "complex"): "small",
+    ("sql_generation", "simple"): "small",
+    ("sql_generation", "complex"): "medium",
+    ("sql_repair", "simple"): "small",
+    ("sql_repair", "complex"): "medium",
+    ("followup_sql", "simple"): "small",
+    ("followup_sql", "complex"): "medium",
+    ("analysis", "simple"): "small",
+    ("analysis", "complex"): "medium",
+}
+DEFAULT_TIER = "small"
+
+# Questions whose SQL usually needs joins, subqueries or window functions
+COMPLEX_QUESTION = re.compile(
+    r"\b(rank|ranked|ranking|running|cumulative|rolling|moving average|percentile|median|quartile|"
+    r"previous|prior|month over month|year over year|growth|versus|vs|compared (to|with)|"
+    r"correlat\w*|within each|for each|in each|per each|second highest|nth|top \d+ \w+ (per|in each|by))\b")
+COMPLEX_SQL = re.compile(r"\bJOIN\b|\bOVER\s*\(|\bWITH\b|\bUNION\b|\(\s*SELECT\b|\bPARTITION\s+BY\b", re.IGNORECASE)
+# Results larger than this make the analysis complex
+COMPLEX_RESULT_ROWS = int(os.environ.get("MODEL_ROUTING_COMPLEX_ROWS", "50"))
+COMPLEX_RESULT_COLUMNS = 4
+
+
+def question_complexity(question):
+    text = question.lower()
+    group_by = re.search(r"\bby \w+(?: \w+)? and \w+", text)
+    return "complex" if COMPLEX_QUESTION.search(text) or group_by else "simple"
+
+
+def sql_complexity(sql):
+    return "complex" if sql and COMPLEX_SQL.search(sql) else "simple"
+
+
+def result_complexity(sql, df):
+    if sql_complexity(sql) == "complex":
+        return "complex"
+    if df is not None and (len(df) > COMPLEX_RESULT_ROWS or df.shape[1] > COMPLEX_RESULT_COLUMNS):
+        return "complex"
+    return "simple"
+
+
+def _load_routing_table():
+    table = dict(ROUTING_TABLE)
+    path = os.environ.get("MODEL_ROUTING_TABLE")
+    if path and os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            for route, tier in json.load(f).items():
+                stage, complexity = route.split(":")
+                table[(stage, complexity)] = tier
+    return table
+
+
+class RouteStats:
+    """Per-route call counts, latency, tokens and outcomes, in memory and in the route log."""
+
+    def __init__(self, log_path=ROUTE_LOG_PATH):
+        self.log_path = log_path
+        self._lock = threading.Lock()
+        self._routes = defaultdict(lambda: {"calls": 0, "errors": 0, "seconds": 0.0, "prompt_tokens": 0,
+                                            "completion_tokens": 0, "succeeded": 0, "failed": 0})
+
+    def _log(self, entry):
+        if not self.log_path:
+            return
+        os.makedirs(os.path.dirname(self.log_path), exist_ok=True)
+        with open(self.log_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry) + "\n")
+
+    def record_call(self, route, seconds, prompt_tokens, completion_tokens, error=None):
+        with self._lock:
+            stats = self._routes[route]
+            stats["calls"] += 1
+            stats["errors"] += error is not None
+            stats["seconds"] += seconds
+            stats["prompt_tokens"] += prompt_tokens
+            stats["completion_tokens"] += completion_tokens
+            self._log({"ts": time.time(), "event": "call", "route": list(route), "seconds": round(seconds, 4),
+                       "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                       "error": None if error is None else type(error).__name__})
+
+    def record_outcome(self, route, success):
+        with self._lock:
+            self._routes[route]["succeeded" if success else "failed"] += 1
+            self._log({"ts": time.time(), "event": "outcome", "route": list(route), "success": bool(success)})
+
+    def snapshot(self):
+        with self._lock:
+            return {":".join(route): dict(stats, mean_seconds=round(stats["seconds"] / stats["calls"], 4)
+                                          if stats["calls"] else 0.0)
+                    for route, stats in self._routes.items()}
+
+
+route_stats = RouteStats()
+
+
+class RoutedModel:
+    """One chat model chosen for a route; times and counts every call."""
+
+    def __init__(self, router, stage, complexity, tier):
+        self.router = router
+        self.provider = router.provider
+        self.model = router.model_for(tier)
+        self.route = (stage, complexity, tier, self.model)
+        self._llm = None
+
+    @property
+    def llm(self):
+        # Created on first use, so an escalation model that is never needed costs nothing
+        if self._llm is None:
+            self._llm = self.router.factory(self.model)
+        return self._llm
+
+    def cached(self, messages):
+        # Recorded completions are not provider calls, so they are not booked on the route
+        lookup = getattr(self.llm, "cached", None)
+        return lookup(messages) if callable(lookup) else None
+
+    def invoke(self, messages, **kwargs):
+        prompt_tokens = sum(count_tokens(getattr(m, "content", str(m))) for m in messages)
+        started = time.perf_counter()
+        try:
+            response = self.llm.invoke(messages, **kwargs)
+        except Exception as e:
+            self.router.stats.record_call(self.route, time.perf_counter() - started, prompt_tokens, 0, e)
+            raise
+        self.router.stats.record_call(self.route, time.perf_counter() - started, prompt_tokens,
+                                      count_tokens(getattr(response, "content", "")))
+        return response
+
+
+class ModelRouter:
+    """
+    Chooses a model per (stage, complexity) for one provider and API key.
+    `factory(model)` builds the chat model (pooled client, record/replay layer).
+    """
+
+    def __init__(self, provider, factory, stats=None):
+        self.provider = provider
+        self.factory = factory
+        self.stats = stats or route_stats
+        self.table = _load_routing_table()
+        # Scheduler and cache keys need a model name; calls go through select() anyway
+        self.model = self.model_for(DEFAULT_TIER)
+
+    def model_for(self, tier):
+        models = MODEL_TIERS.get(self.provider, {})
+        return os.environ.get(f"MODEL_{self.provider.upper()}_{tier.upper()}") or models.get(tier) \
+            or models.get(DEFAULT_TIER)
+
+    def select(self, stage, complexity="simple", escalate=False):
+        tier = self.table.get((stage, complexity), DEFAULT_TIER)
+        if escalate:
+            tier = TIERS[min(TIERS.index(tier) + 1, len(TIERS) - 1)]
+        return RoutedModel(self, stage, complexity, tier)
+
+    def cached(self, messages):
+        return self.select("default").cached(messages)
+
+    def invoke(self, messages, **kwargs):
+        # Callers that don't route explicitly get the default tier
+        return self.select("default").invoke(messages, **kwargs)
+
+
+def select_model(llm, stage, complexity="simple", escalate=False):
+    """The model for a stage: chosen by the router, or `llm` itself when routing is off."""
+    if isinstance(llm, ModelRouter):
+        return llm.select(stage, complexity, escalate)
+    return llm
+
+
+def record_outcome(llm, success):
+    """Book whether the output of a routed model was usable (e.g. its SQL validated)."""
+    if isinstance(llm, RoutedModel):
+        llm.router.stats.record_outcome(llm.route, success)
+
+
+def report(log_path=ROUTE_LOG_PATH):
+    """Per-route statistics from the route log, for tuning ROUTING_TABLE."""
+    calls = defaultdict(list)
+    outcomes = defaultdict(list)
+    if os.path.exists(log_path):
+        with open(log_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                route = tuple(entry["route"])
+                if entry.get("event") == "call":
+                    calls[route].append(entry)
+                else:
+                    outcomes[route].append(entry["success"])
+    rows = []
+    for route in sorted(set(calls) | set(outcomes)):
+        seconds = sorted(entry["seconds"] for entry in calls[route])
+        rows.append({
+            "stage": route[0], "complexity": route[1], "tier": route[2], "model": route[3],
+            "calls": len(calls[route]),
+            "errors": sum(1 for entry in calls[route] if entry.get("error")),
+            "p50_seconds": seconds[len(seconds) // 2] if seconds else None,
+            "p95_seconds": seconds[min(len(seconds) - 1, int(len(seconds) * 0.95))] if seconds else None,
+            "mean_tokens": round(sum(e["prompt_tokens"] + e["completion_tokens"] for e in calls[route])
+                                 / len(calls[route]), 1) if calls[route] else None,
+            "success_rate": round(sum(outcomes[route]) / len(outcomes[route]), 3) if outcomes[route] else None,
+        })
+    return rows
+
+
+if __name__ == "__main__":
+    import sys
+    rows = report(sys.argv[1] if len(sys.argv) > 1 else ROUTE_LOG_PATH)
+    if not rows:
+        print("No routed calls logged yet.")
+    for row in rows:
+        print(f"{row['stage']:<15} {row['complexity']:<8} {row['tier']:<7} {row['model']:<20} "
+              f"calls={row['calls']:<5} errors={row['errors']:<3} p50={row['p50_seconds']}s "
+              f"p95={row['p95_seconds']}s tokens={row['mean_tokens']} success={row['success_rate']}")
@@ -0,0 +1,175 @@
+"""
+Decomposition of compound questions into independent sub-questions.
+
+"Compare churn rate by country and average balance by gender, and plot both"
+asks for two unrelated aggregates; forcing them into one SQL query either
+fails or produces a contorted UNION. plan_question() splits such questions:
+
+- rules split on "and", "as well as", "plus" and ";" when every part has its
+  own measure (average, count, rate, ...) and names a column or table of its
+  own, none refers back to another ("their average balance"), no part but the
+  last has a filter the "and" may be continuing ("among customers with ...
+  and tenure above 5"), and a trailing "by country" is not shared
+- with QUESTION_PLANNER=llm, questions that look compound but that the rules
+  can't split are sent to one planning call
+
+The pipeline answers the sub-questions concurrently on pooled connections and
+merges them into one answer with a chart per part (see _run_plan in
+llm_agent_pipeline.py), so the latency is close to that of the slowest part.
+"""
+import argparse
+import json
+import os
+import re
+
+from langchain_core.messages import HumanMessage
+
+import utils.DataModels as dm
+from utils.example_store import tokenize
+from utils.llm_scheduler import scheduler
+from utils.prompt_compiler import PromptCompiler
+
+QUESTION_PLANNER = os.environ.get("QUESTION_PLANNER", "rules")  # rules, llm or off
+MAX_SUB_QUESTIONS = int(os.environ.get("PLANNER_MAX_SUB_QUESTIONS", "4"))
+
+MEASURE_WORDS = re.compile(
+    r"\b(how many|count|number of|average|avg|mean|median|sum|total|max|maximum|min|minimum|highest|lowest|"
+    r"rate|ratio|share|percent|percentage|proportion|distribution|std|standard deviation|variance)\b")
+GROUPING = re.compile(r"\b(by|per|for each|in each|across)\s+\w+")
+# Parts that depend on another part's answer can't run independently
+REFERS_BACK = re.compile(r"\b(their|them|those|these|that|it|its|they|this)\b")
+SEPARATORS = re.compile(r"\s*(?:;|,?\s+and also\s+|,?\s+as well as\s+|,?\s+plus\s+|,?\s+and\s+)\s*")
+PLOT_ALL = re.compile(
+    r"[,;]?\s*(?:and\s+)?(?:then\s+)?(?:plot|chart|graph|visuali[sz]e|draw)\s+"
+    r"(?:both|them|each|all|these|those|the results?)(?:\s+of\s+them)?\s*$")
+LEADING_VERB = re.compile(r"^(?:please\s+)?(?:compare|show(?: me)?|give(?: me)?|tell me|get|find|calculate|what (?:is|are))\s+")
+COMPOUND_HINT = re.compile(r"\b(and|as well as|plus|also)\b|;")
+# "... among customers with more than 2 products and tenure above 5": the "and" continues the filter
+FILTER_WORDS = re.compile(r"\b(with|among|where|who)\b")
+FILLER_WORDS = {"the", "a", "an", "of", "what", "is", "are", "was", "were", "me", "show", "give", "tell", "get",
+                "find", "calculate", "compare", "there", "do", "does", "we", "have", "value", "values", "all"}
+
+# (question, expected sub-questions or None); `python -m utils.planner` checks them
+REGRESSION_EXAMPLES = [
+    ("Compare churn rate by country and average balance by gender, and plot both",
+     ["churn rate by country", "average balance by gender"]),
+    ("count of customers by country; average salary by gender",
+     ["count of customers by country", "average salary by gender"]),
+    ("average balance by country plus churn rate by age", ["average balance by country", "churn rate by age"]),
+    ("average balance and average salary by country", None),
+    # "<measure> and <measure> <column>" is one query over one column
+    ("What is the highest and lowest balance?", None),
+    ("What is the min and max age?", None),
+    ("Show the average and median balance", None),
+    ("how many customers churned and what is their average age", None),
+    ("what is the churn rate among customers with more than 2 products and average tenure above 5", None),
+    ("how many customers have a balance of 0 and how many have more than 100000", None),
+]
+# Schema the regression examples are checked against (the sample customer dataset)
+EXAMPLE_SCHEMA = ["customer_data", "customer_id", "credit_score", "country", "gender", "age", "tenure", "balance",
+                  "products_number", "credit_card", "active_member", "estimated_salary", "churn"]
+
+
+def _has_subject(part):
+    """Whether a part names what it measures, besides measure words and its grouping."""
+    words = re.findall(r"[a-z_]+", GROUPING.sub(" ", MEASURE_WORDS.sub(" ", part)))
+    return any(word not in FILLER_WORDS for word in words)
+
+
+def _names_schema(part, schema_names):
+    """Whether a part mentions a column or table (or a word of one: "salary" for estimated_salary)."""
+    schema_tokens = set(tokenize(" ".join(schema_names)))
+    return any(token in schema_tokens for token in tokenize(MEASURE_WORDS.sub(" ", part)))
+
+
+def split_question(question, schema_names=None):
+    """
+    QueryPlan from the rules, or None when the question is not a set of independent parts.
+    schema_names (column and table names) lets every part be checked for a subject of its own.
+    """
+    text = re.sub(r"\s+", " ", question.lower()).strip().rstrip("?.! ")
+    plot_all = bool(PLOT_ALL.search(text))
+    text = PLOT_ALL.sub("", text).strip()
+    text = LEADING_VERB.sub("", text)
+
+    parts = [part.strip(" ,") for part in SEPARATORS.split(text) if part.strip(" ,")]
+    if len(parts) < 2 or len(parts) > MAX_SUB_QUESTIONS:
+        return None
+    if any(not MEASURE_WORDS.search(part) or REFERS_BACK.search(part) for part in parts):
+        return None
+    # "highest and lowest balance": "the highest" alone has no column to work on
+    if not all(_has_subject(part) for part in parts):
+        return None
+    # "how many customers have a balance of 0 and how many have more than 100000": the second part
+    # only makes sense with the first one's column
+    if schema_names and not all(_names_schema(part, schema_names) for part in parts):
+        return None
+    if any(FILTER_WORDS.search(part) for part in parts[:-1]):
+        return None
+    # "average balance and average salary by country": the grouping belongs to both, one query answers it
+    grouped = [bool(GROUPING.search(part)) for part in parts]
+    if grouped[-1] and not all(grouped):
+        return None
+    return dm.QueryPlan(sub_questions=parts, plot_all=plot_all, source="rules")
+
+
+PLANNING_INSTRUCTIONS = """
+You split a user's question about a database into independent sub-questions.
+
+Each sub-question must be answerable with one SQL query on its own, without the
+answer of another sub-question. Only split questions that ask for several unrelated
+results; a single aggregate with several columns or filters is one question.
+
+Reply with a JSON list of sub-questions, e.g. ["churn rate by country", "average balance by gender"].
+Reply with [] when the question should not be split.
+"""
+
+
+def llm_split_question(llm, question, schema_names=None):
+    compiler = PromptCompiler("planning")
+    compiler.add_static("instructions", PLANNING_INSTRUCTIONS)
+    compiler.set_question(f'Question to split: "{question}"')
+    response = scheduler.invoke(llm, [HumanMessage(content=compiler.compile())], stage="planning")
+    try:
+        parts = json.loads(re.search(r"\[.*\]", response.content, re.DOTALL).group(0))
+    except (AttributeError, ValueError):
+        return None
+    parts = [str(part).strip() for part in parts if str(part).strip()]
+    if not 2 <= len(parts) <= MAX_SUB_QUESTIONS or not all(_has_subject(part.lower()) for part in parts):
+        return None
+    if schema_names and not all(_names_schema(part, schema_names) for part in parts):
+        return None
+    plot_all = bool(PLOT_ALL.search(question.lower().strip().rstrip("?.! ")))
+    return dm.QueryPlan(sub_questions=parts, plot_all=plot_all, source="llm")
+
+
+def plan_question(question, llm=None, mode=None, schema_names=None):
+    """
+    QueryPlan with at least two sub-questions, or None to answer the question as a whole.
+    schema_names are the column and table names of the database, when known.
+    """
+    mode = QUESTION_PLANNER if mode is None else mode
+    if mode == "off":
+        return None
+    plan = split_question(question, schema_names)
+    if plan is None and mode == "llm" and llm is not None \
+            and COMPOUND_HINT.search(question.lower()) and len(MEASURE_WORDS.findall(question.lower())) >= 2:
+        plan = llm_split_question(llm, question, schema_names)
+    return plan
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show how questions are split, or check the regression examples")
+    parser.add_argument("question", nargs="?")
+    args = parser.parse_args()
+    if args.question:
+        print(split_question(args.question, EXAMPLE_SCHEMA))
+    else:
+        failed = 0
+        for question, expected in REGRESSION_EXAMPLES:
+            plan = split_question(question, EXAMPLE_SCHEMA)
+            got = plan.sub_questions if plan else None
+            ok = got == expected
+            failed += not ok
+            print(f"{'ok  ' if ok else 'FAIL'} {question!r} -> {got}")
+        raise SystemExit(1 if failed else 0)
@@ -1,10 +1,13 @@
-import matplotlib.pyplot as plt
+import threading
 import numpy as np
 import pandas as pd
 from typing import Tuple
 import utils.DataModels as dm
 # from models import ChartMetadata  # assumes ChartMetadata is defined elsewhere
 
+# pyplot keeps global figure state, so concurrent workers must not plot at the same time
+_pyplot_lock = threading.Lock()
+
 
 def normalize_chart_metadata(df: pd.DataFrame, metadata: dm.ChartMetadata) -> Tuple[pd.DataFrame, str, str]:
     """
@@ -43,8 +46,24 @@ def plot_chart(df: pd.DataFrame, metadata: dm.ChartMetadata):
         return None
 
     df, x, y = normalize_chart_metadata(df, metadata)
-    chart_type = metadata.chart_type
+    with _pyplot_lock:
+        return _draw_chart(df, metadata.chart_type, x, y)
+
+
+def figure_png(fig):
+    """Render a figure to PNG bytes and release it from pyplot."""
+    import io
+    import matplotlib.pyplot as plt
+    buffer = io.BytesIO()
+    with _pyplot_lock:
+        fig.savefig(buffer, format="png")
+        plt.close(fig)
+    return buffer.getvalue()
+
 
+def _draw_chart(df: pd.DataFrame, chart_type: str, x: str, y: str):
+    # pyplot is slow to import, so it is only loaded when the first chart is drawn
+    import matplotlib.pyplot as plt
     fig, ax = plt.subplots()
 
     if chart_type == 'pie':
@@ -0,0 +1,152 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Few-shot examples are trimmed to this many tokens per prompt (override with PROMPT_FEW_SHOT_BUDGET)
+DEFAULT_FEW_SHOT_BUDGET = int(os.environ.get("PROMPT_FEW_SHOT_BUDGET", "400"))
+
+_encoder = None
+_encoder_loaded = False
+
+
+def _get_encoder():
+    """Load the tiktoken encoder once; fall back to a heuristic if it is unavailable."""
+    global _encoder, _encoder_loaded
+    if not _encoder_loaded:
+        _encoder_loaded = True
+        try:
+            import tiktoken
+            _encoder = tiktoken.get_encoding("cl100k_base")
+        except Exception:
+            _encoder = None
+    return _encoder
+
+
+def count_tokens(text):
+    """Count tokens in text. Uses tiktoken when installed, otherwise ~4 chars per token."""
+    if not text:
+        return 0
+    encoder = _get_encoder()
+    if encoder is not None:
+        return len(encoder.encode(text))
+    return (len(text) + 3) // 4
+
+
+def trim_examples(examples, token_budget):
+    """
+    Keep examples in their given order until the token budget is used up.
+    The first example is always kept so a prompt never loses all its guidance.
+    """
+    kept = []
+    used = 0
+    for example in examples:
+        tokens = count_tokens(example)
+        if kept and used + tokens > token_budget:
+            break
+        kept.append(example)
+        used += tokens
+    return kept
+
+
+class PromptCompiler:
+    """
+    Assemble a prompt as a stable, cacheable prefix followed by the per-question tail.
+
+    Static sections (schema, column details, instructions, examples) are emitted
+    first in insertion order so providers can reuse their prefix cache across
+    questions; dynamic sections (data, retrieved context) follow, and the user
+    question always comes last.
+    """
+
+    def __init__(self, stage, few_shot_budget=None):
+        self.stage = stage
+        self.few_shot_budget = DEFAULT_FEW_SHOT_BUDGET if few_shot_budget is None else few_shot_budget
+        self.static_sections = []
+        self.dynamic_sections = []
+        self.question = None
+
+    def add_static(self, name, text):
+        self.static_sections.append((name, text.strip()))
+        return self
+
+    def add_examples(self, name, examples, header="## Examples:", dynamic=False):
+        """Fixed examples belong to the prefix; examples retrieved per question are dynamic."""
+        kept = trim_examples(examples, self.few_shot_budget)
+        if kept:
+            sections = self.dynamic_sections if dynamic else self.static_sections
+            sections.append((name, "\n".join([header] + kept)))
+        return self
+
+    def add_dynamic(self, name, text):
+        self.dynamic_sections.append((name, text.strip()))
+        return self
+
+    def set_question(self, text):
+        self.question = text.strip()
+        return self
+
+    def sections(self):
+        sections = self.static_sections + self.dynamic_sections
+        if self.question:
+            sections = sections + [("question", self.question)]
+        return sections
+
+    def compile(self):
+        """Return the prompt text and record its size report for this stage."""
+        prompt = "\n\n".join(text for _, text in self.sections() if text) + "\n"
+        record_prompt_report(self.stage, self.report())
+        return prompt
+
+    def report(self):
+        section_tokens = {name: count_tokens(text) for name, text in self.sections()}
+        static_tokens = sum(count_tokens(text) for _, text in self.static_sections)
+        return {
+            "stage": self.stage,
+            "sections": section_tokens,
+            "static_prefix_tokens": static_tokens,
+            "total_tokens": sum(section_tokens.values()),
+        }
+
+
+# Last prompt size report per stage, shared by every session in this process
+_reports_lock = threading.Lock()
+PROMPT_REPORTS = {}
+
+# Per-question collector, so one run can report its own prompt sizes
+_local = threading.local()
+
+
+@contextmanager
+def collect_prompt_reports():
+    """Collect the prompt reports compiled on this thread into a {stage: report} dict."""
+    reports = {}
+    previous = getattr(_local, "collector", None)
+    _local.collector = reports
+    try:
+        yield reports
+    finally:
+        _local.collector = previous
+
+
+def record_prompt_report(stage, report):
+    report = dict(report, recorded_at=time.time())
+    with _reports_lock:
+        PROMPT_REPORTS[stage] = report
+    collector = getattr(_local, "collector", None)
+    if collector is not None:
+        collector[stage] = report
+    print(f"prompt[{stage}] {report['total_tokens']} tokens "
+          f"(static prefix {report['static_prefix_tokens']}) {report['sections']}")
+
+
+def merge_prompt_reports(reports):
+    """Add reports collected on another thread (e.g. a speculative call) to this thread's collector."""
+    collector = getattr(_local, "collector", None)
+    if collector is not None:
+        collector.update(reports)
+
+
+def get_prompt_reports():
+    with _reports_lock:
+        return dict(PROMPT_REPORTS)
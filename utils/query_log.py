@@ -0,0 +1,183 @@
+"""
+Query log for generated SQL.
+
+Every query run by execute_sql_query is appended to db/query_log.jsonl with
+the question, the SQL, its normalised fingerprint, the EXPLAIN QUERY PLAN
+output, execution time, rows returned and bytes materialised. Queries over
+QUERY_LOG_SLOW_MS (or materialising more than QUERY_LOG_LARGE_BYTES) are
+flagged, so a slow answer can be traced to the query and the plan behind it.
+
+The fingerprint replaces literals with ? and normalises case and whitespace,
+so "WHERE age > 40" and "where age > 65" count as the same query. Run
+
+    python -m utils.query_log --top 10 --sort total
+
+to list the worst fingerprints by total, p95 or maximum time, or by count.
+Set QUERY_LOG=slow to keep only flagged queries, or QUERY_LOG=off.
+"""
+import argparse
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import defaultdict
+
+QUERY_LOG = os.environ.get("QUERY_LOG", "all")  # all, slow or off
+QUERY_LOG_PATH = "db/query_log.jsonl"
+SLOW_MS = float(os.environ.get("QUERY_LOG_SLOW_MS", "500"))
+LARGE_BYTES = int(os.environ.get("QUERY_LOG_LARGE_BYTES", str(50 * 1024 * 1024)))
+# Plans of very wide UNION views repeat the same steps; keep the first lines
+MAX_PLAN_LINES = 50
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?(?:e[+-]?\d+)?\b", re.IGNORECASE)
+_IN_LIST = re.compile(r"\bIN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)", re.IGNORECASE)
+_COMMENT = re.compile(r"--[^\n]*|/\*.*?\*/", re.DOTALL)
+
+_lock = threading.Lock()
+
+
+def normalize(sql):
+    """SQL with comments removed, literals replaced by ? and whitespace and case normalised."""
+    text = _COMMENT.sub(" ", sql or "")
+    text = _STRING.sub("?", text)
+    text = _NUMBER.sub("?", text)
+    text = _IN_LIST.sub("IN (?)", text)
+    text = re.sub(r"\s+", " ", text).strip().rstrip(";").strip()
+    return text.lower()
+
+
+def fingerprint(sql):
+    """Short stable ID of the normalised SQL."""
+    return hashlib.sha1(normalize(sql).encode("utf-8")).hexdigest()[:12]
+
+
+def explain_plan(conn, sql):
+    """EXPLAIN QUERY PLAN as indented lines, or [] when the query can't be planned on conn."""
+    try:
+        rows = conn.execute(f"EXPLAIN QUERY PLAN {sql}").fetchall()
+    except Exception:
+        return []
+    depth = {0: -1}
+    lines = []
+    for node_id, parent, _, detail in rows[:MAX_PLAN_LINES]:
+        depth[node_id] = depth.get(parent, -1) + 1
+        lines.append("  " * depth[node_id] + detail)
+    return lines
+
+
+def is_full_scan(plan):
+    """True when the plan scans a table without an index (SQLite says "SCAN t", not "SEARCH t USING INDEX")."""
+    return any(line.strip().startswith("SCAN ") and "USING" not in line and "SUBQUERY" not in line
+               for line in plan)
+
+
+def log_query(conn, question, sql, seconds, df=None, error=None, mode="direct", log_path=QUERY_LOG_PATH):
+    """Append one executed query to the query log. Returns the entry, or None when not logged."""
+    if QUERY_LOG == "off" or not log_path:
+        return None
+    rows = len(df) if df is not None else 0
+    size = int(df.memory_usage(deep=True).sum()) if df is not None else 0
+    slow = seconds * 1000 >= SLOW_MS
+    large = size >= LARGE_BYTES
+    if QUERY_LOG == "slow" and not (slow or large):
+        return None
+    entry = {
+        "ts": time.time(),
+        "question": question,
+        "sql": sql,
+        "fingerprint": fingerprint(sql),
+        "normalized": normalize(sql),
+        "mode": mode,
+        "ms": round(seconds * 1000, 2),
+        "rows": rows,
+        "bytes": size,
+        "slow": slow,
+        "large": large,
+        "error": error,
+        "plan": explain_plan(conn, sql) if conn is not None else [],
+    }
+    try:
+        os.makedirs(os.path.dirname(log_path), exist_ok=True)
+        with _lock:
+            with open(log_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, default=str) + "\n")
+    except OSError as e:
+        # Never fail a question because the log can't be written
+        print(f"could not write the query log: {e}")
+    if slow:
+        print(f"slow query ({entry['ms']:.0f} ms, {rows:,} rows, fingerprint {entry['fingerprint']})")
+    return entry
+
+
+def _read_log(log_path):
+    if not os.path.exists(log_path):
+        return
+    with open(log_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
+
+
+def report(log_path=QUERY_LOG_PATH, sort="total", top=10, slow_only=False):
+    """Per-fingerprint statistics from the query log, worst first."""
+    groups = defaultdict(list)
+    for entry in _read_log(log_path):
+        groups[entry["fingerprint"]].append(entry)
+
+    rows = []
+    for fp, entries in groups.items():
+        ms = sorted(e["ms"] for e in entries)
+        slow = sum(1 for e in entries if e.get("slow"))
+        if slow_only and not slow:
+            continue
+        latest = entries[-1]
+        rows.append({
+            "fingerprint": fp,
+            "normalized": latest["normalized"],
+            "count": len(entries),
+            "slow": slow,
+            "errors": sum(1 for e in entries if e.get("error")),
+            "total_ms": round(sum(ms), 1),
+            "p50_ms": ms[len(ms) // 2],
+            "p95_ms": ms[min(len(ms) - 1, int(len(ms) * 0.95))],
+            "max_ms": ms[-1],
+            "mean_rows": round(sum(e["rows"] for e in entries) / len(entries), 1),
+            "max_bytes": max(e["bytes"] for e in entries),
+            "full_scan": is_full_scan(latest.get("plan", [])),
+            "question": latest.get("question"),
+            "sql": latest["sql"],
+            "plan": latest.get("plan", []),
+        })
+    key = {"total": "total_ms", "p95": "p95_ms", "max": "max_ms", "count": "count"}[sort]
+    rows.sort(key=lambda row: row[key], reverse=True)
+    return rows[:top] if top else rows
+
+
+def _print_report(rows):
+    if not rows:
+        print("No queries logged yet.")
+    for rank, row in enumerate(rows, 1):
+        scan = " full scan" if row["full_scan"] else ""
+        print(f"{rank}. {row['fingerprint']}  count={row['count']} slow={row['slow']} errors={row['errors']} "
+              f"total={row['total_ms']}ms p50={row['p50_ms']}ms p95={row['p95_ms']}ms max={row['max_ms']}ms "
+              f"rows={row['mean_rows']} bytes={row['max_bytes']:,}{scan}")
+        print(f"   question: {row['question']}")
+        print(f"   sql: {row['sql']}")
+        for line in row["plan"]:
+            print(f"   plan: {line}")
+        print()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Top queries by fingerprint from the query log")
+    parser.add_argument("log_path", nargs="?", default=QUERY_LOG_PATH)
+    parser.add_argument("--sort", choices=["total", "p95", "max", "count"], default="total")
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--slow", action="store_true", help="Only fingerprints with slow executions")
+    args = parser.parse_args()
+    _print_report(report(args.log_path, args.sort, args.top, args.slow))
@@ -0,0 +1,305 @@
+import json
+import math
+import os
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+import utils.DataModels as dm
+from utils.data_profile import summarize
+
+# Local routing decides "does this question need SQL?" without an LLM round trip.
+# Rules run first; a tiny naive Bayes model trained on logged LLM decisions covers
+# the rest; only decisions below ROUTER_CONFIDENCE_THRESHOLD fall back to the LLM.
+ROUTER_CONFIDENCE_THRESHOLD = float(os.environ.get("ROUTER_CONFIDENCE_THRESHOLD", "0.8"))
+ROUTING_LOG_PATH = "db/routing_log.jsonl"
+MIN_TRAINING_EXAMPLES = 20
+RETRAIN_EVERY = 10
+
+# Questions about the table itself, answered from the cached schema
+METADATA_PATTERNS = [
+    ("columns", re.compile(r"\b(what|which|list|show)\b.*\b(columns|fields|attributes)\b|\bschema\b|\bstructure of the (table|data|dataset)\b")),
+    ("about", re.compile(r"\bwhat\b.*\b(data|dataset|table|database)\b.*\b(about|contain|contains|hold|holds)\b")),
+    ("describe_column", re.compile(r"\bwhat\b.*\b(does|do|is)\b.*\b(mean|means|represent|represents|stand for|defined)\b")),
+]
+
+# Questions about column statistics, answered from the column profile stored at import
+PROFILE_PATTERNS = [
+    ("values", re.compile(r"\b(distinct|unique|possible|different)\s+(values|categories)\b|\b(what|which)\s+(values|categories)\b")),
+    ("range", re.compile(r"\brange of\b|\bvalue range\b|\b(min|minimum)\s+and\s+(max|maximum)\b")),
+    ("missing", re.compile(r"\b(missing|null|empty)\s+values?\b|\bnulls\b|\bany (missing|nulls?)\b")),
+]
+# "What does credit_score mean?": here "mean" is the verb, not the statistic
+DEFINITION_PATTERN = re.compile(
+    r"\bwhat (does|do)\b.*\b(mean|represent|stand for)\W*$|\bwhat\b.*\b(represents|stands for)\W*$")
+# Filters or grouping turn these into data questions
+SCOPED_WORDS = re.compile(r"\b(by|per|where|who|whose|each|grouped|among|between|across)\b")
+
+# Anything that needs actual data values
+DATA_PATTERNS = re.compile(
+    r"\b(how many|count|number of|average|avg|mean|median|sum|total|max|maximum|min|minimum|"
+    r"highest|lowest|top|bottom|most|least|plot|chart|graph|histogram|distribution|compare|"
+    r"comparison|percent|percentage|ratio|rate|trend|per|group|grouped|breakdown|std|"
+    r"standard deviation|variance|correlation|summari[sz]e|which customers|"
+    r"greater than|less than|more than|over|under|between|older|younger)\b"
+)
+# Words that appear in metadata and chat questions too ("list the columns", "list what I asked")
+LISTING_WORDS = re.compile(r"\b(list|show me)\b")
+COLUMN_WORDS = re.compile(r"\b(columns?|fields?|attributes?)\b")
+
+
+def _normalize(question):
+    return re.sub(r"\s+", " ", question.lower()).strip()
+
+
+def _mentioned_columns(question, columns):
+    text = _normalize(question)
+    mentioned = []
+    for name, _ in columns:
+        variants = {name.lower(), name.lower().replace("_", " ")}
+        if any(re.search(rf"\b{re.escape(v)}\b", text) for v in variants):
+            mentioned.append(name)
+    return mentioned
+
+
+def _mentioned_values(question, profile):
+    """Listed column values ("Spain", "Female") named in the question."""
+    text = _normalize(question)
+    return [str(value) for column in (profile or {}).values() if column.kind not in ("encrypted", "blind_index")
+            for value, _ in column.top_values
+            if isinstance(value, str) and len(value) > 1 and re.search(rf"\b{re.escape(value.lower())}\b", text)]
+
+
+def _profile_value(value):
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return str(value)
+    return f"{int(number):,}" if number.is_integer() else f"{number:,.2f}"
+
+
+def answer_profile_question(kind, question, profile):
+    """Answer a question about column values, ranges or missing values from the column profile."""
+    mentioned = _mentioned_columns(question, [(name, None) for name in profile])
+    mentioned += [name for name in _mentioned_columns(
+        question, [(name[:-len("_encrypted")], None) for name in profile if name.endswith("_encrypted")])
+        if name not in mentioned]
+    # "credit card type" also matches credit_card; keep the longest column
+    mentioned = [name for name in mentioned if not any(other != name and other.startswith(name) for other in mentioned)]
+    lines = []
+    for name in mentioned:
+        column = profile.get(name) or profile[f"{name}_encrypted"]
+        if kind == "missing":
+            lines.append(f"{name} has no missing values." if not column.null_count else
+                         f"{name} has {column.null_count:,} missing values out of {column.row_count:,}.")
+        elif column.kind in ("encrypted", "blind_index"):
+            lines.append(f"{name} is encrypted, so its values are not shown ({column.distinct_count:,} distinct values).")
+        elif kind == "values" and column.top_values:
+            listing = ", ".join(f"{value} ({count:,})" for value, count in column.top_values)
+            if column.distinct_count <= len(column.top_values):
+                lines.append(f"{name} has {column.distinct_count} distinct values: {listing}.")
+            else:
+                lines.append(f"{name} has {column.distinct_count:,} distinct values; the most common are {listing}.")
+        elif column.min_value is not None:
+            line = (f"{name} ranges from {_profile_value(column.min_value)} to {_profile_value(column.max_value)}"
+                    if column.kind != "datetime" else f"{name} ranges from {column.min_value} to {column.max_value}")
+            if column.mean is not None:
+                line += f" (mean {_profile_value(column.mean)})"
+            if kind == "values":
+                line += f", with {column.distinct_count:,} distinct values"
+            lines.append(line + ".")
+    return "\n".join(lines)
+
+
+def answer_metadata_question(kind, question, columns, descriptions, table_name="customer_data", profile=None):
+    """Build a direct answer for a schema/metadata question from the cached schema."""
+    column_names = [name for name, _ in columns]
+    if kind == "columns":
+        listing = "\n".join(f"- {name} ({dtype})" for name, dtype in columns)
+        return f"The {table_name} table has {len(columns)} columns:\n{listing}"
+
+    if kind == "describe_column":
+        mentioned = _mentioned_columns(question, columns)
+        if not mentioned and COLUMN_WORDS.search(_normalize(question)):
+            # "What does each column mean?"
+            mentioned = column_names
+        described = [f"- {name}: {descriptions[name]}" + (f" ({summarize(profile[name])})" if name in (profile or {}) else "")
+                     for name in mentioned if name in descriptions]
+        if described:
+            return "\n".join(described)
+        return ""
+
+    if kind == "about":
+        return (f"The {table_name} table contains customer bank activity and churn information "
+                f"with the columns: {', '.join(column_names)}.")
+    return ""
+
+
+def rule_based_decision(question, columns, descriptions, table_name="customer_data", profile=None):
+    """Keyword/regex routing. Returns a RoutingDecision, or None when the rules have no opinion."""
+    text = _normalize(question)
+
+    if profile:
+        for kind, pattern in PROFILE_PATTERNS:
+            if pattern.search(text) and not SCOPED_WORDS.search(text):
+                answer = answer_profile_question(kind, question, profile)
+                if answer:
+                    return dm.RoutingDecision(needs_sql=False, confidence=0.95, answer=answer, source="rules")
+
+    if DEFINITION_PATTERN.search(text):
+        answer = answer_metadata_question("describe_column", question, columns, descriptions, table_name, profile)
+        if answer:
+            return dm.RoutingDecision(needs_sql=False, confidence=0.95, answer=answer, source="rules")
+        # Most likely not about the data, but only the LLM can write the answer
+        return dm.RoutingDecision(needs_sql=False, confidence=0.5, source="rules")
+
+    # "what does the data contain for customers in spain" is about rows, not the schema
+    about_rows = SCOPED_WORDS.search(text) or _mentioned_values(question, profile)
+    for kind, pattern in METADATA_PATTERNS:
+        if not pattern.search(text) or DATA_PATTERNS.search(text) or about_rows:
+            continue
+        # A column named in a schema question makes it a data question; describing it is the point otherwise
+        if kind != "describe_column" and _mentioned_columns(question, columns):
+            continue
+        answer = answer_metadata_question(kind, question, columns, descriptions, table_name, profile)
+        if answer:
+            return dm.RoutingDecision(needs_sql=False, confidence=0.95, answer=answer, source="rules")
+
+    data_hit = DATA_PATTERNS.search(text)
+    mentioned = _mentioned_columns(question, columns)
+    if data_hit and mentioned:
+        return dm.RoutingDecision(needs_sql=True, confidence=0.95, source="rules")
+    if data_hit or (LISTING_WORDS.search(text) and mentioned):
+        return dm.RoutingDecision(needs_sql=True, confidence=0.85, source="rules")
+    if mentioned:
+        # A column is mentioned but no analytic verb: most likely still a data question
+        return dm.RoutingDecision(needs_sql=True, confidence=0.7, source="rules")
+    if LISTING_WORDS.search(text):
+        # "List last few things I asked": listing words alone may be about the chat, not the data
+        return dm.RoutingDecision(needs_sql=True, confidence=0.6, source="rules")
+    return None
+
+
+def _tokenize(text):
+    return re.findall(r"[a-z_]+", text.lower())
+
+
+class NaiveBayesRouter:
+    """
+    Multinomial naive Bayes over question words with a scikit-learn style
+    fit / predict_proba / predict interface. Kept dependency free so the
+    router works without scikit-learn installed.
+    """
+
+    def __init__(self, alpha=1.0):
+        self.alpha = alpha
+        self.classes_ = []
+        self.class_log_prior_ = {}
+        self.word_counts_ = {}
+        self.class_totals_ = {}
+        self.vocabulary_ = set()
+
+    def fit(self, questions, labels):
+        class_docs = Counter(labels)
+        self.classes_ = sorted(class_docs)
+        self.word_counts_ = defaultdict(Counter)
+        self.vocabulary_ = set()
+        for question, label in zip(questions, labels):
+            tokens = _tokenize(question)
+            self.word_counts_[label].update(tokens)
+            self.vocabulary_.update(tokens)
+        total_docs = sum(class_docs.values())
+        self.class_log_prior_ = {c: math.log(class_docs[c] / total_docs) for c in self.classes_}
+        self.class_totals_ = {c: sum(self.word_counts_[c].values()) for c in self.classes_}
+        return self
+
+    def predict_proba(self, questions):
+        vocab_size = max(len(self.vocabulary_), 1)
+        probabilities = []
+        for question in questions:
+            scores = {}
+            for c in self.classes_:
+                denominator = self.class_totals_[c] + self.alpha * vocab_size
+                score = self.class_log_prior_[c]
+                for token in _tokenize(question):
+                    if token in self.vocabulary_:
+                        score += math.log((self.word_counts_[c][token] + self.alpha) / denominator)
+                scores[c] = score
+            peak = max(scores.values())
+            exp_scores = {c: math.exp(s - peak) for c, s in scores.items()}
+            norm = sum(exp_scores.values())
+            probabilities.append([exp_scores[c] / norm for c in self.classes_])
+        return probabilities
+
+    def predict(self, questions):
+        return [self.classes_[row.index(max(row))] for row in self.predict_proba(questions)]
+
+
+_model_lock = threading.Lock()
+_model = None
+_model_trained_on = 0
+_log_size_seen = None
+
+
+def log_routing_decision(question, needs_sql, source="llm", log_path=ROUTING_LOG_PATH):
+    """Append a routing decision to the training log."""
+    os.makedirs(os.path.dirname(log_path), exist_ok=True)
+    with _model_lock:
+        with open(log_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"ts": time.time(), "question": question,
+                                "needs_sql": bool(needs_sql), "source": source}) + "\n")
+
+
+def _load_training_data(log_path):
+    questions, labels = [], []
+    if not os.path.exists(log_path):
+        return questions, labels
+    with open(log_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            # Only learn from decisions made by the LLM, never from our own guesses
+            if entry.get("source") == "llm":
+                questions.append(entry["question"])
+                labels.append(bool(entry["needs_sql"]))
+    return questions, labels
+
+
+def get_routing_model(log_path=ROUTING_LOG_PATH):
+    """Return the trained model, (re)training it from the log when enough new decisions exist."""
+    global _model, _model_trained_on, _log_size_seen
+    with _model_lock:
+        # Only re-read the log when it has grown since the last check
+        log_size = os.path.getsize(log_path) if os.path.exists(log_path) else 0
+        if log_size == _log_size_seen:
+            return _model
+        _log_size_seen = log_size
+        questions, labels = _load_training_data(log_path)
+        enough = len(questions) >= MIN_TRAINING_EXAMPLES and len(set(labels)) == 2
+        if enough and (_model is None or len(questions) - _model_trained_on >= RETRAIN_EVERY):
+            _model = NaiveBayesRouter().fit(questions, labels)
+            _model_trained_on = len(questions)
+        return _model
+
+
+def route_question(question, columns, descriptions, table_name="customer_data", log_path=ROUTING_LOG_PATH,
+                   profile=None):
+    """Decide locally whether a question needs SQL; the caller falls back to the LLM when not confident."""
+    decision = rule_based_decision(question, columns, descriptions, table_name, profile)
+    if decision is not None and decision.confidence >= ROUTER_CONFIDENCE_THRESHOLD:
+        return decision
+
+    model = get_routing_model(log_path)
+    if model is not None:
+        probabilities = model.predict_proba([question])[0]
+        best = probabilities.index(max(probabilities))
+        needs_sql = model.classes_[best]
+        # The model can only say "yes" locally; a "no" needs an answer text, which only the LLM writes
+        if needs_sql:
+            return dm.RoutingDecision(needs_sql=True, confidence=probabilities[best], source="model")
+
+    if decision is not None:
+        return decision
+    return dm.RoutingDecision(needs_sql=True, confidence=0.0, source="rules")
@@ -0,0 +1,266 @@
+"""
+Approximate answers from sample tables.
+
+The import stores customer_data_sample, a Bernoulli sample of customer_data
+with a _weight column (1 / inclusion probability), and one stratified sample
+per column in APPROX_STRATIFY_COLUMNS in which small strata are oversampled.
+
+execute_approximate() runs an aggregate query on a sample: COUNT becomes
+SUM(_weight), SUM(x) becomes SUM(x * _weight) and AVG the weighted mean.
+Every column that is a single COUNT, SUM or AVG gets a <column>_ci95 column
+with the half-width of its 95% confidence interval, from the Horvitz-Thompson
+variance sum(w * (w - 1) * y^2), which is unbiased under Bernoulli sampling.
+MIN and MAX are read from the sample as is and carry no interval. ROUND and
+CAST around a single aggregate are looked through: ROUND(AVG(x), 2) gets the
+interval of AVG(x), rounded the same way.
+"""
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+from utils.sql_parse import IDENTIFIER, aggregate_calls, mask, parse_single_table_select, split_alias, split_top_level
+
+SOURCE_TABLE = "customer_data"
+SAMPLE_TABLE = "customer_data_sample"
+SAMPLE_INFO_TABLE = "sample_info"
+SAMPLE_FRACTION = float(os.environ.get("APPROX_SAMPLE_FRACTION", "0.05"))
+MIN_SAMPLE_ROWS = int(os.environ.get("APPROX_MIN_SAMPLE_ROWS", "2000"))
+MIN_STRATUM_ROWS = int(os.environ.get("APPROX_MIN_STRATUM_ROWS", "500"))
+STRATIFY_COLUMNS = [c.strip() for c in os.environ.get("APPROX_STRATIFY_COLUMNS", "country,gender").split(",") if c.strip()]
+Z_95 = 1.96
+
+
+def _stratum_sizes(conn, column):
+    return dict(conn.execute(f'SELECT "{column}", COUNT(*) FROM {SOURCE_TABLE} GROUP BY "{column}"').fetchall())
+
+
+def build_samples(conn, seed=None, chunk_size=10000):
+    """
+    Write the uniform and stratified sample tables of customer_data into `conn`.
+
+    The table is read in chunks and every chunk is Bernoulli sampled on its own; the
+    stratum sizes the stratified rates need come from a GROUP BY per column first.
+    """
+    rng = np.random.default_rng(seed)
+    conn.execute(f"DROP TABLE IF EXISTS {SAMPLE_INFO_TABLE}")
+    conn.execute(f"CREATE TABLE {SAMPLE_INFO_TABLE} (table_name TEXT, stratify_column TEXT, "
+                 "sample_rows INTEGER, population_rows INTEGER)")
+    population = conn.execute(f"SELECT COUNT(*) FROM {SOURCE_TABLE}").fetchone()[0]
+    if not population:
+        conn.commit()
+        return
+
+    rate = min(1.0, max(SAMPLE_FRACTION, MIN_SAMPLE_ROWS / population))
+    columns = [d[0] for d in conn.execute(f"SELECT * FROM {SOURCE_TABLE} LIMIT 0").description]
+    # (table, stratify column, {stratum: size}); the uniform sample has no strata
+    samples = [(SAMPLE_TABLE, None, None)] + [
+        (f"{SAMPLE_TABLE}_by_{column}", column, _stratum_sizes(conn, column))
+        for column in STRATIFY_COLUMNS if column in columns]
+    kept = {table_name: [] for table_name, _, _ in samples}
+    for chunk in pd.read_sql_query(f"SELECT * FROM {SOURCE_TABLE}", conn, chunksize=chunk_size):
+        for table_name, column, sizes in samples:
+            if sizes is None:
+                rates = np.full(len(chunk), rate)
+            else:
+                # Every stratum gets at least MIN_STRATUM_ROWS rows (or all of its rows)
+                stratum_sizes = chunk[column].map(sizes).fillna(population).to_numpy(dtype=float)
+                rates = np.minimum(1.0, np.maximum(rate, MIN_STRATUM_ROWS / stratum_sizes))
+            keep = rng.random(len(chunk)) < rates
+            sample = chunk[keep].copy()
+            sample["_weight"] = 1.0 / rates[keep]
+            kept[table_name].append(sample)
+
+    for table_name, column, _ in samples:
+        sample = pd.concat(kept.pop(table_name), ignore_index=True)
+        sample.to_sql(table_name, conn, if_exists="replace", index=False)
+        conn.execute(f"INSERT INTO {SAMPLE_INFO_TABLE} VALUES (?, ?, ?, ?)",
+                     (table_name, column, len(sample), population))
+    conn.commit()
+
+
+def _sample_tables(conn):
+    try:
+        rows = conn.execute(f"SELECT table_name, stratify_column, sample_rows, population_rows "
+                            f"FROM {SAMPLE_INFO_TABLE}").fetchall()
+    except Exception:
+        return []
+    return [{"sample_table": r[0], "stratified_by": r[1], "sample_rows": r[2], "population_rows": r[3]}
+            for r in rows]
+
+
+def _choose_sample(samples, clauses):
+    """A sample stratified on a grouped or filtered column, else the uniform one."""
+    referenced = " ".join(clauses.get(k) or "" for k in ("group by", "where", "select")).lower()
+    for sample in samples:
+        column = sample["stratified_by"]
+        if column and re.search(rf"\b{re.escape(column.lower())}\b", referenced):
+            return sample
+    return next((s for s in samples if not s["stratified_by"]), None)
+
+
+_WRAPPER = re.compile(r"^(ROUND|CAST)\s*\((.*)\)$", re.IGNORECASE | re.DOTALL)
+
+
+def _balanced(text):
+    depth = 0
+    for ch in mask(text, mask_parens=False):
+        depth += {"(": 1, ")": -1}.get(ch, 0)
+        if depth < 0:
+            return False
+    return depth == 0
+
+
+def _unwrap(expr):
+    """The expression inside ROUND(...) / CAST(... AS type) wrappers, and the ROUND digits (None if not rounded)."""
+    digits = None
+    while True:
+        match = _WRAPPER.match(expr.strip())
+        if not match or not _balanced(match.group(2)):
+            # "ROUND(a) + ROUND(b)" is not one wrapper
+            return expr, digits
+        if match.group(1).upper() == "ROUND":
+            arguments = split_top_level(match.group(2))
+            if len(arguments) > 2:
+                return expr, digits
+            if digits is None:
+                digits = int(arguments[1]) if len(arguments) == 2 and arguments[1].isdigit() else 0
+            expr = arguments[0]
+        else:
+            cast = list(re.finditer(r"\s+AS\s+", mask(match.group(2)), re.IGNORECASE))
+            if not cast:
+                return expr, digits
+            expr = match.group(2)[:cast[-1].start()]
+
+
+def _rewrite(clauses, sample_table):
+    """Sample SQL plus the interval columns to derive: [(label, kind, hidden column names)]."""
+    if re.match(r"DISTINCT\b", clauses.get("select") or "", re.IGNORECASE):
+        raise ValueError("SELECT DISTINCT")
+    w = "_weight"
+
+    def present(argument, value):
+        return value if argument == "*" else f"CASE WHEN ({argument}) IS NOT NULL THEN {value} END"
+
+    def estimate(function, argument):
+        if function == "COUNT":
+            return f"SUM({present(argument, w)})"
+        if function == "SUM":
+            return f"SUM(({argument}) * {w})"
+        if function == "AVG":
+            return f"(SUM(({argument}) * {w}) / SUM({present(argument, w)}))"
+        return f"{function}({argument})"
+
+    def rewrite(expr):
+        for start, end, function, argument in reversed(aggregate_calls(expr)):
+            expr = expr[:start] + estimate(function, argument) + expr[end:]
+        return expr
+
+    items, hidden, intervals = [], [], []
+    found_aggregate = False
+    for item in split_top_level(clauses["select"]):
+        expr, alias = split_alias(item)
+        calls = aggregate_calls(expr)
+        if not calls:
+            items.append(item)
+            continue
+        found_aggregate = True
+        label = alias or (expr if IDENTIFIER.match(expr) else '"' + expr.replace('"', '""') + '"')
+        items.append(f"{rewrite(expr)} AS {label}")
+
+        inner, digits = _unwrap(expr)
+        calls = aggregate_calls(inner)
+        if len(calls) != 1:
+            continue
+        start, end, function, argument = calls[0]
+        if inner[:start].strip() or inner[end:].strip() or function in ("MIN", "MAX"):
+            continue  # compound expressions and MIN/MAX get no interval
+        k = len(intervals)
+        var_weight = f"{w} * ({w} - 1)"
+        if function == "COUNT":
+            hidden.append(f"SUM({present(argument, var_weight)}) AS __ci{k}_var")
+            names = [f"__ci{k}_var"]
+        elif function == "SUM":
+            hidden.append(f"SUM({var_weight} * ({argument}) * ({argument})) AS __ci{k}_var")
+            names = [f"__ci{k}_var"]
+        else:
+            # Linearised variance of the ratio mean: (A - 2RB + R^2 C) / N^2
+            hidden += [f"SUM({var_weight} * ({argument}) * ({argument})) AS __ci{k}_a",
+                       f"SUM({var_weight} * ({argument})) AS __ci{k}_b",
+                       f"SUM({present(argument, var_weight)}) AS __ci{k}_c",
+                       f"SUM({present(argument, w)}) AS __ci{k}_n"]
+            names = [f"__ci{k}_a", f"__ci{k}_b", f"__ci{k}_c", f"__ci{k}_n"]
+            if inner != expr:
+                # The shown estimate is rounded or cast; the variance needs the exact one
+                hidden.append(f"{estimate(function, argument)} AS __ci{k}_r")
+                names.append(f"__ci{k}_r")
+        column = alias.strip('"`[]') if alias else expr
+        intervals.append((column, function, names, digits))
+    if not found_aggregate:
+        raise ValueError("no aggregates")
+
+    sql = f"SELECT {', '.join(items + hidden)} FROM {sample_table}"
+    if clauses.get("where"):
+        sql += f" WHERE {clauses['where']}"
+    if clauses.get("group by"):
+        sql += f" GROUP BY {clauses['group by']}"
+    if clauses.get("having"):
+        sql += f" HAVING {rewrite(clauses['having'])}"
+    if clauses.get("order by"):
+        sql += f" ORDER BY {rewrite(clauses['order by'])}"
+    if clauses.get("limit"):
+        sql += f" LIMIT {clauses['limit']}"
+    return sql, intervals
+
+
+def _add_intervals(df, intervals):
+    for label, function, names, digits in intervals:
+        if function == "AVG":
+            a, b, c, n = (df[name].astype(float) for name in names[:4])
+            r = df[names[4] if len(names) > 4 else label].astype(float)
+            variance = (a - 2 * r * b + r * r * c) / (n * n)
+        else:
+            variance = df[names[0]].astype(float)
+        ci = Z_95 * np.sqrt(variance.clip(lower=0))
+        if digits is not None:
+            ci = ci.round(digits)
+        df.insert(df.columns.get_loc(label) + 1, f"{label}_ci95", ci)
+        df.drop(columns=names, inplace=True)
+    return df
+
+
+def execute_approximate(conn, sql):
+    """
+    Run an aggregate query on the best sample table. Returns a DataFrame with
+    df.attrs["approximation"] describing the sample, or None when the query is
+    not an aggregate over customer_data or no sample exists (run it exactly then).
+    """
+    clauses = parse_single_table_select(sql, SOURCE_TABLE)
+    samples = _sample_tables(conn) if clauses else []
+    sample = _choose_sample(samples, clauses) if samples else None
+    if sample is None:
+        return None
+    try:
+        sample_sql, intervals = _rewrite(clauses, sample["sample_table"])
+        df = _add_intervals(pd.read_sql_query(sample_sql, conn), intervals)
+    except Exception as e:
+        print(f"approximate query not possible ({e}), running it exactly")
+        return None
+    print(f"approximate query on {sample['sample_table']}\n{sample_sql}")
+    df.attrs["approximation"] = dict(sample, fraction=sample["sample_rows"] / max(sample["population_rows"], 1),
+                                     confidence=0.95)
+    # The query log records the SQL that actually ran
+    df.attrs["executed_sql"] = sample_sql
+    return df
+
+
+def approximation_note(approximation):
+    """Sentence for the analysis prompt that explains the estimates and their intervals."""
+    stratified = f", stratified by {approximation['stratified_by']}" if approximation["stratified_by"] else ""
+    return (
+        f"These figures are estimates from a random sample of {approximation['sample_rows']:,} rows "
+        f"({approximation['fraction']:.1%} of {approximation['population_rows']:,}{stratified}). "
+        "A column ending in _ci95 holds the half-width of the 95% confidence interval of the column before it: "
+        "the true value lies within estimate ± ci95. Say that the answer is approximate and quote the intervals."
+    )
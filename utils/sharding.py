@@ -0,0 +1,355 @@
+"""
+Optional sharded storage for customer_data.
+
+With SHARD_MODE=country or SHARD_MODE=hash the import splits customer_data
+across several SQLite files next to the snapshot (v3.db -> v3.shard0.db, ...)
+and records them in a shard_manifest table inside the snapshot itself.
+
+Connections opened through connect() ATTACH the shards and expose a TEMP view
+named customer_data over all of them, so every existing query still works.
+execute_sharded() picks a faster path where it can:
+
+- single: the WHERE clause pins the shard key to one shard, run the query there
+- scatter: COUNT/SUM/AVG/MIN/MAX with optional GROUP BY run on every shard in
+  parallel and the partial results are merged in an in-memory database
+- union: anything else runs against the union view
+"""
+import glob
+import json
+import os
+import re
+import sqlite3
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+import pandas as pd
+
+from utils import blind_index
+from utils.sql_parse import (
+    IDENTIFIER, aggregate_calls, mask, normalise, parse_single_table_select, split_alias, split_top_level,
+)
+
+SHARD_MODES = ("off", "country", "hash")
+SHARD_MODE = os.environ.get("SHARD_MODE", "off")
+SHARD_COUNT = int(os.environ.get("SHARD_COUNT", "4"))
+# SQLite attaches at most 10 databases per connection by default
+MAX_SHARDS = 8
+SHARDED_TABLE = "customer_data"
+MANIFEST_TABLE = "shard_manifest"
+SHARD_KEYS = {"country": "country", "hash": "customer_id"}
+
+_shard_pool = ThreadPoolExecutor(max_workers=MAX_SHARDS, thread_name_prefix="shard")
+_manifest_cache = {}
+
+
+def shard_path(db_path, shard_id):
+    root, _ = os.path.splitext(db_path)
+    return f"{root}.shard{shard_id}.db"
+
+
+def shard_files(db_path):
+    root, _ = os.path.splitext(db_path)
+    return sorted(glob.glob(f"{glob.escape(root)}.shard*.db"))
+
+
+def shard_of_hash(value, shard_count):
+    """Stable shard of a customer_id, the same across processes and runs."""
+    return zlib.crc32(str(value).encode()) % shard_count
+
+
+@dataclass
+class Shard:
+    shard_id: int
+    path: str
+    key_values: List[str] = field(default_factory=list)
+    row_count: int = 0
+
+
+@dataclass
+class ShardManifest:
+    mode: str
+    shard_key: str
+    shards: List[Shard]
+
+    def shards_for(self, values):
+        """Shards that can hold any of the given shard key values."""
+        if self.mode == "hash":
+            ids = {shard_of_hash(v, len(self.shards)) for v in values}
+        else:
+            ids = {s.shard_id for s in self.shards if set(s.key_values) & set(values)}
+        return [s for s in self.shards if s.shard_id in ids]
+
+
+class ShardWriter:
+    """Partition chunks of customer_data across shard files while an import runs."""
+
+    def __init__(self, db_path, mode=SHARD_MODE, shard_count=SHARD_COUNT):
+        if mode not in SHARD_MODES or mode == "off":
+            raise ValueError(f"SHARD_MODE must be one of {SHARD_MODES[1:]} to write shards, got {mode!r}")
+        self.db_path = db_path
+        self.mode = mode
+        self.shard_key = SHARD_KEYS[mode]
+        self.shards = [Shard(i, shard_path(db_path, i)) for i in range(max(1, min(shard_count, MAX_SHARDS)))]
+        self._conns = [sqlite3.connect(s.path) for s in self.shards]
+        self._assignment = {}
+        self._empty = None
+
+    def _shard_ids(self, keys):
+        if self.mode == "hash":
+            return [shard_of_hash(k, len(self.shards)) for k in keys]
+        keys = keys.astype(str)
+        load = {s.shard_id: s.row_count for s in self.shards}
+        for key, rows in keys.value_counts().items():
+            if key not in self._assignment:
+                # New countries go to the emptiest shard so shards stay balanced
+                target = min(load, key=load.get)
+                self._assignment[key] = target
+                self.shards[target].key_values.append(key)
+            load[self._assignment[key]] += rows
+        return keys.map(self._assignment).tolist()
+
+    def write(self, df):
+        shard_ids = pd.Series(self._shard_ids(df[self.shard_key]), index=df.index)
+        for shard_id, part in df.groupby(shard_ids, sort=False):
+            part.to_sql(SHARDED_TABLE, self._conns[shard_id], if_exists="append", index=False)
+            self.shards[shard_id].row_count += len(part)
+        self._empty = df.head(0)
+
+    def close(self, main_conn, index_columns=()):
+        """Commit the shards, index them and record them in the snapshot's manifest table."""
+        for shard, conn in zip(self.shards, self._conns):
+            # Every shard needs the table, or the union view cannot be created
+            if shard.row_count == 0 and self._empty is not None:
+                self._empty.to_sql(SHARDED_TABLE, conn, if_exists="append", index=False)
+            blind_index.create_indexes(conn, index_columns, SHARDED_TABLE)
+            conn.commit()
+            conn.close()
+        main_conn.execute(
+            f"CREATE TABLE {MANIFEST_TABLE} (shard_id INTEGER, file TEXT, mode TEXT, "
+            "shard_key TEXT, key_values TEXT, row_count INTEGER)")
+        main_conn.executemany(
+            f"INSERT INTO {MANIFEST_TABLE} VALUES (?, ?, ?, ?, ?, ?)",
+            [(s.shard_id, os.path.basename(s.path), self.mode, self.shard_key,
+              json.dumps(s.key_values), s.row_count) for s in self.shards])
+        main_conn.commit()
+
+    def abort(self):
+        for conn in self._conns:
+            conn.close()
+        for shard in self.shards:
+            if os.path.exists(shard.path):
+                os.remove(shard.path)
+
+
+def load_manifest(db_path):
+    """ShardManifest of a snapshot, or None when it is not sharded. Cached per file version."""
+    if not db_path or not os.path.exists(db_path):
+        return None
+    cache_key = (db_path, os.path.getmtime(db_path))
+    if cache_key in _manifest_cache:
+        return _manifest_cache[cache_key]
+
+    manifest = None
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    try:
+        rows = conn.execute(
+            f"SELECT shard_id, file, mode, shard_key, key_values, row_count FROM {MANIFEST_TABLE} "
+            "ORDER BY shard_id").fetchall()
+        directory = os.path.dirname(db_path)
+        shards = [Shard(r[0], os.path.join(directory, r[1]), json.loads(r[4]), r[5]) for r in rows]
+        if shards:
+            manifest = ShardManifest(rows[0][2], rows[0][3], shards)
+    except sqlite3.OperationalError:
+        pass  # no manifest table: a single-file snapshot
+    finally:
+        conn.close()
+    _manifest_cache[cache_key] = manifest
+    return manifest
+
+
+def attach_shards(conn, db_path):
+    """ATTACH the shards of a sharded snapshot and expose them as one customer_data view."""
+    manifest = load_manifest(db_path)
+    if manifest is None:
+        return conn
+    for shard in manifest.shards:
+        conn.execute("ATTACH DATABASE ? AS ?", (shard.path, f"shard{shard.shard_id}"))
+    union = " UNION ALL ".join(f"SELECT * FROM shard{s.shard_id}.{SHARDED_TABLE}" for s in manifest.shards)
+    conn.execute(f"CREATE TEMP VIEW IF NOT EXISTS {SHARDED_TABLE} AS {union}")
+    return conn
+
+
+def connect(db_path, read_only=False, check_same_thread=True):
+    """Open a connection to a snapshot; sharded snapshots get their shards attached."""
+    if read_only:
+        conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, check_same_thread=check_same_thread)
+    else:
+        conn = sqlite3.connect(db_path, check_same_thread=check_same_thread)
+    blind_index.register(conn)
+    return attach_shards(conn, db_path)
+
+
+def table_info(conn, table_name=SHARDED_TABLE):
+    """PRAGMA table_info rows; for sharded tables read from a shard since the view has no declared types."""
+    schemas = {row[1] for row in conn.execute("PRAGMA database_list").fetchall()}
+    schema = "shard0." if table_name == SHARDED_TABLE and "shard0" in schemas else ""
+    return conn.execute(f"PRAGMA {schema}table_info({table_name})").fetchall()
+
+
+@dataclass
+class ShardPlan:
+    kind: str  # "single", "scatter" or "union"
+    shards: List[Shard]
+    partial_sql: Optional[str] = None
+    merge_sql: Optional[str] = None
+
+
+def _target_shards(where, manifest):
+    """Shards the WHERE clause can match, from top-level shard key = / IN predicates."""
+    if not where:
+        return manifest.shards
+    masked = mask(where)
+    if re.search(r"\bOR\b", masked, re.IGNORECASE):
+        return manifest.shards
+    key = re.escape(manifest.shard_key)
+    literal = r"(?:'[^']*'|-?\d+)"
+    for conjunct in re.split(r"\bAND\b", where, flags=re.IGNORECASE):
+        conjunct = conjunct.strip()
+        equals = re.fullmatch(rf'"?{key}"?\s*=\s*({literal})', conjunct, re.IGNORECASE)
+        within = re.fullmatch(rf'"?{key}"?\s+IN\s*\(\s*({literal}(?:\s*,\s*{literal})*)\s*\)', conjunct, re.IGNORECASE)
+        if equals or within:
+            values = re.findall(literal, (equals or within).group(1))
+            return manifest.shards_for([v.strip("'") for v in values])
+    return manifest.shards
+
+
+def _decompose(clauses):
+    """Partial (per shard) and merge SQL for a decomposable aggregate query."""
+    if not clauses.get("select") or re.match(r"DISTINCT\b", clauses["select"], re.IGNORECASE):
+        raise ValueError("not a plain SELECT")
+    items = split_top_level(clauses["select"])
+    if any(item.strip() == "*" for item in items):
+        raise ValueError("SELECT * is not an aggregate")
+
+    # Aggregates from every clause evaluated after grouping
+    partials, merged = [], {}
+    for expr in items + [clauses.get("having") or "", clauses.get("order by") or ""]:
+        for _, _, function, argument in aggregate_calls(expr):
+            key = (function, normalise(argument))
+            if key in merged:
+                continue
+            name = f"_a{len(merged)}"
+            if function == "AVG":
+                partials += [f"SUM({argument}) AS {name}", f"COUNT({argument}) AS {name}_n"]
+                merged[key] = f"(SUM({name}) * 1.0 / SUM({name}_n))"
+            else:
+                partials.append(f"{function}({argument}) AS {name}")
+                merged[key] = f"{'SUM' if function == 'COUNT' else function}({name})"
+    if not merged:
+        raise ValueError("no aggregates")
+
+    def rewrite(expr):
+        calls = aggregate_calls(expr)
+        for start, end, function, argument in reversed(calls):
+            expr = expr[:start] + merged[(function, normalise(argument))] + expr[end:]
+        return expr
+
+    # GROUP BY terms may be columns, select aliases, positions or expressions
+    split_items = [split_alias(item) for item in items]
+    aliases = {alias.strip('"`[]').lower(): expr for expr, alias in split_items if alias}
+    groups = []
+    for j, term in enumerate(split_top_level(clauses.get("group by") or "")):
+        if term.isdigit():
+            expr, alias = split_items[int(term) - 1]
+            name = alias if alias and IDENTIFIER.match(alias) else None
+        elif term.lower() in aliases:
+            expr, name = aliases[term.lower()], term
+        else:
+            expr, name = term, None
+        name = name or (expr if IDENTIFIER.match(expr) else f"_g{j}")
+        if aggregate_calls(expr):
+            raise ValueError("aggregate in GROUP BY")
+        groups.append((expr, name))
+
+    final_items = []
+    for item, (expr, alias) in zip(items, split_items):
+        # Unaliased items keep the column name the unsharded query would return
+        label = alias or (expr if IDENTIFIER.match(expr) else '"' + expr.replace('"', '""') + '"')
+        group_name = next((name for g, name in groups if normalise(g) == normalise(expr)), None)
+        if group_name is not None:
+            final_items.append(group_name if group_name == label else f"{group_name} AS {label}")
+        elif aggregate_calls(expr):
+            final_items.append(f"{rewrite(expr)} AS {label}")
+        elif groups:
+            final_items.append(item)
+        else:
+            raise ValueError("bare column without GROUP BY")
+
+    partial_select = [f"{expr} AS {name}" for expr, name in groups] + partials
+    partial_sql = f"SELECT {', '.join(partial_select)} FROM {SHARDED_TABLE}"
+    if clauses.get("where"):
+        partial_sql += f" WHERE {clauses['where']}"
+    if groups:
+        partial_sql += f" GROUP BY {', '.join(expr for expr, _ in groups)}"
+
+    merge_sql = f"SELECT {', '.join(final_items)} FROM partials"
+    if groups:
+        merge_sql += f" GROUP BY {', '.join(name for _, name in groups)}"
+    if clauses.get("having"):
+        merge_sql += f" HAVING {rewrite(clauses['having'])}"
+    if clauses.get("order by"):
+        merge_sql += f" ORDER BY {rewrite(clauses['order by'])}"
+    if clauses.get("limit"):
+        merge_sql += f" LIMIT {clauses['limit']}"
+    return partial_sql, merge_sql
+
+
+def plan_query(sql, manifest):
+    """Choose how to run `sql` over the shards of `manifest`."""
+    clauses = parse_single_table_select(sql, SHARDED_TABLE)
+    if not clauses:
+        return ShardPlan("union", manifest.shards)
+
+    # No shard holds the value: let the union view return the (empty) result
+    targets = _target_shards(clauses.get("where"), manifest) or manifest.shards
+    if len(targets) == 1:
+        return ShardPlan("single", targets)
+    try:
+        partial_sql, merge_sql = _decompose(clauses)
+    except (ValueError, IndexError) as e:
+        print(f"sharding: not decomposable ({e}), using the union view")
+        return ShardPlan("union", manifest.shards)
+    return ShardPlan("scatter", targets, partial_sql, merge_sql)
+
+
+def _read_shard(shard, sql):
+    conn = blind_index.register(sqlite3.connect(f"file:{shard.path}?mode=ro", uri=True))
+    try:
+        return pd.read_sql_query(sql, conn)
+    finally:
+        conn.close()
+
+
+def execute_sharded(conn, sql, manifest):
+    """Run `sql` on a sharded snapshot. `conn` must come from connect() so the union view exists."""
+    plan = plan_query(sql, manifest)
+    print(f"sharding: {plan.kind} over {len(plan.shards)} of {len(manifest.shards)} shards")
+    if plan.kind == "single":
+        return _read_shard(plan.shards[0], sql)
+    if plan.kind == "union":
+        return pd.read_sql_query(sql, conn)
+
+    frames = list(_shard_pool.map(lambda shard: _read_shard(shard, plan.partial_sql), plan.shards))
+    partials = pd.concat(frames, ignore_index=True)
+    merge_conn = sqlite3.connect(":memory:")
+    try:
+        partials.to_sql("partials", merge_conn, index=False)
+        return pd.read_sql_query(plan.merge_sql, merge_conn)
+    except Exception as e:
+        # Merge SQL could not be evaluated over the partials; the union view always can
+        print(f"sharding: merge failed ({e}), using the union view")
+        return pd.read_sql_query(sql, conn)
+    finally:
+        merge_conn.close()
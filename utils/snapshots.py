@@ -0,0 +1,157 @@
+import json
+import os
+import re
+import threading
+from contextlib import contextmanager
+from utils import sharding
+
+# Each import writes a new versioned database file and then flips the CURRENT
+# pointer, so readers never see a half-written table and never wait on a writer.
+SNAPSHOT_DIR = 'db/snapshots'
+CURRENT_POINTER = 'db/CURRENT'
+LEGACY_DB_PATH = 'db/database.db'
+KEEP_VERSIONS = int(os.environ.get('SNAPSHOT_KEEP_VERSIONS', '3'))
+
+_SNAPSHOT_NAME = re.compile(r'^v(\d+)\.db$')
+_lock = threading.Lock()
+_pins = {}
+
+
+def snapshot_path(version):
+    return os.path.join(SNAPSHOT_DIR, f"v{version}.db")
+
+
+def version_of(db_path):
+    """Snapshot version of a database path (0 for the legacy single database)."""
+    match = _SNAPSHOT_NAME.match(os.path.basename(db_path or ''))
+    return int(match.group(1)) if match else 0
+
+
+def list_versions():
+    if not os.path.isdir(SNAPSHOT_DIR):
+        return []
+    versions = []
+    for name in os.listdir(SNAPSHOT_DIR):
+        match = _SNAPSHOT_NAME.match(name)
+        if match:
+            versions.append(int(match.group(1)))
+    return sorted(versions)
+
+
+def current_snapshot():
+    """
+    Return (version, db_path) of the published dataset.
+    Falls back to the legacy db/database.db (version 0), or (0, None) when nothing was imported.
+    """
+    try:
+        with open(CURRENT_POINTER, 'r') as f:
+            pointer = json.load(f)
+        path = snapshot_path(pointer['version'])
+        if os.path.exists(path):
+            return pointer['version'], path
+    except (OSError, ValueError, KeyError):
+        pass
+    if os.path.exists(LEGACY_DB_PATH):
+        return 0, LEGACY_DB_PATH
+    return 0, None
+
+
+def current_db_path():
+    return current_snapshot()[1]
+
+
+def reserve_snapshot():
+    """Reserve the next version number by creating its file exclusively. Returns (version, path)."""
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    with _lock:
+        version = max(list_versions() + [current_snapshot()[0]]) + 1
+        while True:
+            path = snapshot_path(version)
+            try:
+                os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return version, path
+            except FileExistsError:
+                # Another process reserved it first
+                version += 1
+
+
+def discard_snapshot(version):
+    """Delete a snapshot file, its shard files and any SQLite side files."""
+    path = snapshot_path(version)
+    for db_file in [path] + sharding.shard_files(path):
+        for suffix in ('', '-journal', '-wal', '-shm'):
+            try:
+                os.remove(db_file + suffix)
+            except FileNotFoundError:
+                pass
+
+
+def publish_snapshot(version):
+    """Atomically point CURRENT at `version`, then garbage-collect old versions."""
+    tmp_path = f"{CURRENT_POINTER}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump({'version': version}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, CURRENT_POINTER)
+    gc_snapshots()
+    return version
+
+
+def pin(version):
+    with _lock:
+        _pins[version] = _pins.get(version, 0) + 1
+
+
+def unpin(version):
+    with _lock:
+        _pins[version] -= 1
+        if _pins[version] <= 0:
+            del _pins[version]
+
+
+@contextmanager
+def pinned_snapshot():
+    """Pin the current snapshot for the duration of a read. Yields (version, db_path)."""
+    version, path = current_snapshot()
+    pin(version)
+    try:
+        yield version, path
+    finally:
+        unpin(version)
+
+
+@contextmanager
+def open_snapshot():
+    """Open a read-only connection on the current snapshot; it stays on that version until closed."""
+    with pinned_snapshot() as (version, path):
+        if path is None:
+            raise FileNotFoundError("No dataset has been imported yet")
+        conn = sharding.connect(path, read_only=True)
+        try:
+            yield conn, version
+        finally:
+            conn.close()
+
+
+def gc_snapshots(keep=KEEP_VERSIONS):
+    """
+    Remove old snapshot files. The current version, the newest `keep` versions and
+    anything pinned by a reader in this process are kept; readers in other processes
+    are covered by `keep` (and on POSIX an open file stays readable after unlink).
+    """
+    current = current_snapshot()[0]
+    versions = list_versions()
+    keep_set = set(versions[-keep:]) | {current}
+    removed = []
+    with _lock:
+        pinned = set(_pins)
+    for version in versions:
+        if version in keep_set or version in pinned:
+            continue
+        # Unpublished versions newer than current may still be being written
+        if version > current:
+            continue
+        discard_snapshot(version)
+        removed.append(version)
+    return removed
@@ -0,0 +1,46 @@
+import threading
+
+class SpeculationStats:
+    """
+    Process-wide counters for speculative routing + SQL generation.
+
+    Compares the latency saved by overlapping the two calls with the tokens
+    spent on SQL that was generated but then discarded because routing said "no".
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.runs = 0
+        self.sql_discarded = 0
+        self.pre_executed = 0
+        self.speculative_tokens = 0
+        self.wasted_tokens = 0
+        self.saved_seconds = 0.0
+
+    def record(self, routing_seconds, sql_seconds, wall_seconds, sql_tokens, discarded, pre_executed):
+        with self._lock:
+            self.runs += 1
+            self.speculative_tokens += sql_tokens
+            if discarded:
+                self.sql_discarded += 1
+                self.wasted_tokens += sql_tokens
+            else:
+                # Sequential execution would have paid both latencies one after another
+                self.saved_seconds += max(routing_seconds + sql_seconds - wall_seconds, 0.0)
+            if pre_executed:
+                self.pre_executed += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "runs": self.runs,
+                "sql_discarded": self.sql_discarded,
+                "pre_executed": self.pre_executed,
+                "speculative_tokens": self.speculative_tokens,
+                "wasted_tokens": self.wasted_tokens,
+                "saved_seconds": round(self.saved_seconds, 3),
+                "avg_saved_seconds": round(self.saved_seconds / max(self.runs - self.sql_discarded, 1), 3),
+            }
+
+
+speculation_stats = SpeculationStats()
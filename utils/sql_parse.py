@@ -0,0 +1,129 @@
+"""
+Just enough SQL parsing to rewrite the single-table aggregate queries the
+pipeline generates (used by utils/sharding.py and utils/sampling.py).
+
+Quoted text and nested parentheses are masked so clause keywords, commas and
+aggregate calls are only matched at the level they belong to. Anything this
+cannot handle is reported as None or ValueError and callers run the query as is.
+"""
+import re
+
+_AGGREGATE_CALL = re.compile(r"\b(COUNT|SUM|AVG|MIN|MAX)\s*\(", re.IGNORECASE)
+_CLAUSES = re.compile(r"\b(SELECT|FROM|WHERE|GROUP\s+BY|HAVING|ORDER\s+BY|LIMIT)\b", re.IGNORECASE)
+IDENTIFIER = re.compile(r"^[A-Za-z_]\w*$")
+_ALIAS = re.compile(r"\s+(AS\s+)?(\"[^\"]+\"|`[^`]+`|\[[^\]]+\]|[A-Za-z_]\w*)$", re.IGNORECASE)
+_NOT_ALIASES = {"END", "NULL", "ASC", "DESC", "AND", "OR", "NOT", "ELSE", "THEN"}
+
+
+def mask(sql, mask_parens=True):
+    """Blank out quoted text (and parenthesised text) so keywords are only found at the top level."""
+    out = []
+    depth = 0
+    quote = None
+    for ch in sql:
+        if quote:
+            out.append(" ")
+            if ch == quote:
+                quote = None
+            continue
+        if ch in ("'", '"', "`"):
+            quote = ch
+            out.append(" ")
+            continue
+        if ch == "(":
+            depth += 1
+            out.append(ch if depth == 1 or not mask_parens else " ")
+            continue
+        if ch == ")":
+            depth -= 1
+            out.append(ch if depth == 0 or not mask_parens else " ")
+            continue
+        out.append(" " if depth and mask_parens else ch)
+    return "".join(out)
+
+
+def split_top_level(text, separator=","):
+    masked = mask(text)
+    parts, start = [], 0
+    for i, ch in enumerate(masked):
+        if ch == separator:
+            parts.append(text[start:i].strip())
+            start = i + 1
+    parts.append(text[start:].strip())
+    return [p for p in parts if p]
+
+
+def normalise(expr):
+    return re.sub(r"\s+", " ", expr.strip()).lower()
+
+
+def split_clauses(sql):
+    """{"select": ..., "from": ..., "where": ..., "group by": ..., ...} for one top-level SELECT."""
+    masked = mask(sql)
+    matches = list(_CLAUSES.finditer(masked))
+    clauses = {}
+    for i, match in enumerate(matches):
+        name = re.sub(r"\s+", " ", match.group(1)).lower()
+        if name in clauses:
+            return None
+        end = matches[i + 1].start() if i + 1 < len(matches) else len(sql)
+        clauses[name] = sql[match.end():end].strip()
+    return clauses
+
+
+def aggregate_calls(expr):
+    """(start, end, function, argument) for each aggregate call in expr, outermost only."""
+    masked = mask(expr, mask_parens=False)
+    calls, pos = [], 0
+    while True:
+        match = _AGGREGATE_CALL.search(masked, pos)
+        if not match:
+            return calls
+        depth, end = 0, None
+        for i in range(match.end() - 1, len(masked)):
+            if masked[i] == "(":
+                depth += 1
+            elif masked[i] == ")":
+                depth -= 1
+                if depth == 0:
+                    end = i + 1
+                    break
+        if end is None:
+            raise ValueError("unbalanced parentheses")
+        argument = expr[match.end():end - 1].strip()
+        function = match.group(1).upper()
+        if re.match(r"\s*OVER\b", masked[end:], re.IGNORECASE):
+            raise ValueError("window function")
+        if function in ("MIN", "MAX") and len(split_top_level(argument)) > 1:
+            pos = end  # scalar min()/max()
+            continue
+        if re.match(r"DISTINCT\b", argument, re.IGNORECASE):
+            raise ValueError("DISTINCT aggregate")
+        calls.append((match.start(), end, function, argument))
+        pos = end
+
+
+def split_alias(item):
+    """(expression, alias) of a select item; alias is None when it has none."""
+    item = item.strip()
+    match = _ALIAS.search(item)
+    if IDENTIFIER.match(item) or not match or match.group(2).upper() in _NOT_ALIASES:
+        return item, None
+    expr = item[:match.start()].rstrip()
+    # Without AS only "f(...) name" is an alias; in "a + b" the b is an operand
+    if not match.group(1) and not expr.endswith(")"):
+        return item, None
+    return expr, match.group(2)
+
+
+def parse_single_table_select(sql, table_name):
+    """Clauses of a plain SELECT over `table_name` (no joins, subqueries or compound queries), else None."""
+    sql = sql.strip().rstrip(";").strip()
+    masked = mask(sql, mask_parens=False)
+    if ";" in masked or len(re.findall(r"\bSELECT\b", masked, re.IGNORECASE)) != 1 \
+            or re.search(r"\b(JOIN|UNION|INTERSECT|EXCEPT|WITH)\b", masked, re.IGNORECASE):
+        return None
+    clauses = split_clauses(sql)
+    if not clauses or not re.fullmatch(rf'"?{table_name}"?', clauses.get("from", ""), re.IGNORECASE):
+        return None
+    return clauses
@@ -0,0 +1,167 @@
+import difflib
+import re
+import sqlite3
+from langchain_core.messages import HumanMessage
+from utils.prompt_compiler import PromptCompiler
+from utils.llm_scheduler import scheduler
+
+# Deterministic fix attempts before falling back to a single LLM repair call
+MAX_DETERMINISTIC_FIXES = 5
+
+SQL_START = re.compile(r"^\s*(select|with)\b", re.IGNORECASE)
+NARRATION_START = re.compile(
+    r"^\s*(here|this query|the query|note|explanation|this will|this sql|i have|sure|```)", re.IGNORECASE
+)
+NO_SUCH_COLUMN = re.compile(r"no such column: ([\w.\"'`]+)", re.IGNORECASE)
+NO_SUCH_TABLE = re.compile(r"no such table: ([\w.\"'`]+)", re.IGNORECASE)
+
+
+def compile_sql(conn, sql):
+    """
+    Compile the SQL locally without running it (EXPLAIN only prepares the statement).
+    Returns the SQLite error message, or None when the statement is valid.
+    """
+    if not sql.strip():
+        return "empty SQL statement"
+    if not SQL_START.match(sql):
+        return "only SELECT/WITH queries are allowed"
+    if not sqlite3.complete_statement(sql.rstrip().rstrip(";") + ";"):
+        return "incomplete SQL statement"
+    try:
+        conn.execute(f"EXPLAIN {sql}").fetchall()
+        return None
+    except sqlite3.Warning as e:
+        # Raised for multiple statements in one string
+        return str(e)
+    except sqlite3.Error as e:
+        return str(e)
+
+
+def strip_non_sql(text):
+    """Drop markdown fences and narration lines so only the SQL statement is left."""
+    fenced = re.search(r"```(?:sql)?(.*?)```", text, re.DOTALL | re.IGNORECASE)
+    if fenced:
+        text = fenced.group(1)
+
+    lines = text.strip().splitlines()
+    # Start at the first line that opens a query
+    start = next((i for i, line in enumerate(lines) if SQL_START.match(line)), 0)
+    kept = []
+    for line in lines[start:]:
+        if NARRATION_START.match(line):
+            break
+        kept.append(line)
+        if line.rstrip().endswith(";"):
+            break
+    return "\n".join(kept).strip().rstrip(";").strip()
+
+
+def _unquote(identifier):
+    return identifier.strip("\"'`")
+
+
+def _replace_identifier(sql, old, new):
+    return re.sub(rf"(?<![\w'\"]){re.escape(old)}(?![\w'\"])", new, sql)
+
+
+def fix_unknown_column(sql, error, column_names):
+    """
+    Repair a "no such column" error: fuzzy-match the name to a real column, or when
+    none is close and the name is compared like a value (country = France,
+    country IN ('Spain', France)) quote it as a string.
+    """
+    match = NO_SUCH_COLUMN.search(error)
+    if not match:
+        return None
+    bad = _unquote(match.group(1))
+    bad_name = bad.split(".")[-1]
+
+    close = difflib.get_close_matches(bad_name.lower(), [c.lower() for c in column_names], n=1, cutoff=0.75)
+    if close:
+        real = next(c for c in column_names if c.lower() == close[0])
+        fixed = _replace_identifier(sql, bad, real)
+        if fixed != sql:
+            return fixed
+
+    # Unquoted literal on the right of a comparison: country = France
+    name = rf"(?<![\w'\"]){re.escape(bad)}(?![\w'\"])"
+    literal = re.sub(rf"((?:=|!=|<>)\s*){name}", lambda m: f"{m.group(1)}'{bad}'", sql)
+    # ... or an element of an IN (...) list; a comma elsewhere separates columns, not values
+    literal = re.sub(r"(\bin\s*\()([^()]*)\)",
+                     lambda m: m.group(1) + re.sub(name, f"'{bad}'", m.group(2)) + ")",
+                     literal, flags=re.IGNORECASE)
+    return literal if literal != sql else None
+
+
+def fix_unknown_table(sql, error, table_name):
+    match = NO_SUCH_TABLE.search(error)
+    if not match:
+        return None
+    fixed = _replace_identifier(sql, _unquote(match.group(1)), table_name)
+    return fixed if fixed != sql else None
+
+
+def quote_identifiers(sql, column_names):
+    """Double-quote column names that are not plain identifiers (spaces, dashes, keywords)."""
+    fixed = sql
+    for name in column_names:
+        if not re.fullmatch(r"[A-Za-z_]\w*", name):
+            fixed = re.sub(rf'(?<!["\w]){re.escape(name)}(?!["\w])', f'"{name}"', fixed)
+    return fixed
+
+
+def llm_repair_sql(llm, question, sql, error, schema_context):
+    """One bounded LLM repair call that includes the SQLite error."""
+    compiler = PromptCompiler("sql_repair")
+    compiler.add_static("context", schema_context)
+    compiler.add_static("instructions", """
+You are fixing a SQLite query that failed to compile.
+Return only the corrected raw SQL query (no markdown, no explanation).
+""")
+    compiler.add_dynamic("failed_sql", f"Failed SQL:\n{sql}\n\nSQLite error:\n{error}")
+    compiler.set_question(f'User question: "{question}"')
+    response = scheduler.invoke(llm, [HumanMessage(content=compiler.compile())], stage="sql_repair")
+    return strip_non_sql(response.content)
+
+
+def validate_and_repair(conn, sql, column_names, table_name="customer_data",
+                        llm=None, question=None, schema_context=""):
+    """
+    Validate generated SQL locally and repair it cheaply before execution.
+
+    Returns (sql, error, repairs): error is None when the final SQL compiles,
+    repairs lists the fixes that were applied in order.
+    """
+    repairs = []
+    cleaned = strip_non_sql(sql)
+    # A trailing semicolon alone is not worth reporting (or dropping speculative results for)
+    if cleaned.rstrip().rstrip(";") != sql.strip().rstrip(";").rstrip():
+        repairs.append("stripped non-SQL text")
+    sql = cleaned
+
+    error = compile_sql(conn, sql)
+    attempts = 0
+    while error and attempts < MAX_DETERMINISTIC_FIXES:
+        attempts += 1
+        for name, fix in (
+            ("fixed unknown column", lambda s, e: fix_unknown_column(s, e, column_names)),
+            ("fixed table name", lambda s, e: fix_unknown_table(s, e, table_name)),
+            ("quoted identifiers", lambda s, e: quote_identifiers(s, column_names)),
+        ):
+            fixed = fix(sql, error)
+            if fixed and fixed != sql:
+                sql = fixed
+                repairs.append(name)
+                break
+        else:
+            # No deterministic fix applies to this error
+            break
+        error = compile_sql(conn, sql)
+
+    if error and llm is not None:
+        print(f"local SQL repair failed ({error}), asking the LLM once")
+        sql = llm_repair_sql(llm, question or "", sql, error, schema_context)
+        repairs.append("llm repair")
+        error = compile_sql(conn, sql)
+
+    return sql, error, repairs
@@ -0,0 +1,30 @@
+import threading
+import time
+from contextlib import contextmanager
+
+# Per-question collector, so one run can report how long each pipeline stage took
+_local = threading.local()
+
+
+@contextmanager
+def collect_stage_timings():
+    """Collect the stage timings recorded on this thread into a {stage: seconds} dict."""
+    timings = {}
+    previous = getattr(_local, "collector", None)
+    _local.collector = timings
+    try:
+        yield timings
+    finally:
+        _local.collector = previous
+
+
+@contextmanager
+def stage_timer(stage):
+    """Time a block and add it to the current collector; repeated stages add up."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        collector = getattr(_local, "collector", None)
+        if collector is not None:
+            collector[stage] = collector.get(stage, 0.0) + time.perf_counter() - start
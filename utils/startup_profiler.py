@@ -0,0 +1,135 @@
+"""
+Startup profiling: per-module import time, cold start and first-paint latency.
+
+Enable in the app with STARTUP_PROFILE=1; results are appended to
+db/startup_profile.jsonl so cold start can be tracked over time.
+Run it on its own to profile the imports of any module:
+
+    python -m utils.startup_profiler utils.helper llm_agent_pipeline --top 20
+"""
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+
+PROFILE_ENABLED = os.environ.get("STARTUP_PROFILE", "0") == "1"
+PROFILE_LOG_PATH = "db/startup_profile.jsonl"
+# Modules app.py needs before the first paint, and the ones deferred to the first question
+STARTUP_MODULES = ["streamlit", "utils.helper", "utils.import_jobs", "utils.snapshots"]
+DEFERRED_MODULES = ["llm_agent_pipeline"]
+
+
+
+def _process_start_time():
+    """Wall-clock start of this process (Linux /proc), else the time this module was first imported."""
+    try:
+        with open("/proc/self/stat") as f:
+            # The command name may contain spaces; fields after it are space separated
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/stat") as f:
+            boot_time = next(int(line.split()[1]) for line in f if line.startswith("btime"))
+        return boot_time + start_ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError, StopIteration, AttributeError):
+        return time.time()
+
+
+PROCESS_STARTED = _process_start_time()
+_first_paint_recorded = False
+_lock = threading.Lock()
+
+_IMPORTTIME_LINE = re.compile(r"import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+
+
+def profile_imports(modules, top=25):
+    """
+    Import `modules` in a fresh interpreter with -X importtime and return
+    {"total_ms": ..., "modules": [{"module", "self_ms", "cumulative_ms", "depth"}, ...]}
+    sorted by cumulative time. A subprocess keeps the measurement cold.
+    """
+    code = "; ".join(f"import {m}" for m in modules)
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True, text=True, cwd=os.getcwd(),
+    )
+    entries = []
+    for line in result.stderr.splitlines():
+        match = _IMPORTTIME_LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            entries.append({
+                "module": name,
+                "self_ms": int(self_us) / 1000,
+                "cumulative_ms": int(cumulative_us) / 1000,
+                "depth": len(indent) // 2,
+            })
+    top_level = [e for e in entries if e["depth"] == 0]
+    return {
+        "modules_profiled": list(modules),
+        "total_ms": round(sum(e["cumulative_ms"] for e in top_level), 1),
+        "returncode": result.returncode,
+        "modules": sorted(entries, key=lambda e: e["cumulative_ms"], reverse=True)[:top],
+    }
+
+
+def _append_log(record, log_path=PROFILE_LOG_PATH):
+    os.makedirs(os.path.dirname(log_path), exist_ok=True)
+    with open(log_path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(record) + "\n")
+
+
+def mark_first_paint(script_started):
+    """
+    Record render latency. The first call in a process also records cold start
+    (process start -> first paint) and profiles imports in the background.
+    """
+    global _first_paint_recorded
+    if not PROFILE_ENABLED:
+        return
+    now = time.time()
+    render_ms = round((now - script_started) * 1000, 1)
+    with _lock:
+        first = not _first_paint_recorded
+        _first_paint_recorded = True
+    if not first:
+        print(f"startup-profile: rerun rendered in {render_ms} ms")
+        return
+
+    cold_start_ms = round((now - PROCESS_STARTED) * 1000, 1)
+    print(f"startup-profile: cold start {cold_start_ms} ms, first paint {render_ms} ms")
+
+    def profile():
+        record = {
+            "ts": now,
+            "cold_start_ms": cold_start_ms,
+            "first_paint_ms": render_ms,
+            "loaded_modules": len(sys.modules),
+            "startup_imports": profile_imports(STARTUP_MODULES),
+            "deferred_imports": profile_imports(DEFERRED_MODULES),
+        }
+        _append_log(record)
+
+    threading.Thread(target=profile, name="startup-profile", daemon=True).start()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-module import time of the given modules")
+    parser.add_argument("modules", nargs="+")
+    parser.add_argument("--top", type=int, default=25)
+    parser.add_argument("--log", action="store_true", help=f"Append the result to {PROFILE_LOG_PATH}")
+    args = parser.parse_args()
+
+    report = profile_imports(args.modules, top=args.top)
+    print(f"Total import time: {report['total_ms']} ms")
+    print(f"{'cumulative ms':>14} {'self ms':>10}  module")
+    for entry in report["modules"]:
+        print(f"{entry['cumulative_ms']:>14.1f} {entry['self_ms']:>10.1f}  {'  ' * entry['depth']}{entry['module']}")
+    if args.log:
+        _append_log({"ts": time.time(), "imports": report})
+
+
+if __name__ == "__main__":
+    main()